@@ -11,9 +11,13 @@ from messy.scripts import run
 # initialize view
 # from messy.views import *
 from messy.routes import includeme
-from messy.lib.uploads import set_temp_directory
+from messy.lib.uploads import set_temp_directory, set_chunk_size
 from messy.lib.nomenclature import load_location_data
 from messy.lib.qstospec import set_fields
+from messy.lib import jobs
+from messy import configkeys as ck
+
+from pyramid.settings import asbool
 
 
 def get_userid_func():
@@ -32,8 +36,12 @@ def main(global_config, **settings):
                       include=includeme, include_tags=['messy.includes'])
 
     set_temp_directory(config.get_settings().get('messy.temp_directory'))
+    set_chunk_size(int(config.get_settings().get(ck.msy_upload_chunk_size, 1000)))
     load_location_data(config.get_settings().get('assets.directory') + '/locations.json')
 
+    # background jobs, executed by messy-run worker processes
+    jobs.set_jobs_enabled(asbool(config.get_settings().get(ck.msy_jobs_enabled, False)))
+
     # prepare query syntax parser
     set_fields(get_dbhandler_class().query_constructor_class.field_specs.keys())
 
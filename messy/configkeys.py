@@ -4,5 +4,11 @@ from rhombus.configkeys import *
 msy_includes = 'messy.includes'
 msy_temp_directory = 'messy.temp_directory'
 msy_whoosh_path = 'messy.whoosh.path'
+msy_whoosh_background = 'messy.whoosh.background'
+msy_search_backend = 'messy.search.backend'
+msy_upload_chunk_size = 'messy.upload.chunk_size'
+msy_jobs_enabled = 'messy.jobs.enabled'
+msy_ekcache_ttl = 'messy.ekcache.ttl'
+msy_ekcache_log_stats = 'messy.ekcache.log_stats'
 
 # EOF
@@ -64,6 +64,9 @@ def includeme(config):
         ('/fastqpair/{id}', 'view'),
     )
 
+    config.add_jsonrpc_method('messy.ext.ngsmgr.lib.rpc.pipeline_upload',
+                              endpoint='rpc-msy-v1', method='pipeline_upload')
+
     # id here is a session key, generated based on user_id and ngsrun_id that holds the
     # fastq
     add_route_view_class(
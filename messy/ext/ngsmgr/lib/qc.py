@@ -0,0 +1,109 @@
+
+# loading pipeline QC metrics into SampleQC
+#
+# QC records are processed in chunks; each chunk resolves its sample codes and existing
+# SampleQC rows with a single query each, and is flushed before the next one, so that
+# thousands of rows can be loaded in one transaction.
+
+from rhombus.lib.utils import get_dbhandler
+from messy.lib import converter
+from messy.models.dbschema import Sample, PlatePosition, Plate
+from messy.ext.ngsmgr.models.schema import SampleQC, NGSRunPlate
+
+from sqlalchemy import select
+
+
+def load_pipeline_qc(instream, ngsrun, user, dbh=None, chunksize=5000):
+    """ insert or update SampleQC of ngsrun from pipeline QC TSV file,
+        return (inserted, updated, failed) with failed as list of (code, message)
+    """
+
+    dbh = dbh or get_dbhandler()
+    inserted = updated = 0
+    failed = []
+
+    for df in converter.iter_pipeline_frames(instream, chunksize):
+        counts = upsert_sample_qcs(converter.frame_to_records(df), ngsrun, user, dbh)
+        inserted += counts[0]
+        updated += counts[1]
+        failed += counts[2]
+        dbh.session().flush()
+
+    return inserted, updated, failed
+
+
+def upsert_sample_qcs(records, ngsrun, user, dbh=None):
+    """ insert or update SampleQC of ngsrun from dicts with sample code as 'sample' and
+        SampleQC metric fields, return (inserted, updated, failed)
+    """
+
+    dbh = dbh or get_dbhandler()
+    if not ngsrun.can_modify(user):
+        raise PermissionError(f'Current user can not modify NGS run {ngsrun.code}')
+
+    session = dbh.session()
+    sample_ids, failed = resolve_sample_codes({d['sample'] for d in records}, ngsrun, session)
+
+    existing = {
+        qc.sample_id: qc for qc in SampleQC.query(session).filter(
+            SampleQC.ngsrun_id == ngsrun.id,
+            SampleQC.sample_id.in_(sample_ids.values())
+        )
+    }
+
+    inserted = updated = 0
+    new_qcs = []
+    for d in records:
+        if (sample_id := sample_ids.get(d['sample'], None)) is None:
+            continue
+        values = {f: d[f] for f in SampleQC.__metric_fields__ if f in d}
+        if (qc := existing.get(sample_id, None)) is not None:
+            qc.update_fields_with_dict(values)
+            updated += 1
+        else:
+            existing[sample_id] = qc = SampleQC(sample_id=sample_id, ngsrun_id=ngsrun.id,
+                                                **values)
+            new_qcs.append(qc)
+            inserted += 1
+
+    session.add_all(new_qcs)
+    return inserted, updated, failed
+
+
+def resolve_sample_codes(codes, ngsrun, session):
+    """ return {code: sample_id} and failed list; sample codes are unique only within a
+        collection, hence a code shared by several samples is resolved to the sample
+        placed on the plates of ngsrun
+    """
+
+    candidates = {}
+    for code, sample_id in session.execute(
+            select(Sample.code, Sample.id).where(Sample.code.in_(codes))):
+        candidates.setdefault(code, []).append(sample_id)
+
+    ambiguous = [code for code, ids in candidates.items() if len(ids) > 1]
+    run_samples = set()
+    if ambiguous:
+        run_samples = set(session.scalars(
+            select(Sample.id).join(PlatePosition).join(Plate).join(NGSRunPlate).where(
+                NGSRunPlate.ngsrun_id == ngsrun.id, Sample.code.in_(ambiguous))
+        ))
+
+    sample_ids = {}
+    failed = []
+    for code in sorted(codes):
+        ids = candidates.get(code, [])
+        if len(ids) == 0:
+            failed.append((code, 'sample does not exist'))
+            continue
+        if len(ids) > 1:
+            ids = [i for i in ids if i in run_samples]
+        if len(ids) == 1:
+            sample_ids[code] = ids[0]
+        else:
+            failed.append((code, 'sample code matches several samples, but not a single '
+                                 'sample in the plates of this NGS run'))
+
+    return sample_ids, failed
+
+# EOF
@@ -0,0 +1,43 @@
+
+from rhombus.lib.utils import get_dbhandler
+from rhombus.lib import rpc
+from messy.lib import converter
+from messy.ext.ngsmgr.lib.qc import upsert_sample_qcs
+
+import pandas as pd
+
+
+# number of QC rows resolved and upserted at once
+CHUNK_SIZE = 5000
+
+
+def pipeline_upload(request, token, run_code, sample_code, data):
+    """ upsert pipeline QC metrics of an NGS run; data is either a dict of QC columns (eg.
+        AVGDEPTH, RAW) of sample_code, or a list of such dicts with SAMPLE column when
+        sample_code is empty
+    """
+
+    user, errmsg = rpc.get_userinstance_by_token(request, token)
+    if user is None:
+        return {'auth': False, 'user': None, 'errmsg': errmsg}
+
+    dbh = get_dbhandler()
+    runs = dbh.get_ngsruns_by_codes(run_code, groups=None, user=user)
+    if len(runs) == 0:
+        return {'auth': True, 'errmsg': f'NGS run {run_code} does not exist'}
+
+    rows = [dict(data, SAMPLE=sample_code)] if sample_code else data
+    inserted = updated = 0
+    failed = []
+    for start in range(0, len(rows), CHUNK_SIZE):
+        df = pd.DataFrame(rows[start:start + CHUNK_SIZE]).fillna('').astype(str)
+        counts = upsert_sample_qcs(
+            converter.frame_to_records(converter.pipeline_frame_to_qcs(df)), runs[0], user, dbh)
+        inserted += counts[0]
+        updated += counts[1]
+        failed += counts[2]
+        dbh.session().flush()
+
+    return {'auth': True, 'inserted': inserted, 'updated': updated, 'failed': failed}
+
+# EOF
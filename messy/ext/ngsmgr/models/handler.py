@@ -1,6 +1,7 @@
 from rhombus.lib.utils import cerr
 from messy.ext.ngsmgr.models import schema
 from messy.ext.ngsmgr.lib import roles as r
+from sqlalchemy.orm import joinedload, selectinload, undefer
 
 __initialized__ = False
 
@@ -24,6 +25,7 @@ def generate_handler_class(base_class):
             'panel_id': schema.Panel.id,
             'panel_code': schema.Panel.code,
             'fastqpair_id': schema.FastqPair.id,
+            'sampleqc_id': schema.SampleQC.id,
             'fastquploadjob_id': schema.FastqUploadJob.id,
             'fastquploadjob_sesskey': schema.FastqUploadJob.sesskey,
         }
@@ -36,6 +38,7 @@ def generate_handler_class(base_class):
         NGSRunPlate = schema.NGSRunPlate
         Panel = schema.Panel
         FastqPair = schema.FastqPair
+        SampleQC = schema.SampleQC
         FastqUploadJob = schema.FastqUploadJob
 
 
@@ -43,6 +46,35 @@ def generate_handler_class(base_class):
 
         query_constructor_class = MessyNGSMSQueryConstructor
 
+        # named eager-loading profiles
+
+        _R = schema.NGSRun
+        _F = schema.FastqPair
+
+        load_profiles = base_class.load_profiles | {
+            _R: {
+                'list': [undefer(_R.remark)],
+                'detail': [joinedload(_R.group), joinedload(_R.ngs_provider),
+                           joinedload(_R.depthplots_file), joinedload(_R.qcreport_file),
+                           joinedload(_R.screenshot_file), selectinload(_R.additional_files),
+                           selectinload(_R.plates).joinedload(schema.NGSRunPlate.plate),
+                           undefer(_R.remark)],
+                'export': [joinedload(_R.group), joinedload(_R.ngs_provider),
+                           selectinload(_R.plates).joinedload(schema.NGSRunPlate.plate),
+                           selectinload(_R.fastqpairs), undefer(_R.remark)],
+            },
+            _F: {
+                'list': [joinedload(_F.sample), joinedload(_F.panel), joinedload(_F.read1_file),
+                         joinedload(_F.read2_file)],
+                'detail': [joinedload(_F.sample), joinedload(_F.panel), joinedload(_F.ngsrun),
+                           joinedload(_F.group), joinedload(_F.read1_file),
+                           joinedload(_F.read2_file)],
+                'export': [joinedload(_F.sample), joinedload(_F.panel), joinedload(_F.ngsrun),
+                           joinedload(_F.read1_file), joinedload(_F.read2_file)],
+            },
+        }
+        del _R, _F
+
         # define additional methods here
 
         def initdb(self, create_table=True, init_data=True, rootpasswd=None, ek_initlist=[]):
@@ -57,21 +89,24 @@ def generate_handler_class(base_class):
 
         # accessor for ngsrun
 
-        def get_ngsruns(self, groups, specs=None, user=None, fetch=True, raise_if_empty=False):
+        def get_ngsruns(self, groups, specs=None, user=None, fetch=True, raise_if_empty=False,
+                        load=None):
 
-            q = self.construct_select(self.NGSRun, specs)
+            q = self.apply_load(self.construct_select(self.NGSRun, specs), self.NGSRun, load)
             if fetch:
                 q = q.order_by(self.NGSRun.date.desc())
 
             return self.fetch_select(q, fetch, raise_if_empty)
 
-        def get_ngsruns_by_ids(self, ids, groups, user=None, fetch=True, raise_if_empty=False):
+        def get_ngsruns_by_ids(self, ids, groups, user=None, fetch=True, raise_if_empty=False,
+                               load=None):
             return self.get_ngsruns(groups, [{'ngsrun_id': ids}], user=user, fetch=fetch,
-                                    raise_if_empty=raise_if_empty)
+                                    raise_if_empty=raise_if_empty, load=load)
 
-        def get_ngsruns_by_codes(self, codes, groups, user=None, fetch=True, raise_if_empty=False):
+        def get_ngsruns_by_codes(self, codes, groups, user=None, fetch=True, raise_if_empty=False,
+                                 load=None):
             return self.get_ngsruns(groups, [{'ngsrun_code': codes}], user=user, fetch=fetch,
-                                    raise_if_empty=raise_if_empty)
+                                    raise_if_empty=raise_if_empty, load=load)
 
         # accessor for Panel
         # Panel does not require strict ACLs
@@ -94,9 +129,10 @@ def generate_handler_class(base_class):
 
         # accessor for FastqPair
 
-        def get_fastqpairs(self, groups, specs=None, user=None, fetch=True, raise_if_empty=False):
+        def get_fastqpairs(self, groups, specs=None, user=None, fetch=True, raise_if_empty=False,
+                           load=None):
 
-            q = self.construct_query(self.FastqPair, specs)
+            q = self.apply_load(self.construct_query(self.FastqPair, specs), self.FastqPair, load)
 
             # check permission
             if groups:
@@ -104,9 +140,10 @@ def generate_handler_class(base_class):
 
             return self.fetch_query(q, fetch, raise_if_empty)
 
-        def get_fastqpairs_by_ids(self, ids, groups, user=None, fetch=True, raise_if_empty=False):
+        def get_fastqpairs_by_ids(self, ids, groups, user=None, fetch=True, raise_if_empty=False,
+                                  load=None):
             return self.get_fastqpairs(groups, [{'fastqpair_id': ids}], user=user, fetch=fetch,
-                                       raise_if_empty=raise_if_empty)
+                                       raise_if_empty=raise_if_empty, load=load)
 
         # accessor for FastqUploadjob and FastqUploadItem
 
@@ -1,12 +1,13 @@
 
 from messy.ext.ngsmgr.lib import roles as r
+from messy.lib.acl import get_acl_context
 from messy.models.dbschema import (Institution, Sample, Plate, PlatePosition, UploadJob,
                                    UploadItem, convert_date)
 
 from rhombus.lib.utils import cerr, cout, get_dbhandler
 from rhombus.models.core import (Base, BaseMixIn, metadata, deferred, relationship,
                                  registered, declared_attr, column_property)
-from rhombus.models.ek import EK
+from messy.lib.ekcache import ek_proxy
 from rhombus.models.user import Group, User
 from rhombus.models.fileattach import FileAttachment
 from rhombus.models.auxtypes import GUID
@@ -142,7 +143,7 @@ class NGSRun(BaseMixIn, Base):
     ngs_provider = relationship(Institution, uselist=False, foreign_keys=ngs_provider_id)
 
     ngs_kit_id = Column(types.Integer, ForeignKey('eks.id'), nullable=False)
-    ngs_kit = EK.proxy('ngs_kit_id', '@NGS_KIT')
+    ngs_kit = ek_proxy('ngs_kit_id', '@NGS_KIT')
 
     # pdf of depthplots, if available
     depthplots_file_id = Column(types.Integer, ForeignKey('fileattachments.id'), nullable=True)
@@ -177,6 +178,9 @@ class NGSRun(BaseMixIn, Base):
     plates = relationship('NGSRunPlate', order_by='ngsrunplates.c.plate_id',
                           back_populates='ngsrun')
 
+    __searchable__ = ['code', 'serial']
+    __searchable_filters__ = ['group_id', 'public', 'refctrl']
+
     __managing_roles__ = BaseMixIn.__managing_roles__ | {r.NGSRUN_MANAGE}
     __modifying_roles__ = __managing_roles__ | {r.NGSRUN_MODIFY}
 
@@ -240,9 +244,10 @@ class NGSRun(BaseMixIn, Base):
             srp = NGSRunPlate.from_dict(d, dbh)
 
     def can_modify(self, user):
-        if user.has_roles(* self.__managing_roles__):
+        acl = get_acl_context(user)
+        if acl.has_roles(* self.__managing_roles__):
             return True
-        if user.has_roles(* self.__modifying_roles__):  # and user.in_group(self.group):
+        if acl.has_roles(* self.__modifying_roles__):  # and acl.in_group(self.group_id):
             return True
         return False
 
@@ -281,7 +286,7 @@ class NGSRunPlate(BaseMixIn, Base):
                          back_populates='ngsruns')
 
     adapterindex_id = Column(types.Integer, ForeignKey('eks.id'), nullable=False)
-    adapterindex = EK.proxy('adapterindex_id', '@ADAPTERINDEX')
+    adapterindex = ek_proxy('adapterindex_id', '@ADAPTERINDEX')
 
     lane = Column(types.Integer, nullable=False, server_default='1')
 
@@ -326,7 +331,7 @@ class Panel(BaseMixIn, Base):
     related_panel = relationship('Panel', uselist=False, remote_side='Panel.id')
 
     species_id = Column(types.Integer, ForeignKey('eks.id'), nullable=False)
-    species = EK.proxy('species_id', '@SPECIES')
+    species = ek_proxy('species_id', '@SPECIES')
 
     __table_args__ = (
         UniqueConstraint('code', 'type'),
@@ -338,13 +343,17 @@ class Panel(BaseMixIn, Base):
                                     collection_class=attribute_mapped_collection('id'),
                                     order_by=FileAttachment.filename)
 
+    __searchable__ = ['code', 'remark']
+    __searchable_filters__ = ['group_id', 'public', 'refctrl']
+
     __managing_roles__ = BaseMixIn.__managing_roles__ | {r.PANEL_MANAGE}
     __modifying_roles__ = __managing_roles__ | {r.PANEL_MODIFY}
 
     def can_modify(self, user):
-        if user.has_roles(* self.__managing_roles__):
+        acl = get_acl_context(user)
+        if acl.has_roles(* self.__managing_roles__):
             return True
-        if user.has_roles(* self.__modifying_roles__) and user.in_group(self.group):
+        if acl.has_roles(* self.__modifying_roles__) and acl.in_group(self.group_id):
             return True
         return False
 
@@ -431,6 +440,51 @@ class FastqPair(BaseMixIn, Base):
             self.read2_file.clear()
 
 
+class SampleQC(BaseMixIn, Base):
+    """ QC metrics of a sample sequenced in an NGS run, as reported by the pipeline """
+
+    __tablename__ = 'sampleqcs'
+
+    sample_id = Column(types.Integer, ForeignKey('samples.id', ondelete='CASCADE'),
+                       index=True, nullable=False)
+    sample = relationship('Sample', uselist=False, foreign_keys=sample_id)
+
+    ngsrun_id = Column(types.Integer, ForeignKey('ngsruns.id', ondelete='CASCADE'),
+                       index=True, nullable=False)
+    ngsrun = relationship(NGSRun, uselist=False, foreign_keys=ngsrun_id)
+
+    # assembly metrics
+    avg_depth = Column(types.Float, nullable=True)
+    length = Column(types.Integer, nullable=True)
+    base_N = Column(types.Integer, nullable=True)
+    point_mutations = Column(types.Integer, nullable=True)
+    inframe_gaps = Column(types.Integer, nullable=True)
+    outframe_gaps = Column(types.Integer, nullable=True)
+
+    # read counts after each processing step
+    raw_reads = Column(types.Integer, nullable=True)
+    op_dedup_reads = Column(types.Integer, nullable=True)
+    adapter_reads = Column(types.Integer, nullable=True)
+    prop_pair_reads = Column(types.Integer, nullable=True)
+    pcr_dedup_reads = Column(types.Integer, nullable=True)
+    primal_reads = Column(types.Integer, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint('sample_id', 'ngsrun_id'),
+    )
+
+    # fields that are set from pipeline QC records
+    __metric_fields__ = ['avg_depth', 'length', 'base_N', 'point_mutations', 'inframe_gaps',
+                         'outframe_gaps', 'raw_reads', 'op_dedup_reads', 'adapter_reads',
+                         'prop_pair_reads', 'pcr_dedup_reads', 'primal_reads']
+
+    def __repr__(self):
+        return f'<SampleQC sample_id={self.sample_id} ngsrun_id={self.ngsrun_id}>'
+
+    def can_modify(self, user):
+        return self.ngsrun.can_modify(user)
+
+
 class FastqUploadJob(UploadJob):
 
     __subdir__ = 'tmp-uploads/fastqs/'
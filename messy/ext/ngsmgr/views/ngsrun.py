@@ -174,7 +174,7 @@ class NGSRunViewer(BaseViewer):
 
         runs = self.dbh.scalars(
             self.dbh.get_ngsruns(
-                groups=None, fetch=False
+                groups=None, fetch=False, load='list'
             ).order_by(self.dbh.NGSRun.date.desc())
         )
 
@@ -489,7 +489,7 @@ def generate_ngsrun_table(ngsruns, request):
 
     table_body = t.tbody()
 
-    not_guest = not request.user.has_roles(r.GUEST)
+    not_guest = not request.acl.is_guest
 
     for ngsrun in ngsruns:
         table_body.add(
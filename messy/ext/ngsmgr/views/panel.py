@@ -245,8 +245,8 @@ def generate_panel_table(panels, request):
 
     table_body = t.tbody()
 
-    not_guest = not request.user.has_roles(r.GUEST)
-    can_manage = request.user.has_roles(* PanelViewer.modifying_roles)
+    not_guest = not request.acl.is_guest
+    can_manage = request.acl.has_roles(* PanelViewer.modifying_roles)
 
     for p in panels:
         table_body.add(
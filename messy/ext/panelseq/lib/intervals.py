@@ -0,0 +1,182 @@
+
+# interval index of panel regions and variants
+#
+# coordinates follow BED convention: 0-based begin and exclusive end for regions, while
+# variant positions are 1-based (VCF), ie. a variant at position p is the interval
+# [p - 1, p). a 1-based position p is inside a region if begin < p <= end.
+#
+# IntervalIndex keeps, for each chromosome, the intervals sorted by begin together with
+# the running maximum of their ends. the intervals overlapping [begin, end) are those
+# with index between bisect(running max end, begin) and bisect(begins, end - 1), so
+# that overlap and containment queries only scan the candidate intervals.
+#
+# PanelIntervalCache holds the IntervalIndex of regions and of variants of each panel.
+# a flush that modifies regions, variants or the region/variant list of a panel marks its
+# session, and the affected panels are dropped from the cache after the session commits.
+
+from rhombus.models.meta import RhoSession
+from sqlalchemy import event, select, inspect
+
+from bisect import bisect_left, bisect_right
+import itertools
+import threading
+import time
+
+
+class IntervalIndex(object):
+
+    def __init__(self, intervals):
+        """ intervals is iterable of (chrom, begin, end, value) """
+
+        self.chroms = {}
+        for chrom, items in itertools.groupby(sorted(intervals, key=lambda x: x[:3]),
+                                              key=lambda x: x[0]):
+            items = list(items)
+            begins = [i[1] for i in items]
+            ends = [i[2] for i in items]
+            self.chroms[chrom] = (begins, ends, list(itertools.accumulate(ends, max)),
+                                  [i[3] for i in items])
+
+    def __len__(self):
+        return sum(len(c[0]) for c in self.chroms.values())
+
+    def overlaps(self, chrom, begin, end):
+        """ return values of intervals overlapping [begin, end) """
+        if (c := self.chroms.get(chrom, None)) is None:
+            return []
+        begins, ends, max_ends, values = c
+        return [values[i]
+                for i in range(bisect_right(max_ends, begin), bisect_left(begins, end))
+                if ends[i] > begin]
+
+    def containing(self, chrom, position):
+        """ return values of intervals containing 1-based position """
+        return self.overlaps(chrom, position - 1, position)
+
+    def contained(self, chrom, begin, end):
+        """ return values of intervals lying completely within [begin, end) """
+        if (c := self.chroms.get(chrom, None)) is None:
+            return []
+        begins, ends, _, values = c
+        return [values[i]
+                for i in range(bisect_left(begins, begin), bisect_left(begins, end))
+                if ends[i] <= end]
+
+    def map_positions(self, chrom, positions):
+        """ return [values of intervals containing each 1-based position] """
+        if (c := self.chroms.get(chrom, None)) is None:
+            return [[] for _ in positions]
+        begins, ends, max_ends, values = c
+        return [[values[i]
+                 for i in range(bisect_left(max_ends, p), bisect_left(begins, p))
+                 if ends[i] >= p]
+                for p in positions]
+
+
+def region_intervals(session, panel_id):
+    from messy.ext.panelseq.models.schema import Region, panel_region_table as t
+    return session.execute(
+        select(Region.chrom, Region.begin, Region.end, Region.id)
+        .join(t, t.c.region_id == Region.id).where(t.c.panel_id == panel_id)
+    ).all()
+
+
+def variant_intervals(session, panel_id):
+    from messy.ext.panelseq.models.schema import Variant, panel_variant_table as t
+    return [(chrom, position - 1, position, variant_id) for chrom, position, variant_id in
+            session.execute(
+                select(Variant.chrom, Variant.position, Variant.id)
+                .join(t, t.c.variant_id == Variant.id).where(t.c.panel_id == panel_id)
+            )]
+
+
+class PanelIntervalCache(object):
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.indexes = {}
+
+        event.listen(RhoSession, "after_flush", self.after_flush)
+        event.listen(RhoSession, "after_commit", self.after_commit)
+        event.listen(RhoSession, "after_rollback", self.after_rollback)
+
+    def close(self):
+        event.remove(RhoSession, "after_flush", self.after_flush)
+        event.remove(RhoSession, "after_commit", self.after_commit)
+        event.remove(RhoSession, "after_rollback", self.after_rollback)
+
+    def get_index(self, session, panel_id, kind='regions'):
+        """ return IntervalIndex of the regions or variants (kind) of panel_id """
+
+        if kind not in ('regions', 'variants'):
+            raise ValueError(f'unknown interval index kind: {kind}')
+
+        # a session with uncommitted changes builds its own index
+        if session.info.get('panel_intervals_changed', None):
+            return self.build_index(session, panel_id, kind)
+
+        key = (panel_id, kind)
+        entry = self.indexes.get(key, None)
+        if entry is None or (self.ttl and time.monotonic() - entry[1] > self.ttl):
+            entry = (self.build_index(session, panel_id, kind), time.monotonic())
+            with self.lock:
+                self.indexes[key] = entry
+        return entry[0]
+
+    def build_index(self, session, panel_id, kind):
+        func = region_intervals if kind == 'regions' else variant_intervals
+        return IntervalIndex(func(session, panel_id))
+
+    def invalidate(self, panel_ids=None):
+        """ drop the indexes of panel_ids, or all indexes if panel_ids is None """
+        with self.lock:
+            if panel_ids is None:
+                self.indexes = {}
+            else:
+                self.indexes = {k: v for k, v in self.indexes.items()
+                                if k[0] not in panel_ids}
+
+    # session events
+
+    def after_flush(self, session, context):
+        from messy.ext.panelseq.models.schema import Region, Variant, Panel
+
+        changed = session.info.get('panel_intervals_changed', None) or set()
+        for obj in itertools.chain(session.new, session.dirty, session.deleted):
+            if isinstance(obj, (Region, Variant)):
+                # regions or variants may be shared by several panels
+                changed.add(None)
+            elif isinstance(obj, Panel):
+                state = inspect(obj)
+                if any(attr in state.attrs and state.attrs[attr].history.has_changes()
+                       for attr in ('regions', 'variants')):
+                    changed.add(obj.id)
+        if changed:
+            session.info['panel_intervals_changed'] = changed
+
+    def after_commit(self, session):
+        if (changed := session.info.pop('panel_intervals_changed', None)):
+            self.invalidate(None if None in changed else changed)
+
+    def after_rollback(self, session):
+        session.info.pop('panel_intervals_changed', None)
+
+
+_INTERVAL_CACHE_ = None
+
+
+def get_interval_cache():
+    global _INTERVAL_CACHE_
+    if _INTERVAL_CACHE_ is None:
+        _INTERVAL_CACHE_ = PanelIntervalCache()
+    return _INTERVAL_CACHE_
+
+
+def set_interval_cache(interval_cache):
+    global _INTERVAL_CACHE_
+    if _INTERVAL_CACHE_ is not None:
+        _INTERVAL_CACHE_.close()
+    _INTERVAL_CACHE_ = interval_cache
+
+# EOF
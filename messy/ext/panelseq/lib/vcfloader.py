@@ -0,0 +1,298 @@
+
+# streaming loader of multi-sample VCF files into SNAllele
+#
+# the VCF (plain or bgzipped) is read line by line by the main process, which groups the
+# records into chunks of a single chromosome. the chunks are parsed by a pool of worker
+# processes, each holding the (chrom, position) -> variant ids hash of the panel and the
+# sample id of each VCF sample column, and returning SNAllele rows for the records of
+# panel variants. the main process writes the rows with batched executemany upserts on
+# (sample_id, variant_id, alignmentmap_id), so that all database work stays in the
+# transaction of the caller.
+#
+# per-allele depths are taken from the AD field. samples without AD get their DP depth
+# assigned to the alleles of their GT call. alleles other than single A, C, G or T bases
+# (indels, *, <NON_REF>, etc) are counted as allele_undefined.
+#
+# several panel variants at the same position (eg. different alt alleles) all get the
+# depths of that position. several records at the same position (eg. a SNP and an indel
+# record) are merged by taking the maximum of each depth column, as an upsert batch must
+# not hold the same row twice. records of a position are kept in a single chunk, hence
+# the VCF has to be sorted by position, as required by bgzip/tabix anyway.
+
+from rhombus.lib.utils import cerr, get_dbhandler
+from messy.ext.panelseq.models.schema import Variant, panel_variant_table
+from messy.ext.panelseq.models.genotypes import SNAllele
+from messy.ext.ngsmgr.lib.qc import resolve_sample_codes
+
+from sqlalchemy import select, insert
+from sqlalchemy.dialects import postgresql, sqlite
+
+from concurrent.futures import ProcessPoolExecutor
+import collections
+import gzip
+import io
+import time
+
+
+depth_fields = ['allele_A', 'allele_C', 'allele_G', 'allele_T', 'allele_undefined']
+base_columns = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+
+
+def open_vcf(source):
+    """ return text stream of a VCF path or binary stream, decompressing (b)gzip """
+    instream = open(source, 'rb') if isinstance(source, (str, bytes)) or \
+        hasattr(source, '__fspath__') else source
+    instream = io.BufferedReader(instream) if not hasattr(instream, 'peek') else instream
+    if instream.peek(2)[:2] == b'\x1f\x8b':
+        # bgzip files are a series of gzip members, which GzipFile reads as one stream
+        instream = gzip.GzipFile(fileobj=instream)
+    return io.TextIOWrapper(instream, encoding='utf-8')
+
+
+def read_header(instream):
+    """ consume the meta lines and return the sample names of the #CHROM header """
+    for line in instream:
+        if line.startswith('##'):
+            continue
+        if line.startswith('#CHROM'):
+            return line.rstrip('\n').split('\t')[9:]
+        break
+    raise ValueError('VCF does not have a #CHROM header line')
+
+
+def iter_chunks(instream, chunksize=5000):
+    """ yield (chrom, [lines]) of about chunksize records of a single chromosome, without
+        splitting the records of a position
+    """
+    chrom, position, lines = None, None, []
+    for line in instream:
+        if not line.rstrip():
+            continue
+        record_chrom, record_position, _ = line.split('\t', 2)
+        if record_chrom != chrom or (len(lines) >= chunksize and record_position != position):
+            if lines:
+                yield chrom, lines
+            chrom, lines = record_chrom, []
+        position = record_position
+        lines.append(line)
+    if lines:
+        yield chrom, lines
+
+
+# worker state, set by init_worker() in each worker process
+
+_variants = None
+_sample_ids = None
+
+
+def init_worker(variants, sample_ids):
+    global _variants, _sample_ids
+    _variants = variants
+    _sample_ids = sample_ids
+
+
+def allele_columns(ref, alt):
+    """ return the depth column of each allele index of the record """
+    return [base_columns.get(allele, 4) for allele in [ref] + alt.split(',')]
+
+
+def parse_chunk(chunk):
+    """ return (number of records, number of panel variant records, [SNAllele row
+        tuples]) of a chunk, with each row as (sample_id, variant_id, A, C, G, T, undefined)
+    """
+
+    chrom, lines = chunk
+    variants, sample_ids = _variants, _sample_ids
+    matched = 0
+    rows = {}
+
+    for line in lines:
+        fields = line.rstrip('\n').split('\t')
+        if (variant_ids := variants.get((chrom, int(fields[1])), None)) is None:
+            continue
+        matched += 1
+        columns = allele_columns(fields[3].upper(), fields[4].upper())
+        keys = fields[8].split(':')
+        ad_idx = keys.index('AD') if 'AD' in keys else None
+        dp_idx = keys.index('DP') if 'DP' in keys else None
+        gt_idx = keys.index('GT') if 'GT' in keys else None
+
+        for sample_id, value in zip(sample_ids, fields[9:]):
+            if sample_id is None:
+                continue
+            values = value.split(':')
+            depths = [0, 0, 0, 0, 0]
+
+            if ad_idx is not None and ad_idx < len(values) and values[ad_idx] not in ('.', ''):
+                for column, depth in zip(columns, values[ad_idx].split(',')):
+                    if depth != '.':
+                        depths[column] += int(depth)
+
+            elif (dp_idx is not None and gt_idx is not None
+                    and max(dp_idx, gt_idx) < len(values) and values[dp_idx] not in ('.', '')):
+                called = {int(a) for a in values[gt_idx].replace('|', '/').split('/')
+                          if a != '.' and int(a) < len(columns)}
+                if called:
+                    depth, remainder = divmod(int(values[dp_idx]), len(called))
+                    for i, allele in enumerate(sorted(called)):
+                        depths[columns[allele]] += depth + (remainder if i == 0 else 0)
+
+            if not any(depths):
+                continue
+            for variant_id in variant_ids:
+                if (row := rows.get((sample_id, variant_id), None)) is None:
+                    rows[(sample_id, variant_id)] = depths
+                else:
+                    rows[(sample_id, variant_id)] = [max(a, b) for a, b in zip(row, depths)]
+
+    return len(lines), matched, [(*key, *depths) for key, depths in rows.items()]
+
+
+def variant_map(session, panel=None):
+    """ return {(chrom, position): [variant_id, ...]} of panel variants, or of all
+        variants
+    """
+    q = select(Variant.chrom, Variant.position, Variant.id)
+    if panel is not None:
+        t = panel_variant_table
+        q = q.join(t, t.c.variant_id == Variant.id).where(
+            t.c.panel_id == getattr(panel, 'id', panel))
+    variants = collections.defaultdict(list)
+    for chrom, position, variant_id in session.execute(q):
+        variants[(chrom, position)].append(variant_id)
+    return dict(variants)
+
+
+def upsert_statement(connection):
+    t = SNAllele.__table__
+    dialect = {'postgresql': postgresql, 'sqlite': sqlite}.get(connection.dialect.name, None)
+    if dialect is None:
+        return insert(t)
+    stmt = dialect.insert(t)
+    return stmt.on_conflict_do_update(
+        index_elements=[t.c.sample_id, t.c.variant_id, t.c.alignmentmap_id],
+        set_={f: stmt.excluded[f] for f in depth_fields}
+    )
+
+
+def write_rows(session, stmt, rows, alignmentmap_id):
+    if rows:
+        session.connection().execute(stmt, [
+            dict(zip(('sample_id', 'variant_id', *depth_fields), row),
+                 alignmentmap_id=alignmentmap_id)
+            for row in rows
+        ])
+
+
+def load_vcf(source, alignmentmap_id, panel=None, ngsrun=None, dbh=None, procs=None,
+             chunksize=5000, batch_size=10000):
+    """ load depths of the records of panel variants in VCF source (path or binary stream)
+        into SNAllele, return counter of records, variant records, alleles, and the list of
+        (sample name, message) of VCF samples that can not be resolved; sample names are
+        resolved as sample codes, using the plates of ngsrun to resolve shared codes
+    """
+
+    dbh = dbh or get_dbhandler()
+    session = dbh.session()
+    counts = collections.Counter()
+    start_time = time.perf_counter()
+
+    variants = variant_map(session, panel)
+    stmt = upsert_statement(session.connection())
+
+    with open_vcf(source) as instream:
+        names = read_header(instream)
+        resolved, failed = resolve_names(names, ngsrun, session)
+        sample_ids = [resolved.get(name, None) for name in names]
+
+        if procs is not None and procs > 1:
+            executor = ProcessPoolExecutor(procs, initializer=init_worker,
+                                           initargs=(variants, sample_ids))
+            results = bounded_map(executor, parse_chunk, iter_chunks(instream, chunksize),
+                                  procs * 2)
+        else:
+            executor = None
+            init_worker(variants, sample_ids)
+            results = map(parse_chunk, iter_chunks(instream, chunksize))
+
+        try:
+            batch = []
+            for records, matched, rows in results:
+                counts['records'] += records
+                counts['variant_records'] += matched
+                counts['alleles'] += len(rows)
+                batch += rows
+                if len(batch) >= batch_size:
+                    write_rows(session, stmt, batch, alignmentmap_id)
+                    batch = []
+            write_rows(session, stmt, batch, alignmentmap_id)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+    elapsed = time.perf_counter() - start_time
+    cerr(f'[Loaded {counts["alleles"]} allele rows from {counts["records"]} records '
+         f'in {elapsed:.1f}s, {counts["records"] / max(elapsed, 1e-6):.0f} records/s]')
+
+    return counts, failed
+
+
+def resolve_names(names, ngsrun, session):
+    """ return {name: sample_id} and [(name, message)] of VCF sample names """
+    if ngsrun is not None:
+        return resolve_sample_codes(set(names), ngsrun, session)
+
+    from messy.models.dbschema import Sample
+    candidates = collections.defaultdict(list)
+    for code, sample_id in session.execute(
+            select(Sample.code, Sample.id).where(Sample.code.in_(set(names)))):
+        candidates[code].append(sample_id)
+    resolved = {code: ids[0] for code, ids in candidates.items() if len(ids) == 1}
+    failed = [(name, 'sample does not exist' if name not in candidates else
+               'sample code matches several samples') for name in names if name not in resolved]
+    return resolved, failed
+
+
+def bounded_map(executor, func, iterable, size):
+    """ ordered executor.map() that keeps at most size tasks in flight """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= size:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def load_ngsrun_vcfs(ngsrun, panel, user, alignmentmap_id=None, sources=None, dbh=None,
+                     **kwargs):
+    """ load the VCF files of ngsrun, or sources as [(name, path or binary stream)],
+        creating an AlignmentMap for the loaded data if alignmentmap_id is not given;
+        return (alignmentmap_id, counter, failed)
+    """
+
+    dbh = dbh or get_dbhandler()
+    if not ngsrun.can_modify(user):
+        raise PermissionError(f'Current user can not modify NGS run {ngsrun.code}')
+
+    if alignmentmap_id is None:
+        alignmentmap = dbh.AlignmentMap()
+        dbh.session().add(alignmentmap)
+        dbh.session().flush([alignmentmap])
+        alignmentmap_id = alignmentmap.id
+
+    if sources is None:
+        sources = [(vcf_file.filename, vcf_file.fp()) for vcf_file in ngsrun.vcf_files]
+
+    counts = collections.Counter()
+    failed = []
+    for name, source in sources:
+        cerr(f'[Loading VCF file {name}]')
+        file_counts, file_failed = load_vcf(source, alignmentmap_id, panel=panel,
+                                            ngsrun=ngsrun, dbh=dbh, **kwargs)
+        counts.update(file_counts)
+        failed += [(f'{name}: {sample}', msg) for sample, msg in file_failed]
+
+    return alignmentmap_id, counts, failed
+
+# EOF
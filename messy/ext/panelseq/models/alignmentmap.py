@@ -1,17 +1,11 @@
 
-from sqlalchemy import (exists, Table, Column, types, ForeignKey, UniqueConstraint,
-                        Identity, select)
+from sqlalchemy import exists, Table, UniqueConstraint, Identity, select
 
 from rhombus.models.core import (Base, BaseMixIn, metadata, deferred, relationship,
                                  registered, declared_attr, column_property)
 
 
-class FastqPair(BaseMixIn, Base):
-
-    __tablename__ = 'fastqpairs'
-
-    sample_id = Column(types.Integer, ForeignKey('samples.id'), nullable=False)
-
+# FastqPair is provided by messy-ngsmgr extension
 
 
 class AlignmentMap(BaseMixIn, Base):
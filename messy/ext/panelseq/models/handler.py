@@ -1,7 +1,8 @@
 
 from rhombus.lib.utils import cerr
 
-from messy.ext.panelseq.models import schema
+from messy.ext.panelseq.models import schema, genotypes, alignmentmap
+from messy.ext.panelseq.lib.intervals import get_interval_cache
 
 
 def generate_handler_class(base_class):
@@ -31,6 +32,8 @@ def generate_handler_class(base_class):
 
         Variant = schema.Variant
         Region = schema.Region
+        SNAllele = genotypes.SNAllele
+        AlignmentMap = alignmentmap.AlignmentMap
 
         # set query constructor class
 
@@ -79,6 +82,63 @@ def generate_handler_class(base_class):
 
             return self.get_regions(None, [specs])
 
+        # overlap queries; regions are [begin, end) and variant positions are 1-based, see
+        # messy.ext.panelseq.lib.intervals
+
+        def get_regions_by_overlap(self, chrom, begin, end, panel=None, specs=None,
+                                   fetch=True, raise_if_empty=False):
+            """ return regions overlapping [begin, end) of chrom, optionally only the
+                regions of panel (Panel instance or panel id)
+            """
+
+            q = self.construct_select(self.Region, specs).where(
+                self.Region.chrom == chrom, self.Region.begin < end, self.Region.end > begin)
+            if panel is not None:
+                t = schema.panel_region_table
+                q = q.join(t, t.c.region_id == self.Region.id).where(
+                    t.c.panel_id == getattr(panel, 'id', panel))
+            if fetch:
+                q = q.order_by(self.Region.begin)
+
+            return self.fetch_select(q, fetch, raise_if_empty)
+
+        def get_variants_by_interval(self, chrom, begin, end, panel=None, specs=None,
+                                     fetch=True, raise_if_empty=False):
+            """ return variants inside [begin, end) of chrom, optionally only the variants
+                of panel (Panel instance or panel id)
+            """
+
+            q = self.construct_select(self.Variant, specs).where(
+                self.Variant.chrom == chrom, self.Variant.position > begin,
+                self.Variant.position <= end)
+            if panel is not None:
+                t = schema.panel_variant_table
+                q = q.join(t, t.c.variant_id == self.Variant.id).where(
+                    t.c.panel_id == getattr(panel, 'id', panel))
+            if fetch:
+                q = q.order_by(self.Variant.position)
+
+            return self.fetch_select(q, fetch, raise_if_empty)
+
+        def get_variants_by_region(self, region, panel=None, fetch=True, raise_if_empty=False):
+            return self.get_variants_by_interval(region.chrom, region.begin, region.end,
+                                                 panel=panel, fetch=fetch,
+                                                 raise_if_empty=raise_if_empty)
+
+        def get_snhandler(self):
+            """ return SNHandler for genotype matrices of samples x variants """
+            return genotypes.SNHandler(self)
+
+        def get_region_index(self, panel):
+            """ return cached IntervalIndex of region ids of panel (Panel instance or id) """
+            return get_interval_cache().get_index(self.session(), getattr(panel, 'id', panel),
+                                                  'regions')
+
+        def get_variant_index(self, panel):
+            """ return cached IntervalIndex of variant ids of panel (Panel instance or id) """
+            return get_interval_cache().get_index(self.session(), getattr(panel, 'id', panel),
+                                                  'variants')
+
         def get_variants(self, groups, specs=None, user=None, fetch=True, raise_if_empty=False):
 
             q = self.construct_select(self.Variant, specs)
@@ -2,11 +2,11 @@
 from enum import Enum
 
 from sqlalchemy import (exists, Table, Column, types, ForeignKey, UniqueConstraint,
-                        Identity, select)
+                        Identity, Index, select, tuple_)
 from sqlalchemy.orm.collections import attribute_mapped_collection
 
 from rhombus.lib.utils import get_dbhandler
-from rhombus.models.ek import EK
+from messy.lib.ekcache import ek_proxy
 from rhombus.models.auxtypes import GUID
 from rhombus.models.fileattach import FileAttachment
 from rhombus.models.core import (Base, BaseMixIn, metadata, deferred, relationship,
@@ -105,7 +105,7 @@ class Region(BaseMixIn, Base):
     end = Column(types.Integer, nullable=False, server_default='-1')
 
     species_id = Column(types.Integer, ForeignKey('eks.id'), nullable=False)
-    species = EK.proxy('species_id', '@SPECIES')
+    species = ek_proxy('species_id', '@SPECIES')
 
     panels = relationship(Panel,
                           secondary='panels_regions',
@@ -116,6 +116,8 @@ class Region(BaseMixIn, Base):
 
     __table_args__ = (
         UniqueConstraint('code', 'type'),
+        # overlap queries, see PanelSeqHandler.get_regions_by_overlap()
+        Index('ix_regions_chrom_begin_end', 'chrom', 'begin', 'end'),
     )
 
     def __repr__(self):
@@ -145,6 +147,34 @@ class Region(BaseMixIn, Base):
 
         return regions[0]
 
+    @classmethod
+    def get_or_create_many(cls, intervals, type, species_id, dbh=None):
+        """ return regions of [(chrom, begin, end)] in the same order, resolving existing
+            regions with a single query and creating the rest
+        """
+
+        dbh = dbh or get_dbhandler()
+        session = dbh.session()
+        keys = [(chrom, begin, end) for chrom, begin, end in intervals]
+
+        regions = {}
+        if keys:
+            for region in session.scalars(
+                    select(cls).where(tuple_(cls.chrom, cls.begin, cls.end).in_(set(keys)))):
+                regions.setdefault((region.chrom, region.begin, region.end), region)
+
+        new_regions = []
+        for key in keys:
+            if key not in regions:
+                regions[key] = region = cls(type=type, chrom=key[0], begin=key[1], end=key[2],
+                                            species_id=species_id)
+                new_regions.append(region)
+        if new_regions:
+            session.add_all(new_regions)
+            session.flush(new_regions)
+
+        return [regions[key] for key in keys]
+
 
 panel_region_table = Table(
     'panels_regions', metadata,
@@ -67,14 +67,14 @@ class PanelSeqViewer(PanelViewer):
                 bed_info = rq.POST.get('bed_info').strip()
                 if bed_info:
                     # parse to [(chrom, begin, end)]
+                    intervals = []
                     for line in bed_info.split('\n'):
-                        tokens = line.split()
-                        chrom, begin, end = tokens[0], int(tokens[1]), int(tokens[2])
-                        region = Region.get_or_create(
-                            type=PanelType.ASSAY.value,
-                            chrom=chrom, begin=begin, end=end,
-                            species_id=species_id
-                        )
+                        if not (tokens := line.split()):
+                            continue
+                        intervals.append((tokens[0], int(tokens[1]), int(tokens[2])))
+                    for region in Region.get_or_create_many(
+                            intervals, type=PanelType.ASSAY.value, species_id=species_id,
+                            dbh=dbh):
                         panel.regions[region.id] = region
 
                 return HTTPFound(location=rq.route_url(self.view_route, id=panel_id))
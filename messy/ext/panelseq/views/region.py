@@ -64,8 +64,8 @@ def generate_region_table(regions, request):
 
     table_body = t.tbody()
 
-    not_guest = not request.user.has_roles(r.GUEST)
-    can_manage = request.user.has_roles(* RegionViewer.modifying_roles)
+    not_guest = not request.acl.is_guest
+    can_manage = request.acl.has_roles(* RegionViewer.modifying_roles)
 
     for reg in regions:
         table_body.add(
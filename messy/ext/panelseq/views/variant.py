@@ -181,8 +181,8 @@ def generate_variant_table(variants, request):
 
     table_body = t.tbody()
 
-    not_guest = not request.user.has_roles(r.GUEST)
-    can_manage = request.user.has_roles(* VariantViewer.modifying_roles)
+    not_guest = not request.acl.is_guest
+    can_manage = request.acl.has_roles(* VariantViewer.modifying_roles)
 
     for vr in variants:
         table_body.add(
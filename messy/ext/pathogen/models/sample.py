@@ -6,7 +6,7 @@ from sqlalchemy import Column, types, ForeignKey
 from sqlalchemy.sql import False_
 
 from rhombus.lib.utils import cerr
-from rhombus.models.ek import EK
+from messy.lib.ekcache import ek_proxy
 
 
 def generate_sample_class(base_class):
@@ -20,23 +20,23 @@ def generate_sample_class(base_class):
     _bs.nationality_status = Column(types.Boolean, nullable=False, server_default=False_())
 
     _bs.storage_id = Column(types.Integer, ForeignKey('eks.id'), nullable=False)
-    _bs.storage = EK.proxy('storage_id', '@BLOOD-STORAGE', default='NA')
+    _bs.storage = ek_proxy('storage_id', '@BLOOD-STORAGE', default='NA')
     """ sample storage method """
 
     _bs.method_id = Column(types.Integer, ForeignKey('eks.id'), nullable=False)
-    _bs.method = EK.proxy('method_id', '@BLOOD-WITHDRAWAL', default='NA')
+    _bs.method = ek_proxy('method_id', '@BLOOD-WITHDRAWAL', default='NA')
     """ blood withdrawal method """
 
     _bs.pcr_method_id = Column(types.Integer, ForeignKey('eks.id'), nullable=False)
-    _bs.pcr_method = EK.proxy('pcr_method_id', '@PCR-METHOD', default='NA')
+    _bs.pcr_method = ek_proxy('pcr_method_id', '@PCR-METHOD', default='NA')
     """ PCR method for detection """
 
     _bs.pcr_id = Column(types.Integer, ForeignKey('eks.id'), nullable=False)
-    _bs.pcr = EK.proxy('pcr_id', '@SPECIES', default='no-species')
+    _bs.pcr = ek_proxy('pcr_id', '@SPECIES', default='no-species')
     """ species identification based on PCR """
 
     _bs.microscopy_id = Column(types.Integer, ForeignKey('eks.id'), nullable=False)
-    _bs.microscopy = EK.proxy('microscopy_id', '@SPECIES', default='no-species')
+    _bs.microscopy = ek_proxy('microscopy_id', '@SPECIES', default='no-species')
     """ species identification based on microscopy """
 
     _bs.parasitemia = Column(types.Float, nullable=False, server_default='-1')
@@ -0,0 +1,58 @@
+
+# per-request access control context
+#
+# ACLContext resolves the roles and groups of a user once, and is kept with the user
+# instance, ie. once per request (request.acl) or once per token for RPC calls. handler
+# methods and can_modify() implementations use it instead of resolving the roles and
+# rebuilding the group id list for each call or listed object.
+
+from messy.lib import roles as r
+
+
+class ACLContext(object):
+
+    def __init__(self, user):
+        self.user = user
+        self.user_id = user.id
+        self.group_ids = frozenset(g[1] for g in user.groups)
+        self.role_flags = {}
+
+        self.is_admin = user.is_admin()
+        self.is_guest = self.has_roles(r.GUEST)
+        self.sample_manager = self.has_roles(r.SYSADM, r.DATAADM, r.SAMPLE_MANAGE)
+        self.collection_manager = self.has_roles(r.SYSADM, r.DATAADM, r.COLLECTION_MANAGE)
+
+    def has_roles(self, *roles):
+        key = frozenset(roles)
+        if (flag := self.role_flags.get(key, None)) is None:
+            flag = self.role_flags[key] = bool(self.user.has_roles(*roles))
+        return flag
+
+    def in_group(self, group):
+        """ group is either a group id or a Group instance """
+        if group is None:
+            return False
+        return (group if isinstance(group, int) else group.id) in self.group_ids
+
+
+def get_acl_context(user):
+    """ return the ACLContext of user, creating it on first use """
+
+    if user is None:
+        return None
+    if isinstance(user, ACLContext):
+        return user
+    if (acl := getattr(user, '_acl_context', None)) is None:
+        acl = ACLContext(user)
+        try:
+            user._acl_context = acl
+        except AttributeError:
+            pass
+    return acl
+
+
+def request_acl(request):
+    """ request method providing request.acl """
+    return get_acl_context(request.user)
+
+# EOF
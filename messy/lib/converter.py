@@ -1,4 +1,6 @@
 
+import math
+import numpy as np
 import pandas as pd
 from collections import deque
 from rhombus.lib.utils import get_dbhandler
@@ -6,81 +8,143 @@ from rhombus.lib.utils import get_dbhandler
 # all CSV to dict converter
 
 
+# sample fields taken as is from GISAID metadata columns
+gisaid_fields = {
+    'acc_code': 'covv_subm_sample_id',
+    'sequence_name': 'covv_virus_name',
+    'species': 'covv_type',
+    'passage': 'covv_passage',
+    'collection_date': 'covv_collection_date',
+    'location': 'covv_location',
+    'add_location': 'covv_add_location',
+    'host': 'covv_host',
+    'host_info': 'covv_add_host_info',
+    'host_status': 'covv_patient_status',
+    'specimen_type': 'covv_specimen',
+    'outbreak': 'covv_outbreak',
+    'last_vaccinated_info': 'covv_last_vaccinated',
+    'treatment': 'covv_treatment',
+    'originating_institution': 'covv_orig_lab',
+    'sampling_institution': 'covv_orig_lab',
+}
+
+
 def import_gisaid_csv(filename):
     """ create a list of dictionary suitable for Sample.bulk_load() from GISAID metadata file"""
 
-    df = pd.read_table(filename, sep=',', keep_default_na=False)
-    for f in ['fn', 'covv_subm_sample_id', 'covv_add_host_info', 'covv_last_vaccinated', 'covv_outbreak']:
-        df[f] = df[f].fillna('').astype('str')
-
     a_list = []
+    for df in iter_gisaid_frames(filename):
+        a_list += frame_to_records(df)
+    return a_list
 
-    for _, r in df.iterrows():
-        d = dict(
-            collection=r.get('collection', ''),
-            code=r['covv_provider_sample_id'] or r['fn'],
-            acc_code=r['covv_subm_sample_id'],
-            sequence_name=r['covv_virus_name'],
-            species=r['covv_type'],
-            passage=r['covv_passage'],
-            collection_date=r['covv_collection_date'],
-            location=r['covv_location'],
-            add_location=r['covv_add_location'],
-            received_date='1970-01-01',    # add Unix epoch time to indicate NA
-
-            host=r['covv_host'],
-            host_info=r['covv_add_host_info'] or '',
-            host_gender=r['covv_gender'][0] if r['covv_gender'] else '',
-            host_age=r['covv_patient_age'],
-            host_status=r['covv_patient_status'],
-            host_occupation='other',
-
-            specimen_type=r['covv_specimen'],
-            outbreak=r['covv_outbreak'],
-            last_vaccinated_info=r['covv_last_vaccinated'],
-            treatment=r['covv_treatment'],
-
-            # originating_code = r['covv_provider_sample_id'] or r['fn'],
-            originating_institution=r['covv_orig_lab'],
-            sampling_institution=r['covv_orig_lab'],
-
-            ct_method='rtpcr',
-        )
-        d['category'] = 'r-ra' if not d['last_vaccinated_info'] else 'F-PO'
-        if type(d['host_age']) == str:
-            if 'month' in d['host_age'].lower():
-                d['host_age'] = int(d['host_age'].split()[0]) / 12
-            elif ('unknown' in d['host_age'].lower()) or (d['host_age'] == ''):
-                d['host_age'] = -1
-            else:
-                d['host_age'] = float(d['host_age'])
-        a_list.append(d)
 
-    return a_list
+def iter_gisaid_frames(filename, chunksize=10000):
+    """ yield DataFrames of at most chunksize samples with sample fields as columns from
+        GISAID metadata file, converting each chunk column by column
+    """
 
+    for df in pd.read_table(filename, sep=',', dtype=str, keep_default_na=False,
+                            chunksize=chunksize):
+        yield gisaid_frame_to_samples(df)
 
-def import_pipeline_tsv(filename):
 
-    df = pd.read_table(filename, sep='\t')
-    for f in ['SAMPLE']:
-        df[f] = df[f].fillna('').astype('str')
+def gisaid_frame_to_samples(df):
+
+    samples = pd.DataFrame(index=df.index)
+    samples['collection'] = df['collection'] if 'collection' in df.columns else ''
+    samples['code'] = df['covv_provider_sample_id'].where(
+        df['covv_provider_sample_id'] != '', df['fn'])
+    for field, column in gisaid_fields.items():
+        samples[field] = df[column]
+
+    samples['received_date'] = '1970-01-01'    # add Unix epoch time to indicate NA
+    samples['host_gender'] = df['covv_gender'].str[:1]
+    samples['host_age'] = convert_gisaid_age(df['covv_patient_age'])
+    samples['host_occupation'] = 'other'
+    samples['ct_method'] = 'rtpcr'
+    samples['category'] = np.where(samples['last_vaccinated_info'] == '', 'r-ra', 'F-PO')
+
+    return samples
+
+
+def frame_to_records(df):
+    """ return list of dicts of df rows, with the columns converted to python lists first;
+        much faster than df.to_dict(orient='records') for string columns
+    """
+    keys = list(df.columns)
+    return [dict(zip(keys, row)) for row in zip(*(df[k].tolist() for k in keys))]
+
+
+def convert_gisaid_age(ages):
+    """ convert age strings to years, with ages in months (eg. "6 months") divided by 12
+        and unknown or empty ages as -1; values that can not be parsed are kept as strings
+    """
+
+    text = ages.str.strip()
+    lower = text.str.lower()
+    months = lower.str.contains('month')
+    unknown = lower.str.contains('unknown') | (text == '')
+
+    values = pd.to_numeric(text.where(~months, text.str.split().str[0]), errors='coerce')
+    values = values.where(~months, values / 12)
+    values[unknown] = -1
+
+    result = values.astype(object)
+    invalid = values.isna()
+    result[invalid] = text[invalid]
+    return result
+
+
+# pipeline QC columns and their SampleQC fields
+pipeline_fields = {
+    'SAMPLE': 'sample',
+    'AVGDEPTH': 'avg_depth',
+    'LENGTH': 'length',
+    'N_BASE': 'base_N',
+    'POINTMUT': 'point_mutations',
+    'INFRAME': 'inframe_gaps',
+    'OOFRAME': 'outframe_gaps',
+    'RAW': 'raw_reads',
+    'OP_DEDUP': 'op_dedup_reads',
+    'ADAPTER': 'adapter_reads',
+    'PROP_PAIR': 'prop_pair_reads',
+    'PCR_DEDUP': 'pcr_dedup_reads',
+    'PRIMAL': 'primal_reads',
+}
+
+
+def import_pipeline_tsv(filename):
+    """ create a list of dictionary of SampleQC fields from pipeline QC file """
 
     a_list = []
+    for df in iter_pipeline_frames(filename):
+        a_list += frame_to_records(df)
+    return a_list
+
+
+def iter_pipeline_frames(filename, chunksize=10000):
+    """ yield DataFrames of at most chunksize rows with SampleQC fields as columns from
+        pipeline QC file; metrics that are not numbers become None
+    """
+
+    for df in pd.read_table(filename, sep='\t', dtype=str, keep_default_na=False,
+                            chunksize=chunksize):
+        yield pipeline_frame_to_qcs(df)
+
+
+def pipeline_frame_to_qcs(df):
+
+    if 'SAMPLE' not in df.columns:
+        raise ValueError('Pipeline QC file does not have SAMPLE column')
+
+    df = df[[c for c in pipeline_fields if c in df.columns]].rename(columns=pipeline_fields)
+    df['sample'] = df['sample'].str.strip()
+    for field in df.columns.drop('sample'):
+        values = pd.to_numeric(df[field], errors='coerce').tolist()
+        df[field] = pd.Series([None if math.isnan(v) else int(v) if v.is_integer() else v
+                               for v in map(float, values)], index=df.index, dtype=object)
 
-    for _, r in df.iterrows():
-        d = dict(
-            lab_code=r['SAMPLE'],
-            avg_depth=r['AVGDEPTH'],
-            length=r['LENGTH'],
-            base_N=r['N_BASE'],
-            point_mutations=r['POINTMUT'],
-            inframe_gaps=r['INFRAME'],
-            outframe_gaps=r['OOFRAME'],
-            read_stas = dict( raw = r['RAW'], op_dedup = r['OP_DEDUP'], adapter = r['ADAPTER'],
-                            prop_pair = r['PROP_PAIR'], pcr_dedup = r['PCR_DEDUP'],
-                            primal = r['PRIMAL'] ),
-
-        )
+    return df
 
 
 def import_fasta(filename, label='lab_code'):
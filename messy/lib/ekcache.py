@@ -0,0 +1,215 @@
+
+# process-wide cache of EK ids and keys
+#
+# EK proxies (Sample.species, Sample.category, etc) translate between EK ids and keys on
+# each attribute access. the cache holds all EK rows as {id: (key, group)} and
+# {(group, key): id}, loaded on first use, so that these translations do not need any
+# database round-trip.
+#
+# a flush that creates, modifies or deletes EK rows marks its session, and the cache is
+# cleared after the session commits. until then, lookups from that session bypass the
+# cache to see its own uncommitted changes. other processes only notice EK changes after
+# the cache age exceeds the ttl (messy.ekcache.ttl setting).
+
+from rhombus.lib.utils import cerr, get_dbhandler
+from rhombus.models.meta import RhoSession
+from rhombus.models.ek import EK
+from sqlalchemy import event, select
+from sqlalchemy.orm import object_session
+
+import collections
+import threading
+import time
+
+
+class EKCache(object):
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.keys = None
+        self.ids = None
+        self.load_time = 0
+
+        # process-wide counters, and counters of the current request in each thread
+        self.stats = collections.Counter()
+        self.local = threading.local()
+
+        event.listen(RhoSession, "after_flush", self.after_flush)
+        event.listen(RhoSession, "after_commit", self.after_commit)
+        event.listen(RhoSession, "after_rollback", self.after_rollback)
+
+    def close(self):
+        event.remove(RhoSession, "after_flush", self.after_flush)
+        event.remove(RhoSession, "after_commit", self.after_commit)
+        event.remove(RhoSession, "after_rollback", self.after_rollback)
+
+    def load(self, session):
+
+        t = EK.__table__
+        rows = session.execute(select(t.c.id, t.c.key, t.c.member_of_id)).all()
+        group_keys = {ek_id: key for ek_id, key, _ in rows}
+
+        keys = {}
+        ids = {}
+        for ek_id, key, member_of_id in rows:
+            group = group_keys.get(member_of_id, None)
+            keys[ek_id] = (key, group)
+            ids[(group, key)] = ek_id
+
+        with self.lock:
+            self.keys, self.ids = keys, ids
+            self.load_time = time.monotonic()
+        self.count('loads')
+        return keys, ids
+
+    def invalidate(self):
+        with self.lock:
+            self.keys = self.ids = None
+        self.count('invalidations')
+
+    def prepare(self, session):
+        """ return (keys, ids) snapshot to serve lookups for session, loading the cache if
+            needed, or None if the session has to bypass the cache
+        """
+
+        if session is None:
+            session = get_dbhandler().session()
+        if session.info.get('ek_changed', False):
+            self.count('bypasses')
+            return None
+
+        # lookups use this snapshot, as invalidate() may reset the cache concurrently
+        with self.lock:
+            keys, ids, load_time = self.keys, self.ids, self.load_time
+        if keys is None or (self.ttl and time.monotonic() - load_time > self.ttl):
+            return self.load(session)
+        return keys, ids
+
+    def get_key(self, ek_id, session=None):
+        """ return key of EK id, or None if not known by the cache """
+        if (snapshot := self.prepare(session)) is None:
+            return None
+        if (value := snapshot[0].get(ek_id, None)) is None:
+            self.count('misses')
+            return None
+        self.count('hits')
+        return value[0]
+
+    def get_id(self, key, group=None, session=None):
+        """ return id of EK key within group, or None if not known by the cache """
+        if (snapshot := self.prepare(session)) is None:
+            return None
+        if (ek_id := snapshot[1].get((group, key), None)) is None:
+            self.count('misses')
+            return None
+        self.count('hits')
+        return ek_id
+
+    def count(self, name):
+        self.stats[name] += 1
+        if (request_stats := getattr(self.local, 'stats', None)) is not None:
+            request_stats[name] += 1
+
+    def start_request(self):
+        self.local.stats = collections.Counter()
+
+    def end_request(self):
+        """ return the counters of the current request, each hit is a saved round-trip """
+        request_stats = getattr(self.local, 'stats', None)
+        self.local.stats = None
+        return request_stats or collections.Counter()
+
+    # session events
+
+    def after_flush(self, session, context):
+        for objs in (session.new, session.dirty, session.deleted):
+            if any(isinstance(o, EK) for o in objs):
+                session.info['ek_changed'] = True
+                return
+
+    def after_commit(self, session):
+        if session.info.pop('ek_changed', False):
+            self.invalidate()
+
+    def after_rollback(self, session):
+        session.info.pop('ek_changed', None)
+
+
+class CachedEKProxy(object):
+    """ EK proxy that translates ids and keys with the EK cache, falling back to the
+        original EK.proxy() for values not known by the cache
+    """
+
+    def __init__(self, attrname, grpname, default=None):
+        self.proxy = EK.proxy(attrname, grpname, default=default)
+        self.attrname = attrname
+        self.grpname = grpname
+        self.default = default
+
+    def __getattr__(self, name):
+        # metainfo of the original proxy
+        if name == 'proxy':
+            raise AttributeError(name)
+        return getattr(self.proxy, name)
+
+    def __get__(self, inst, owner=None):
+        if inst is None:
+            return self
+        if (ek_id := getattr(inst, self.attrname)) is not None:
+            if (key := get_ek_cache().get_key(ek_id, object_session(inst))) is not None:
+                return key
+        return self.proxy.__get__(inst, owner)
+
+    def __set__(self, inst, value):
+        if value is None:
+            value = self.default
+        if value is not None:
+            if (ek_id := get_ek_cache().get_id(value, self.grpname,
+                                               object_session(inst))) is not None:
+                setattr(inst, self.attrname, ek_id)
+                return
+        self.proxy.__set__(inst, value)
+
+
+def ek_proxy(attrname, grpname, default=None):
+    """ cached replacement of EK.proxy() """
+    return CachedEKProxy(attrname, grpname, default)
+
+
+_EK_CACHE_ = None
+
+
+def get_ek_cache():
+    global _EK_CACHE_
+    if _EK_CACHE_ is None:
+        _EK_CACHE_ = EKCache()
+    return _EK_CACHE_
+
+
+def set_ek_cache(ek_cache):
+    global _EK_CACHE_
+    if _EK_CACHE_ is not None:
+        _EK_CACHE_.close()
+    _EK_CACHE_ = ek_cache
+
+
+def create_ek_cache(settings):
+    """ create EKCache based on configuration settings """
+    from messy import configkeys as ck
+    return EKCache(ttl=int(settings.get(ck.msy_ekcache_ttl, 300)))
+
+
+def start_request_stats(event):
+    """ NewRequest subscriber, resetting the EK cache counters of the request """
+    get_ek_cache().start_request()
+
+
+def log_request_stats(event):
+    """ NewResponse subscriber, logging the EK cache counters of the request """
+    stats = get_ek_cache().end_request()
+    if stats:
+        cerr(f'[EK cache: {event.request.path} - {stats["hits"]} round-trip(s) saved, '
+             f'{stats["misses"]} miss(es), {stats["loads"]} load(s)]')
+
+# EOF
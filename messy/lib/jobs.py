@@ -0,0 +1,311 @@
+
+# this module provides background jobs for long-running operations
+#
+# views submit a Job row and return immediately; worker processes, started separately
+# from the WSGI app with messy-run worker, claim pending jobs and run the function
+# registered for the job type inside their own transaction. currently only upload commits
+# (messy.jobs.enabled setting) are run as jobs.
+#
+# claiming is an UPDATE conditional on the status and lease seen by the preceding SELECT,
+# hence only a single worker can win a job, also on SQLite which has no row locking.
+# on PostgreSQL, SELECT ... FOR UPDATE SKIP LOCKED lets concurrent workers pick different
+# jobs. a running job holds a lease renewed by a heartbeat thread, and a job whose lease
+# has expired (eg. its worker was killed) is claimed again by another worker.
+#
+# once the heartbeat finds that the job is not held by its worker anymore, the job is
+# marked as aborted: the next progress() or log() call of the job function, or at the
+# latest the next commit, raises JobAborted so that the uncommitted changes are rolled
+# back, and the outcome is only recorded by the worker still holding the job. the check
+# runs before every commit of the job, including the commits of job functions that
+# commit in steps (eg. upload commits, one transaction per chunk); steps committed before
+# the lease was lost are kept, and upload jobs record them so that a retry only runs the
+# remaining chunks.
+#
+# on SQLite, the heartbeat UPDATE waits behind the write transaction of the job. this
+# does not abort the job, since the claiming UPDATE of other workers waits behind the same
+# write lock and hence can not take over the lease in the meantime.
+
+from rhombus.lib.utils import cerr, get_dbhandler
+from rhombus.models.core import set_func_userid
+from sqlalchemy import select, update, or_, and_
+
+import datetime
+import os
+import socket
+import threading
+import time
+import traceback
+import transaction
+
+
+# seconds a claimed job is held by a worker without renewal
+LEASE_TIME = 60
+
+# registered job functions, func(ctx, dbh) with ctx as JobContext
+job_functions = {}
+
+_jobs_enabled_ = False
+
+
+def set_jobs_enabled(flag):
+    """ when enabled, views submit long-running operations as jobs instead of running them
+        within the request
+    """
+    global _jobs_enabled_
+    _jobs_enabled_ = flag
+
+
+def is_jobs_enabled():
+    return _jobs_enabled_
+
+
+def register_job(job_type):
+    """ decorator to register a function to execute jobs of job_type """
+    def decorator(func):
+        job_functions[job_type] = func
+        return func
+    return decorator
+
+
+class JobAborted(RuntimeError):
+    pass
+
+
+def submit_job(job_type, params, user, dbh=None):
+    """ create a pending job, to be run by a worker once the current transaction commits """
+
+    if job_type not in job_functions:
+        raise ValueError(f'job type {job_type} is not registered')
+
+    dbh = dbh or get_dbhandler()
+    job = dbh.Job(job_type=job_type, params=params, user_id=user.id)
+    dbh.session().add(job)
+    dbh.session().flush([job])
+    return job
+
+
+class JobContext(object):
+    """ passed to job functions to report progress and write logs; the updates are written
+        through a separate connection, so that they are visible while the job transaction
+        is still open
+    """
+
+    def __init__(self, job_id, user_id, params, worker, engine, lease_time=LEASE_TIME):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.params = params
+        self.worker = worker
+        self.engine = engine
+        self.lease_time = lease_time
+        self.lock = threading.Lock()
+        self.aborted = threading.Event()
+        self.abort_reason = None
+
+    def update(self, **values):
+        """ update the job row as long as this worker holds it, renewing the lease """
+        table = get_dbhandler().Job.__table__
+        values['lease_until'] = datetime.datetime.now() + datetime.timedelta(
+            seconds=self.lease_time)
+        with self.lock, self.engine.begin() as conn:
+            count = conn.execute(
+                update(table).where(table.c.id == self.job_id, table.c.worker == self.worker,
+                                    table.c.status == 'running')
+                .values(**values)
+            ).rowcount
+        if count == 0:
+            raise JobAborted(f'job {self.job_id} is no longer held by worker {self.worker}')
+
+    def abort(self, reason):
+        """ mark the job to be stopped by the next check() """
+        self.abort_reason = reason
+        self.aborted.set()
+
+    def check(self):
+        """ raise JobAborted if the job has been marked to be stopped """
+        if self.aborted.is_set():
+            raise JobAborted(f'job {self.job_id} was aborted: {self.abort_reason}')
+
+    def progress(self, value, message=None):
+        """ set percentage of completion, value between 0 and 100 """
+        self.check()
+        values = {'progress': max(0, min(100, int(value)))}
+        if message is not None:
+            values['message'] = message[:256]
+        self.update(**values)
+
+    def log(self, line):
+        self.check()
+        table = get_dbhandler().Job.__table__
+        self.update(log=table.c.log + line.rstrip('\n') + '\n')
+
+    def renew(self):
+        self.update()
+
+
+class LeaseCheck(object):
+    """ transaction synchronizer adding JobContext.check() as before-commit hook to every
+        transaction begun while the job runs
+    """
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+
+    def newTransaction(self, txn):
+        txn.addBeforeCommitHook(self.ctx.check)
+
+    def beforeCompletion(self, txn):
+        pass
+
+    def afterCompletion(self, txn):
+        pass
+
+
+def claim_job(dbh, worker, lease_time=LEASE_TIME):
+    """ claim the oldest pending job or a job with expired lease, return (id, user_id,
+        job_type, params) or None
+    """
+
+    table = dbh.Job.__table__
+    engine = dbh.session().get_bind()
+    now = datetime.datetime.now()
+
+    with engine.begin() as conn:
+        q = select(table.c.id, table.c.user_id, table.c.job_type, table.c.params,
+                   table.c.status, table.c.lease_until).where(
+            or_(table.c.status == 'pending',
+                and_(table.c.status == 'running', table.c.lease_until < now))
+        ).order_by(table.c.id).limit(1)
+        if engine.dialect.name == 'postgresql':
+            q = q.with_for_update(skip_locked=True)
+        row = conn.execute(q).first()
+        if row is None:
+            return None
+
+        lease_cond = (table.c.lease_until.is_(None) if row.lease_until is None
+                      else table.c.lease_until == row.lease_until)
+        count = conn.execute(
+            update(table).where(table.c.id == row.id, table.c.status == row.status, lease_cond)
+            .values(status='running', worker=worker, start_time=now, progress=0, message='',
+                    lease_until=now + datetime.timedelta(seconds=lease_time))
+        ).rowcount
+        if count == 0:
+            # claimed by another worker in the meantime
+            return None
+
+    if row.status == 'running':
+        cerr(f'[Reclaiming job {row.id} with expired lease]')
+    return row.id, row.user_id, row.job_type, row.params
+
+
+def run_job(dbh, worker, job_id, user_id, job_type, params, lease_time=LEASE_TIME):
+    """ execute a claimed job and record its outcome """
+
+    ctx = JobContext(job_id, user_id, params, worker, dbh.session().get_bind(), lease_time)
+    stopped = threading.Event()
+    wait_for_lock = ctx.engine.dialect.name == 'sqlite'
+
+    def heartbeat():
+        renewed = time.monotonic()
+        while not stopped.wait(lease_time / 3):
+            try:
+                ctx.renew()
+                renewed = time.monotonic()
+            except JobAborted as err:
+                ctx.abort(str(err))
+                return
+            except Exception as err:
+                cerr(f'[WARN: failed to renew lease of job {job_id}: {err}]')
+                if not wait_for_lock and time.monotonic() - renewed > lease_time:
+                    ctx.abort('lease has expired')
+                    return
+
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+
+    set_func_userid(lambda: user_id)
+    lease_check = LeaseCheck(ctx)
+    transaction.manager.registerSynch(lease_check)
+    try:
+        func = job_functions[job_type]
+        with transaction.manager:
+            result = func(ctx, dbh)
+        status, message = 'completed', 'Completed'
+    except Exception as err:
+        if not ctx.aborted.is_set():
+            ctx.log(traceback.format_exc())
+        result, status, message = None, 'failed', str(err)
+    finally:
+        transaction.manager.unregisterSynch(lease_check)
+        stopped.set()
+        heartbeat_thread.join()
+
+    # only recorded if this worker still holds the job, otherwise raises JobAborted
+    values = dict(status=status, result=result, finish_time=datetime.datetime.now(),
+                  message=message[:256])
+    if status == 'completed':
+        values['progress'] = 100
+    ctx.update(**values)
+    cerr(f'[Job {job_id} ({job_type}) {status}]')
+    return status
+
+
+def run_worker(settings, worker, poll_interval=2.0, lease_time=LEASE_TIME):
+    """ loop claiming and running jobs, executed in each worker process """
+
+    from messy.lib.whoosh import set_index_service, create_index_service
+
+    dbh = get_dbhandler(settings)
+    set_index_service(create_index_service(settings))
+    cerr(f'[Job worker {worker} is running]')
+
+    while True:
+        claimed = claim_job(dbh, worker, lease_time)
+        if claimed is None:
+            time.sleep(poll_interval)
+            continue
+        try:
+            run_job(dbh, worker, *claimed, lease_time=lease_time)
+        except Exception as err:
+            # eg. the lease was lost while recording the outcome
+            cerr(f'[WARN: job {claimed[0]} was not completed by worker {worker}: {err}]')
+
+
+def worker_name(idx=0):
+    return f'{socket.gethostname()}:{os.getpid()}:{idx}'
+
+
+# job functions
+
+@register_job('upload_commit')
+def upload_commit(ctx, dbh):
+    """ commit a pending upload job, params: randkey, method """
+
+    from messy.lib import uploads
+
+    user = dbh.get_user(ctx.user_id).user_instance()
+    uploadjob = uploads.load_job(ctx.user_id, ctx.params['randkey'])
+    if not uploadjob.check_user(ctx.user_id):
+        raise RuntimeError('Upload job is not owned by the job user!')
+
+    def progress(completed, chunks):
+        ctx.progress(100 * completed / chunks, f'Committed chunk(s): {completed} of {chunks}')
+
+    method = ctx.params['method']
+    if isinstance(uploadjob, uploads.SampleUploadJob):
+        added, not_added, updated, failed = uploadjob.commit(
+            method, user, tm=transaction.manager, progress=progress)
+        for code, msg in sorted(failed):
+            ctx.log(f'failed: {code}\t{msg}')
+        result = {'added': len(added), 'not_added': len(not_added), 'updated': len(updated),
+                  'failed': len(failed)}
+    else:
+        added, updated, failed = uploadjob.commit(method, tm=transaction.manager,
+                                                  progress=progress)
+        result = {'added': added, 'updated': updated, 'failed': failed}
+
+    result['failed_chunks'] = len(uploadjob.failed_chunks())
+    if uploadjob.status == 'completed':
+        uploadjob.remove()
+    return result
+
+# EOF
@@ -3,7 +3,7 @@ from rhombus.scripts import setup_settings, arg_parser
 from rhombus.lib.utils import cerr, cout, cexit, get_dbhandler
 from rhombus.lib.mgr import yaml_write, yaml_read
 from rhombus.models.core import set_func_userid
-from messy.lib.whoosh import set_index_service, IndexService
+from messy.lib.whoosh import set_index_service, get_index_service, create_index_service
 
 import transaction
 import yaml
@@ -59,10 +59,44 @@ def init_argparser(parser=None):
     p.add_argument('--change_sample_codes', action='store_true',
                    help='change sample code from old_code to new_code in csv/tsv file')
 
+    p.add_argument('--import_pipeline_qc', action='store_true',
+                   help='import pipeline QC TSV file (--infile) of an NGS run (--ngsrun)')
+
+    p.add_argument('--import_vcf', action='store_true',
+                   help='import allele depths of panel variants (--panel) from the VCF files of '
+                        'an NGS run (--ngsrun), or from --infile')
+
+    p.add_argument('--reconcile_stats', action='store_true',
+                   help='verify statistic counters against actual counts, and fix them '
+                        'with --commit')
+
+    p.add_argument('--propagate_flags', action='store_true',
+                   help='verify refctrl/public/archived flags of samples against their '
+                        'collections, and repair them with --commit')
+
     # options
     p.add_argument('--with_samples', default=False, action='store_true',
                    help='export samples as well when exporting collections')
 
+    p.add_argument('--full', default=False, action='store_true',
+                   help='rebuild the whole Whoosh index instead of incremental update')
+
+    p.add_argument('--procs', type=int, default=None,
+                   help='number of worker processes for full Whoosh reindexing or VCF import')
+
+    p.add_argument('--batch_size', type=int, default=500,
+                   help='number of collections checked in each batch by --propagate_flags')
+
+    p.add_argument('--ngsrun', default='',
+                   help='code of NGS run')
+
+    p.add_argument('--panel', default='',
+                   help='code of panel')
+
+    p.add_argument('--alignmentmap_id', type=int, default=None,
+                   help='alignment map id of imported allele depths, a new alignment map is '
+                        'created if not provided')
+
     p.add_argument('--srcdir')
     p.add_argument('--dstdir')
 
@@ -78,7 +112,7 @@ def init_argparser(parser=None):
 def main(args):
 
     settings = setup_settings(args)
-    set_index_service(IndexService(settings['messy.whoosh.path']))
+    set_index_service(create_index_service(settings))
 
     if args.commit:
         with transaction.manager:
@@ -88,6 +122,9 @@ def main(args):
     else:
         do_mgr(args, settings)
 
+    # wait until the background index writer, if used, has caught up
+    get_index_service().flush()
+
 
 def do_mgr(args, settings, dbh=None):
 
@@ -132,6 +169,18 @@ def do_mgr(args, settings, dbh=None):
     elif args.change_sample_codes:
         do_change_sample_codes(args, dbh)
 
+    elif args.import_pipeline_qc:
+        do_import_pipeline_qc(args, dbh)
+
+    elif args.import_vcf:
+        do_import_vcf(args, dbh)
+
+    elif args.reconcile_stats:
+        do_reconcile_stats(args, dbh)
+
+    elif args.propagate_flags:
+        do_propagate_flags(args, dbh)
+
     else:
         cerr('Please provide correct operation')
 
@@ -172,7 +221,8 @@ def do_import_runs(args, dbh):
 def do_export_collections(args, dbh):
     sess = dbh.session()
     yaml_write(args, [collection.as_dict(export_samples=args.with_samples)
-                      for collection in dbh.Collection.query(sess)],
+                      for collection in dbh.apply_load(dbh.Collection.query(sess),
+                                                       dbh.Collection, 'export')],
                'Collection')
 
 
@@ -192,7 +242,7 @@ def do_import_collections(args, dbh):
 def do_export_plates(args, dbh):
     sess = dbh.session()
     yaml_write(args, [plate.as_dict()
-                      for plate in dbh.Plate.query(sess)],
+                      for plate in dbh.apply_load(dbh.Plate.query(sess), dbh.Plate, 'export')],
                'Plate')
 
 
@@ -260,7 +310,7 @@ def do_restore(args, dbh):
 
 def do_whoosh_reindex(args, dbh):
     from messy.lib import whoosh
-    whoosh.reindex()
+    whoosh.reindex(full=args.full, procs=args.procs)
 
 
 def do_change_sample_codes(args, dbh):
@@ -280,6 +330,72 @@ def do_change_sample_codes(args, dbh):
         samples[0].code = r['new_code']
 
 
+def do_import_pipeline_qc(args, dbh):
+
+    from messy.ext.ngsmgr.lib.qc import load_pipeline_qc
+
+    if not args.login:
+        cexit('ERR: please provide --login for the user performing the import')
+    user = dbh.get_user(args.login).user_instance()
+    set_func_userid(lambda: user.id)
+
+    ngsrun = dbh.get_ngsruns_by_codes(args.ngsrun, groups=None, raise_if_empty=True)[0]
+    inserted, updated, failed = load_pipeline_qc(args.infile, ngsrun, user, dbh)
+    for code, msg in failed:
+        cerr(f'[W - sample {code}: {msg}]')
+    cerr(f'[I - pipeline QC of {ngsrun.code}: {inserted} inserted, {updated} updated, '
+         f'{len(failed)} failed]')
+
+
+def do_import_vcf(args, dbh):
+
+    from messy.ext.panelseq.lib import vcfloader
+
+    if not args.login:
+        cexit('ERR: please provide --login for the user performing the import')
+    user = dbh.get_user(args.login).user_instance()
+    set_func_userid(lambda: user.id)
+
+    ngsrun = dbh.get_ngsruns_by_codes(args.ngsrun, groups=None, raise_if_empty=True)[0]
+    panel = dbh.get_panels_by_codes(args.panel, raise_if_empty=True)[0]
+
+    alignmentmap_id, counts, failed = vcfloader.load_ngsrun_vcfs(
+        ngsrun, panel, user, alignmentmap_id=args.alignmentmap_id,
+        sources=[(args.infile, args.infile)] if args.infile else None, dbh=dbh,
+        procs=args.procs)
+
+    for name, msg in failed:
+        cerr(f'[W - VCF sample {name}: {msg}]')
+    cerr(f'[I - VCF of {ngsrun.code}: {counts["records"]} records, '
+         f'{counts["variant_records"]} panel variant records, {counts["alleles"]} allele rows '
+         f'with alignment map id {alignmentmap_id}]')
+
+
+def do_reconcile_stats(args, dbh):
+
+    from messy.lib import stats
+
+    drifts = stats.reconcile(dbh.session(), fix=args.commit)
+    for name, key, stored, actual in drifts:
+        cerr(f'[W - counter {name}[{key}]: stored {stored}, actual {actual}]')
+    cerr(f'[I - statistic counters with drift: {len(drifts)}'
+         f'{" (fixed)" if args.commit and drifts else ""}]')
+
+
+def do_propagate_flags(args, dbh):
+
+    from messy.lib import propagation
+
+    collections = samples = 0
+    for collection, count in propagation.repair_drifts(dbh.session(), args.batch_size,
+                                                       fix=args.commit):
+        cerr(f'[W - collection {collection.code}: {count} sample(s) with drifted flags]')
+        collections += 1
+        samples += count
+    cerr(f'[I - collections with drift: {collections}, samples: {samples}'
+         f'{" (fixed)" if args.commit and samples else ""}]')
+
+
 def yaml_write(args, data, msg, printout=False):
     if printout:
         # this is for debugging purpose, obviously
@@ -0,0 +1,128 @@
+
+# propagation of collection flags to samples
+#
+# refctrl, public and archived of a collection are copied to all of its samples, so that
+# the ACL filtering of samples does not need to join the collections table. the copy is
+# done with a single set-based UPDATE per collection instead of modifying each Sample
+# through the ORM. since this bypasses the unit of work, the statistic counters and the
+# search documents (which hold public and refctrl as ACL filters) of the affected samples
+# are updated here as well.
+#
+# the group of a collection is not copied, but sample search documents hold it as their
+# group_id ACL filter, hence all samples are reindexed when the group changes.
+#
+# samples that drift from their collection (eg. moved to another collection or inserted
+# without the flags) are repaired by messy-run mgr --propagate_flags.
+
+from rhombus.lib.utils import cerr
+from messy.models.dbschema import Collection, Sample
+from messy.lib import stats
+from messy.lib.whoosh import reindex_objects
+
+from sqlalchemy import select, update, func, or_
+from sqlalchemy.orm import object_session
+
+import collections
+
+
+propagated_flags = ['refctrl', 'public', 'archived']
+
+
+def collection_flags(collection):
+    return {flag: bool(getattr(collection, flag)) for flag in propagated_flags}
+
+
+def drift_condition(flags):
+    """ condition of samples whose flags differ from flags """
+    return or_(*[getattr(Sample, flag) != value for flag, value in flags.items()])
+
+
+def propagate_flags(session, collection_id, flags):
+    """ set flags {flag: value} to all samples of collection_id that differ, and queue the
+        updated samples for reindexing; return the number of updated samples
+    """
+
+    condition = drift_condition(flags)
+
+    # ids of the samples being updated, and counter deltas based on their current flags
+    sample_ids = []
+    deltas = collections.Counter()
+    values = {'collection_id': collection_id, 'species_id': None}
+    new_counters = stats.sample_counters(values | {'refctrl': flags['refctrl'],
+                                                   'public': flags['public']})
+    for sample_id, refctrl, public in session.execute(
+            select(Sample.id, Sample.refctrl, Sample.public).where(
+                Sample.collection_id == collection_id, condition)):
+        sample_ids.append(sample_id)
+        for counter in stats.sample_counters(values | {'refctrl': refctrl, 'public': public}):
+            deltas[counter] -= 1
+        for counter in new_counters:
+            deltas[counter] += 1
+
+    if not sample_ids:
+        return 0
+
+    session.execute(
+        update(Sample).where(Sample.collection_id == collection_id, condition)
+        .values(**flags)
+    )
+    stats.add_deltas(session.connection(), deltas)
+
+    # the search documents hold public and refctrl as ACL filters
+    reindex_objects(session, Sample, sample_ids)
+
+    return len(sample_ids)
+
+
+def propagate_collection(collection):
+    """ propagate the flags of collection to its samples """
+    return propagate_flags(object_session(collection), collection.id,
+                           collection_flags(collection))
+
+
+def reindex_samples(collection):
+    """ queue all samples of collection for reindexing, eg. after its group has changed """
+    session = object_session(collection)
+    reindex_objects(session, Sample, session.scalars(
+        select(Sample.id).where(Sample.collection_id == collection.id)).all())
+
+
+def find_drifts(session, collection_ids):
+    """ return {collection_id: number of samples with flags differing from collection} """
+    return dict(session.execute(
+        select(Sample.collection_id, func.count())
+        .join(Collection, Sample.collection_id == Collection.id)
+        .where(Sample.collection_id.in_(collection_ids),
+               or_(*[getattr(Sample, flag) != getattr(Collection, flag)
+                     for flag in propagated_flags]))
+        .group_by(Sample.collection_id)
+    ).all())
+
+
+def repair_drifts(session, batch_size=500, fix=True):
+    """ check all collections in batches of batch_size, propagating the flags of those
+        with drifted samples if fix is True; yield (collection, drifted sample count)
+    """
+
+    last_id = 0
+    while True:
+        batch = session.scalars(
+            select(Collection).where(Collection.id > last_id)
+            .order_by(Collection.id).limit(batch_size)
+        ).all()
+        if not batch:
+            break
+        last_id = batch[-1].id
+
+        drifts = find_drifts(session, [c.id for c in batch])
+        for collection in batch:
+            if (count := drifts.get(collection.id, 0)) == 0:
+                continue
+            if fix:
+                propagate_flags(session, collection.id, collection_flags(collection))
+            yield collection, count
+
+        if fix and drifts:
+            cerr(f'[Propagated flags of {len(drifts)} collection(s) up to id {last_id}]')
+
+# EOF
@@ -3,6 +3,7 @@ from pyramid_rpc.jsonrpc import JsonRpcError
 
 from rhombus.lib.utils import get_dbhandler
 from rhombus.lib import rpc
+from messy.lib import stats
 
 
 # public method
@@ -21,11 +22,12 @@ def data_status(request, token):
     user, errmsg = rpc.get_userinstance_by_token(request, token)
 
     dbh = get_dbhandler()
-    dbsess = dbh.session()
+    counts = stats.get_counters(dbh.session(), 'collections', 'collections.refctrl',
+                                'samples', 'samples.refctrl')
 
     d = {
-        'total_collections': dbh.Collection.query(dbsess).count(),
-        'total_samples': dbh.Collection.query(dbsess).count(),
+        'total_collections': counts['collections'] + counts['collections.refctrl'],
+        'total_samples': counts['samples'] + counts['samples.refctrl'],
     }
 
     return d
@@ -0,0 +1,153 @@
+
+# this module provides SQLite FTS5 search backend, as an alternative to Whoosh
+#
+# all registered classes are kept in a single SQLite file, one FTS5 table per class,
+# using the trigram tokenizer (requires SQLite >= 3.34) and dbid as the rowid.
+# fuzzy matching is approximated by splitting each query term into its trigrams and
+# ranking documents by bm25 over any matching trigram.
+# filter fields (eg. group_id, public) are stored as UNINDEXED columns and restricted
+# in the WHERE clause of the MATCH query.
+
+from rhombus.lib.utils import cerr
+
+from messy.lib.whoosh import ClassIndexer
+
+import datetime
+import itertools
+import sqlite3
+import threading
+
+
+class SQLiteClassIndexer(ClassIndexer):
+
+    def __init__(self, path, name, fields, filters=()):
+        super().__init__(fields, filters)
+        self.path = path
+        self.table = name
+        self.lock = threading.Lock()
+        self.writes = 0
+
+        # autocommit mode, transactions are explicitly opened with BEGIN IMMEDIATE
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False,
+                                    isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.columns = ['text', 'mtime'] + self.filters
+
+        existing = [r[1] for r in self.conn.execute(f'PRAGMA table_info("{self.table}")')]
+        if existing and existing != self.columns:
+            # table was created with different filter fields
+            cerr(f'[WARN: recreating FTS5 table {self.table} to add filter fields, '
+                 f'run whoosh reindex to repopulate]')
+            self.conn.execute(f'DROP TABLE "{self.table}"')
+        self.create_table(self.table)
+
+    def create_table(self, table):
+        unindexed = ''.join(f', "{c}" UNINDEXED' for c in self.columns[1:])
+        self.conn.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS "{table}" '
+                          f"USING fts5(text{unindexed}, tokenize='trigram')")
+
+    def write(self, changeset):
+
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                for field, value in changeset.delete_terms:
+                    self.conn.execute(f'DELETE FROM "{self.table}" WHERE "{field}" = ?',
+                                      (value,))
+                self.conn.executemany(
+                    f'DELETE FROM "{self.table}" WHERE rowid = ?',
+                    [(dbid,) for dbid in itertools.chain(changeset.deletes, changeset.upserts)]
+                )
+                self.insert(self.table, changeset.upserts.values())
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.writes += 1
+
+    def insert(self, table, searchables, batch_size=5000):
+        count = 0
+        searchables = iter(searchables)
+        columns = ', '.join(f'"{c}"' for c in self.columns)
+        placeholders = ', '.join('?' * (len(self.columns) + 1))
+        while (batch := list(itertools.islice(searchables, batch_size))):
+            self.conn.executemany(
+                f'INSERT INTO "{table}"(rowid, {columns}) VALUES ({placeholders})',
+                [(obj.dbid, obj.text, obj.mtime.isoformat() if obj.mtime else None,
+                  *(obj.filters.get(f, None) for f in self.filters))
+                 for obj in batch]
+            )
+            count += len(batch)
+        return count
+
+    def generation(self):
+        # data_version only changes on commits from other connections, hence
+        # local writes are counted separately
+        with self.lock:
+            return (self.conn.execute('PRAGMA data_version').fetchone()[0], self.writes)
+
+    def search(self, terms, limit=None, groups=None, filters=None):
+
+        self.check_filters(groups, filters)
+
+        trigrams = {term[i:i + 3].lower()
+                    for term in terms for i in range(len(term) - 2)}
+        if not trigrams:
+            # terms shorter than 3 characters can not be matched by trigram tokenizer
+            return []
+
+        match = ' OR '.join('"' + t.replace('"', '""') + '"' for t in sorted(trigrams))
+        sql = f'SELECT rowid FROM "{self.table}" WHERE "{self.table}" MATCH ?'
+        params = [match]
+
+        for f, v in (filters or {}).items():
+            sql += f' AND "{f}" = ?'
+            params.append(v)
+
+        if groups is not None:
+            acl = [f'"{f}" = 1' for f in ('public', 'refctrl') if f in self.filters]
+            if groups:
+                acl.append(f'group_id IN ({", ".join("?" * len(groups))})')
+                params.extend(groups)
+            if not acl:
+                return []
+            sql += f' AND ({" OR ".join(acl)})'
+
+        sql += ' ORDER BY rank'
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        with self.lock:
+            return [r[0] for r in self.conn.execute(sql, params)]
+
+    def mtimes(self):
+        with self.lock:
+            return {
+                dbid: datetime.datetime.fromisoformat(mtime) if mtime else None
+                for dbid, mtime in self.conn.execute(f'SELECT rowid, mtime FROM "{self.table}"')
+            }
+
+    def rebuild(self, searchables, procs=None):
+        """ build a new table and swap it in a single transaction; SQLite has a single
+            writer, hence procs is ignored
+        """
+
+        new_table = f'{self.table}__new'
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.execute(f'DROP TABLE IF EXISTS "{new_table}"')
+                self.create_table(new_table)
+                count = self.insert(new_table, searchables)
+                self.conn.execute(f'DROP TABLE "{self.table}"')
+                self.conn.execute(f'ALTER TABLE "{new_table}" RENAME TO "{self.table}"')
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.writes += 1
+
+        return count
+
+# EOF
@@ -0,0 +1,274 @@
+
+# data statistics maintained incrementally
+#
+# the statcounters table holds counters of collections and samples, split by refctrl and
+# public flags, and counters of samples per collection and per species. the counters are
+# updated within the same transaction by an after_flush listener, using the attribute
+# history of the flushed Collection and Sample objects, so that reading the statistics
+# does not need any COUNT(*) scan.
+#
+# changes that bypass the ORM unit of work (eg. bulk UPDATE/DELETE statements) have to
+# adjust the counters with add_deltas(), otherwise the counters drift until reconcile()
+# (messy-run mgr --reconcile_stats) is run. samples removed by the database cascade of a
+# deleted collection never appear in session.deleted, hence they are counted with a
+# grouped query by a before_flush listener, while they still exist.
+#
+# an empty statcounters table is filled from actual counts when it is created and on the
+# first read of each process, so that an existing database does not show zero counters.
+
+from rhombus.lib.utils import cerr
+from rhombus.models.meta import RhoSession
+from messy.models.dbschema import Collection, Sample, StatCounter
+
+from sqlalchemy import event, select, update, insert, delete, func, inspect
+from sqlalchemy.dialects import postgresql, sqlite
+
+import collections
+
+
+def collection_counters(values):
+    counters = ['collections.refctrl' if values['refctrl'] else 'collections']
+    if values['public']:
+        counters.append('collections.public')
+    return [(name, 0) for name in counters]
+
+
+def sample_counters(values):
+    counters = [('samples.refctrl' if values['refctrl'] else 'samples', 0),
+                ('samples.collection', values['collection_id']),
+                ('samples.species', values['species_id'])]
+    if values['public']:
+        counters.append(('samples.public', 0))
+    return counters
+
+
+# {class: (attributes, function returning counters from attribute values)}
+counted_classes = {
+    Collection: (['refctrl', 'public'], collection_counters),
+    Sample: (['refctrl', 'public', 'collection_id', 'species_id'], sample_counters),
+}
+
+
+def counted_spec(obj):
+    for class_, spec in counted_classes.items():
+        if isinstance(obj, class_):
+            return spec
+    return None
+
+
+def object_values(obj, attrs, previous=False):
+    """ return {attr: value} of obj, or the values before the pending changes if previous;
+        values are read from the instance state to avoid reloading expired attributes, eg.
+        server defaults of newly inserted objects which are None (ie. False) anyway
+    """
+    state = inspect(obj)
+    values = {}
+    for attr in attrs:
+        value = state.dict.get(attr, None)
+        if previous:
+            history = state.attrs[attr].history
+            if history.deleted:
+                value = history.deleted[0]
+        values[attr] = value
+    return values
+
+
+def flush_deltas(session):
+    """ return counter deltas of the objects being flushed """
+
+    deltas = collections.Counter()
+
+    for obj in session.new:
+        if (spec := counted_spec(obj)) is not None:
+            for counter in spec[1](object_values(obj, spec[0])):
+                deltas[counter] += 1
+
+    for obj in session.deleted:
+        if (spec := counted_spec(obj)) is not None:
+            for counter in spec[1](object_values(obj, spec[0], previous=True)):
+                deltas[counter] -= 1
+
+    for obj in session.dirty:
+        if (spec := counted_spec(obj)) is None:
+            continue
+        state = inspect(obj)
+        if not any(state.attrs[attr].history.has_changes() for attr in spec[0]):
+            continue
+        for counter in spec[1](object_values(obj, spec[0], previous=True)):
+            deltas[counter] -= 1
+        for counter in spec[1](object_values(obj, spec[0])):
+            deltas[counter] += 1
+
+    return deltas
+
+
+def cascade_deltas(session):
+    """ return counter deltas of the samples of collections being deleted, which are
+        removed by the database cascade
+    """
+
+    deltas = collections.Counter()
+    collection_ids = [obj.id for obj in session.deleted if isinstance(obj, Collection)]
+    if not collection_ids:
+        return deltas
+
+    # samples deleted through the ORM in the same flush are counted by flush_deltas()
+    sample_ids = [obj.id for obj in session.deleted if isinstance(obj, Sample)]
+    attrs, counter_func = counted_classes[Sample]
+    columns = [getattr(Sample, attr) for attr in attrs]
+    q = select(*columns, func.count()).where(Sample.collection_id.in_(collection_ids))
+    if sample_ids:
+        q = q.where(Sample.id.not_in(sample_ids))
+    for row in session.execute(q.group_by(*columns)):
+        for counter in counter_func(dict(zip(attrs, row[:-1]))):
+            deltas[counter] -= row[-1]
+
+    return deltas
+
+
+def add_deltas(connection, deltas):
+    """ add {(name, key): delta} to the counters, inserting missing counters """
+
+    t = StatCounter.__table__
+    dialect = {'postgresql': postgresql, 'sqlite': sqlite}.get(connection.dialect.name, None)
+
+    for (name, key), delta in deltas.items():
+        if delta == 0 or key is None:
+            continue
+        if dialect is not None:
+            connection.execute(
+                dialect.insert(t).values(name=name, key=key, value=delta)
+                .on_conflict_do_update(index_elements=[t.c.name, t.c.key],
+                                       set_={'value': t.c.value + delta})
+            )
+        elif connection.execute(
+                update(t).where(t.c.name == name, t.c.key == key)
+                .values(value=t.c.value + delta)).rowcount == 0:
+            connection.execute(insert(t).values(name=name, key=key, value=delta))
+
+
+def before_flush(session, context, instances):
+    if (deltas := cascade_deltas(session)):
+        add_deltas(session.connection(), deltas)
+
+
+def after_flush(session, context):
+    if (deltas := flush_deltas(session)):
+        add_deltas(session.connection(), deltas)
+
+
+def load_previous(target, value, oldvalue, initiator):
+    """ no-op set listener with active history, so that the previous value of a counted
+        attribute is known also when it was expired before being set
+    """
+    return value
+
+
+event.listen(RhoSession, "before_flush", before_flush)
+event.listen(RhoSession, "after_flush", after_flush)
+for class_, (attrs, _) in counted_classes.items():
+    for attr in attrs:
+        event.listen(getattr(class_, attr), "set", load_previous, active_history=True)
+
+
+_seeded_ = False
+
+
+def seed_counters(connection):
+    """ fill an empty statcounters table with the actual counts, return the number of
+        inserted counters
+    """
+
+    t = StatCounter.__table__
+    if connection.execute(select(t.c.id).limit(1)).first() is not None:
+        return 0
+    inspector = inspect(connection)
+    if not all(inspector.has_table(c.__tablename__) for c in counted_classes):
+        # tables created in the same run, hence still empty
+        return 0
+
+    rows = [{'name': name, 'key': key, 'value': value}
+            for (name, key), value in actual_counters(connection).items()
+            if value and key is not None]
+    if rows:
+        dialect = {'postgresql': postgresql, 'sqlite': sqlite}.get(connection.dialect.name,
+                                                                   None)
+        # counters inserted concurrently by another process are kept
+        stmt = insert(t) if dialect is None else dialect.insert(t).on_conflict_do_nothing()
+        connection.execute(stmt, rows)
+        cerr(f'[Seeded {len(rows)} statistic counter(s)]')
+    return len(rows)
+
+
+def ensure_seeded(session):
+    global _seeded_
+    if not _seeded_:
+        seed_counters(session.connection())
+        _seeded_ = True
+
+
+event.listen(StatCounter.__table__, "after_create",
+             lambda target, connection, **kw: seed_counters(connection))
+
+
+def get_counters(session, *names):
+    """ return {name: value} of counters with key 0 """
+    ensure_seeded(session)
+    counts = dict.fromkeys(names, 0)
+    counts.update(session.execute(
+        select(StatCounter.name, StatCounter.value).where(
+            StatCounter.name.in_(names), StatCounter.key == 0)
+    ).all())
+    return counts
+
+
+def get_keyed_counters(session, name):
+    """ return {key: value} of counter name, eg. samples per species id """
+    ensure_seeded(session)
+    return dict(session.execute(
+        select(StatCounter.key, StatCounter.value).where(
+            StatCounter.name == name, StatCounter.value != 0)
+    ).all())
+
+
+def actual_counters(session):
+    """ return {(name, key): value} computed with COUNT(*) queries, session can also be a
+        connection
+    """
+
+    counts = collections.Counter()
+
+    for class_, (attrs, counter_func) in counted_classes.items():
+        columns = [getattr(class_, attr) for attr in attrs]
+        for row in session.execute(select(*columns, func.count()).group_by(*columns)):
+            for counter in counter_func(dict(zip(attrs, row[:-1]))):
+                counts[counter] += row[-1]
+
+    return counts
+
+
+def reconcile(session, fix=True):
+    """ compare the counters with actual counts, return [(name, key, stored, actual)] of
+        drifted counters and rewrite the counters if fix is True
+    """
+
+    stored = {(r.name, r.key): r.value for r in session.execute(
+        select(StatCounter.name, StatCounter.key, StatCounter.value))}
+    actual = actual_counters(session)
+
+    drifts = sorted(
+        (name, key, stored.get((name, key), 0), actual.get((name, key), 0))
+        for name, key in stored.keys() | actual.keys()
+        if stored.get((name, key), 0) != actual.get((name, key), 0)
+    )
+
+    if fix and drifts:
+        t = StatCounter.__table__
+        session.execute(delete(t))
+        session.execute(insert(t), [{'name': name, 'key': key, 'value': value}
+                                    for (name, key), value in actual.items() if value])
+        cerr(f'[Reconciled {len(drifts)} statistic counter(s)]')
+
+    return drifts
+
+# EOF
@@ -1,11 +1,24 @@
 
-from rhombus.lib.utils import random_string, get_dbhandler
+from rhombus.lib.utils import random_string, get_dbhandler, cerr
 from messy.lib import converter
+from messy.lib.whoosh import hydrate
+from messy.models.dbschema import convert_date, default_date
+from rhombus.models.auxtypes import GUID
+from sqlalchemy import func, inspect
+from sqlalchemy.orm import selectinload
+import dateutil.parser
+import datetime
+import math
 import json
 import yaml
 import pandas as pd
+import pyarrow as pa
+import pyarrow.feather
 import os
+import shutil
+import itertools
 import functools
+import collections
 
 
 _temp_directory_ = None
@@ -21,6 +34,11 @@ def get_temp_directory():
     return _temp_directory_
 
 
+def set_chunk_size(size):
+    """ set the number of rows in each stored chunk, which is also the unit of commit """
+    UploadJob.batch_size = size
+
+
 def create_temp_file(prefix, username, extension, randkey):
     return f"{get_temp_directory()}/{prefix}-{username}-{randkey}.{extension}"
 
@@ -29,76 +47,319 @@ def create_temp_directory(prefix, username, randkey):
     return f"{get_temp_directory()}/{prefix}-{username}-{randkey}/"
 
 
+def batched(iterable, size):
+    """ yield lists of at most size items from iterable """
+    iterator = iter(iterable)
+    while (batch := list(itertools.islice(iterator, size))):
+        yield batch
+
+
+def is_empty(v):
+    return (v is None or (isinstance(v, str) and v == '')
+            or (isinstance(v, float) and math.isnan(v)) or v is pd.NaT)
+
+
+def clean_dict(d):
+    """ clear off empty string, None or NaN """
+    return {f: v for f, v in d.items() if not is_empty(v)}
+
+
+# key of the list of coercion error messages attached to a record dict
+ROW_ERRORS = '__errors__'
+
+
+def row_errors(d):
+    """ pop coercion messages from d, return (messages, has_fatal_error) """
+    msgs = d.pop(ROW_ERRORS, None) or []
+    return msgs, any(msg.startswith('ERR:') for msg in msgs)
+
+
+# light-weight, JSON-serializable replacement of Institution instances in the caches
+InstitutionRef = collections.namedtuple('InstitutionRef', ['id', 'code', 'name'])
+
+
+def institution_ref(inst):
+    return InstitutionRef(inst.id, inst.code, inst.name) if inst is not None else None
+
+
+# pending jobs are stored in their own directory in the temp directory:
+#   job.json            - class name, attributes, validation results and resolved-id caches
+#   rows-NNNNN.feather  - normalized rows, one uncompressed Arrow IPC (Feather) file per
+#                         batch, so that they can be memory-mapped when read
+
+upload_job_classes = {}
+
+
+def register_upload_job(class_):
+    upload_job_classes[class_.__name__] = class_
+    return class_
+
+
+def get_job_directory(user_id, randkey):
+    if not randkey.isalnum():
+        raise ValueError('Invalid job id')
+    return create_temp_directory('upload', user_id, randkey)
+
+
+def load_job(user_id, randkey):
+    """ load pending job stored by UploadJob.save() """
+    jobdir = get_job_directory(user_id, randkey)
+    with open(os.path.join(jobdir, 'job.json')) as instream:
+        state = json.load(instream)
+    class_ = upload_job_classes[state.pop('job_class')]
+    job = class_.__new__(class_)
+    job.jobdir = jobdir
+    job.set_state(state)
+    return job
+
+
 class UploadJob(object):
 
+    # supported input file formats
+    extensions = {'.tsv', '.csv', '.jsonl', '.yaml'}
+
+    # number of records in each batch yielded by stream_to_dicts()
+    batch_size = 1000
+
+    # attributes saved in job.json
+    state_fields = ['randkey', 'user_id', 'filename', 'chunks', 'validation', 'status',
+                    'chunk_results']
+
+    # commit status: pending, running, completed or failed (when any chunk failed)
+    status = 'pending'
+
+    # outcome of each chunk committed by execute(), None for chunks not yet committed
+    chunk_results = None
+
     def __init__(self, user_id):
         self.randkey = random_string(16)
         self.user_id = user_id
+        self.filename = None
+        self.jobdir = get_job_directory(user_id, self.randkey)
+        self.chunks = 0
+        self.validation = None
+
+    def save_stream(self, filename, instream):
+        """ parse the uploaded stream batch by batch and store the normalized rows, so that
+            confirm() and commit() can read them in batches instead of keeping all of them
+            in memory
+        """
+        name, ext = os.path.splitext(filename)
+        if ext not in self.extensions:
+            raise RuntimeError('Invalid input file format')
+        self.filename = filename
+
+        os.makedirs(self.jobdir, exist_ok=True)
+        self.chunks = 0
+        for batch in self.stream_to_dicts(instream):
+            write_rows(self.chunk_path(self.chunks), batch)
+            self.chunks += 1
+        self.save()
+
+    def chunk_path(self, idx):
+        return os.path.join(self.jobdir, f'rows-{idx:05d}.feather')
+
+    def batches(self):
+        """ yield lists of cleaned dicts from the stored rows """
+        for idx in range(self.chunks):
+            yield read_rows(self.chunk_path(idx))
 
     def check_user(self, user_id):
         return self.user_id == user_id
 
     def confirm(self):
-        pass
+        """ return validation results, validating the rows only once per job """
+        if self.validation is None:
+            self.validation = self.validate()
+            self.save()
+        return self.validation
+
+    def validate(self):
+        return {}
 
     def commit(self):
         pass
 
+    def execute(self, commit_chunk, tm=None, progress=None):
+        """ call commit_chunk(rows) for each stored chunk inside a savepoint, recording the
+            outcome of every chunk in job.json; with tm (transaction manager), the transaction
+            is committed after each chunk, so completed chunks survive later failures.
+            Chunks that have been completed are skipped, hence calling execute() again on a
+            failed job only retries the failed chunks. progress(idx, chunks) is called after
+            each chunk.
+        """
+
+        dbh = get_dbhandler()
+        if self.chunk_results is None or len(self.chunk_results) != self.chunks:
+            self.chunk_results = [None] * self.chunks
+        self.status = 'running'
+        self.save()
+
+        for idx, rows in enumerate(self.batches()):
+            if self.chunk_results[idx] and self.chunk_results[idx]['status'] == 'completed':
+                continue
+            try:
+                with dbh.session().begin_nested():
+                    result = commit_chunk(rows)
+                if tm:
+                    tm.commit()
+                    tm.begin()
+                self.chunk_results[idx] = {'status': 'completed', 'result': result}
+            except Exception as err:
+                if tm:
+                    tm.abort()
+                    tm.begin()
+                cerr(f'[WARN: chunk {idx} of upload job {self.randkey} failed: {err}]')
+                self.chunk_results[idx] = {'status': 'failed', 'error': str(err)}
+            self.save()
+            if progress:
+                progress(idx + 1, self.chunks)
+
+        self.status = 'failed' if self.failed_chunks() else 'completed'
+        self.save()
+        return self.chunk_results
+
+    def failed_chunks(self):
+        return [idx for idx, r in enumerate(self.chunk_results or [])
+                if r and r['status'] == 'failed']
+
+    def progress(self):
+        """ return commit progress suitable for the status endpoint """
+        results = self.chunk_results or []
+        return {
+            'jobid': self.randkey,
+            'status': self.status,
+            'chunks': self.chunks,
+            'completed': sum(1 for r in results if r and r['status'] == 'completed'),
+            'failed': self.failed_chunks(),
+            'errors': {idx: results[idx]['error'] for idx in self.failed_chunks()},
+        }
+
+    def get_state(self):
+        return {f: getattr(self, f) for f in self.state_fields}
+
+    def set_state(self, state):
+        for f, v in state.items():
+            setattr(self, f, v)
+
+    def save(self):
+        """ write job.json atomically """
+        state = dict(self.get_state(), job_class=self.__class__.__name__)
+        path = os.path.join(self.jobdir, 'job.json')
+        with open(path + '.tmp', 'w') as outstream:
+            json.dump(state, outstream)
+        os.replace(path + '.tmp', path)
+
+    def remove(self):
+        shutil.rmtree(self.jobdir, ignore_errors=True)
+
     def stream_to_dicts(self, instream):
-        df = dicts = None
+        """ yield lists of at most batch_size dicts, with empty values removed; only a
+            single chunk of the input is parsed at any time
+        """
+        for df in self.read_frames(instream):
+            errors = self.coerce_frame(df)
+            batch = []
+            for idx, d in zip(df.index, converter.frame_to_records(df)):
+                d = clean_dict(d)
+                if idx in errors:
+                    d[ROW_ERRORS] = errors[idx]
+                batch.append(d)
+            yield batch
+
+    def read_frames(self, instream):
+        """ yield DataFrames of at most batch_size rows, indexed by row number """
         name, ext = os.path.splitext(self.filename)
-        if ext == '.tsv':
-            df = pd.read_table(instream, sep='\t', dtype=str, na_filter=False)
-        elif ext == '.csv':
-            df = pd.read_table(instream, sep=',', dtype=str, na_filter=False)
+        if ext in ('.tsv', '.csv'):
+            return pd.read_table(instream, sep='\t' if ext == '.tsv' else ',', dtype=str,
+                                 na_filter=False, chunksize=self.batch_size)
         elif ext == '.jsonl':
-            dicts = []
-            for line in instream:
-                dicts.append(json.loads(line))
+            return records_to_frames(
+                (json.loads(line) for line in instream if line.strip()), self.batch_size)
         elif ext == '.yaml':
-            dicts = list(yaml.safe_load_all(instream))
-        else:
-            raise RuntimeError('Invalid input file format')
+            return records_to_frames(
+                (d for d in yaml.safe_load_all(instream) if d is not None), self.batch_size)
+        raise RuntimeError('Invalid input file format')
+
+    def coerce_frame(self, df):
+        """ convert columns of df in place to their proper types, return
+            {row_index: [messages]} of the cells that can not be converted
+        """
+        return {}
 
-        if dicts is None:
-            dicts = df.to_dict(orient='records')
 
-        # clear off empty string or None
-        for d in dicts:
-            for f, v in list(d.items()):
-                if v == '' or v is None:
-                    del d[f]
+def write_rows(path, rows):
+    """ write list of dicts as uncompressed Feather file, a column for every key """
+    keys = dict.fromkeys(k for d in rows for k in d)
+    try:
+        table = pa.table({k: [d.get(k, None) for d in rows] for k in keys})
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as err:
+        raise ValueError(f'Inconsistent value types in the uploaded file: {err}') from err
+    pyarrow.feather.write_feather(table, path, compression='uncompressed')
 
-        import pprint; pprint.pprint(dicts)
 
-        return dicts
+def read_rows(path):
+    """ read rows written by write_rows(), with the file memory-mapped """
+    table = pyarrow.feather.read_table(path, memory_map=True)
+    return [clean_dict(d) for d in table.to_pylist()]
 
 
+def records_to_frames(records, size):
+    """ yield DataFrames of at most size records, indexed by record number; object dtype
+        keeps the values (eg. integer ids) as they were parsed
+    """
+    offset = 0
+    for batch in batched(records, size):
+        yield pd.DataFrame(batch, index=range(offset, offset + len(batch)), dtype=object)
+        offset += len(batch)
+
+
+@register_upload_job
 class InstitutionUploadJob(UploadJob):
 
     def __init__(self, user_id, filename, instream):
         super().__init__(user_id)
-        # save to memory
-        self.filename = filename
-        self.dicts = self.stream_to_dicts(instream)
+        self.save_stream(filename, instream)
 
-    def confirm(self):
+    def validate(self):
         err_msgs = []
-        code_list = [d['code'] for d in self.dicts]
-        code_set = set(code_list)
-        if len(code_set) < len(code_list):
-            err_msgs.append(f'Duplicate code(s) found in the file, from {len(code_list)} to {len(code_set)} unique code(s)')
         dbh = get_dbhandler()
-        existing = dbh.Institution.query(dbh.session()).filter(dbh.Institution.code.in_(code_list)).count()
+        count = existing = 0
+        code_set = set()
+        for batch in self.batches():
+            code_list = [d['code'] for d in batch]
+            count += len(code_list)
+            new_codes = set(code_list) - code_set
+            code_set.update(new_codes)
+            existing += dbh.Institution.query(dbh.session()).filter(
+                dbh.Institution.code.in_(new_codes)).count()
+        if len(code_set) < count:
+            err_msgs.append(f'Duplicate code(s) found in the file, from {count} to {len(code_set)} unique code(s)')
         return {'existing': existing, 'new': len(code_set) - existing, 'err_msgs': err_msgs}
 
-    def commit(self, method):
+    def commit(self, method, tm=None, progress=None):
 
         dbh = get_dbhandler()
         updated = added = failed = 0
 
+        if method not in ('add', 'update', 'add_update'):
+            raise RuntimeError('unrecognized method')
+
+        results = self.execute(lambda batch: self._commit_batch(batch, method, dbh), tm,
+                               progress)
+        for r in results:
+            if r['status'] == 'completed':
+                counts = r['result']
+                added, updated, failed = added + counts[0], updated + counts[1], failed + counts[2]
+
+        return added, updated, failed
+
+    def _commit_batch(self, batch, method, dbh):
+
+        updated = added = failed = 0
+
         institutions = {}
-        for d in self.dicts:
+        for d in batch:
             institutions[d['code']] = d
         code_list = institutions.keys()
 
@@ -137,39 +398,100 @@ class InstitutionUploadJob(UploadJob):
                 dbh.session().add(obj)
                 added += 1
 
-        else:
-            raise RuntimeError('unrecognized method')
-
         return added, updated, failed
 
 
+@register_upload_job
 class SampleUploadJob(UploadJob):
 
+    state_fields = UploadJob.state_fields + ['collection_id']
+
     def __init__(self, user_id, filename, instream, collection_id):
         super().__init__(user_id)
         self.collection_id = collection_id
-        self.filename = filename
-        self.dicts = self.stream_to_dicts(instream)
         self.institution_translation_table = {}
         self.institution_cache = {}
         self.ekey_cache = {}
+        self.ekid_cache = {}
         self.collection_cache = {}
+        self.collection_ids = {}
+        self.save_stream(filename, instream)
+
+    def get_state(self):
+        # tuple and integer keys are stored as lists of items
+        return dict(
+            super().get_state(),
+            institution_translation_table=self.institution_translation_table,
+            institution_cache=self.institution_cache,
+            ekey_cache=list(self.ekey_cache.items()),
+            ekid_cache=list(self.ekid_cache.items()),
+            collection_cache=list(self.collection_cache.items()),
+            collection_ids=self.collection_ids,
+        )
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.institution_cache = {code: InstitutionRef(*inst) if inst else None
+                                  for code, inst in state['institution_cache'].items()}
+        self.ekey_cache = {tuple(t): v for t, v in state['ekey_cache']}
+        self.ekid_cache = {tuple(t): v for t, v in state['ekid_cache']}
+        self.collection_cache = dict(state['collection_cache'])
+
+    def coerce_frame(self, df):
+        # row numbers in the messages are 1-based, excluding header line
+        errors = {}
+        for f, (convert, default) in sample_converters.items():
+            if f in df.columns:
+                for idx, msg in coerce_numeric(df, f, convert, default).items():
+                    errors.setdefault(idx, []).append(f'row {idx + 1} - {msg}')
+
+        # invalid dates are fatal for the row
+        today = datetime.date.today()
+        for f in sample_date_fields:
+            if f in df.columns:
+                for idx, msg in coerce_date(df, f, today).items():
+                    errors.setdefault(idx, []).append(f'ERR: row {idx + 1} - {msg}')
+
+        return errors
 
     def confirm(self):
+        return dict(super().confirm(), institutions=self.institution_cache)
 
-        dbh = get_dbhandler()
-        samples = len(self.dicts)
-        err_msgs, existing_codes, existing_acc_codes = self.check_duplicate_codes()
+    def validate(self):
 
-        for d in self.dicts:
-            err_msgs.extend(self.fix_fields(d, dbh))
+        dbh = get_dbhandler()
+        samples = 0
+        err_msgs = []
+        existing_codes = set()
+        existing_acc_codes = set()
+        codes = set()
+        acc_codes = set()
+
+        self.prefetch(dbh)
+
+        for batch in self.batches():
+            samples += len(batch)
+            for d in batch:
+                err_msgs.extend(row_errors(d)[0])
+            batch_msgs, batch_codes, batch_acc_codes = self.check_duplicate_codes(
+                batch, codes, acc_codes)
+            err_msgs.extend(batch_msgs)
+            existing_codes.update(batch_codes)
+            existing_acc_codes.update(batch_acc_codes)
+
+            for d in batch:
+                err_msgs.extend(self.fix_fields(d, dbh))
 
         err_msgs = sorted(list(set(err_msgs)))
-        return {'samples': samples, 'existing_codes': existing_codes,
-                'existing_acc_codes': existing_acc_codes, 'err_msgs': err_msgs,
-                'institutions': self.institution_cache}
+        return {'samples': samples, 'existing_codes': sorted(existing_codes),
+                'existing_acc_codes': sorted(existing_acc_codes), 'err_msgs': err_msgs}
 
-    def commit(self, method, user):
+    def commit(self, method, user, bulk=True, tm=None, progress=None):
+        """ add and/or update samples; bulk uses the set-based path which loads existing
+            samples per batch with a single query and bypasses the per-row lookups of
+            Sample.update(), otherwise each sample is processed through the ORM one by one.
+            Samples of a failed chunk are reported as failed with the chunk error.
+        """
 
         dbh = get_dbhandler()
         updated = []
@@ -177,8 +499,34 @@ class SampleUploadJob(UploadJob):
         not_added = []
         failed = []
 
+        self.prefetch(dbh, user)
+
+        results = self.execute(
+            lambda batch: self._commit_batch(batch, method, user, dbh, bulk), tm, progress)
+        for idx, r in enumerate(results):
+            if r['status'] == 'completed':
+                for a_list, batch_list in zip((added, not_added, updated, failed), r['result']):
+                    a_list.extend(tuple(x) if isinstance(x, list) else x for x in batch_list)
+            else:
+                failed.extend((d['code'], f"chunk {idx + 1}: {r['error']}")
+                              for d in read_rows(self.chunk_path(idx)))
+
+        return added, not_added, updated, failed
+
+    def _commit_batch(self, batch, method, user, dbh, bulk=True):
+
+        updated = []
+        added = []
+        not_added = []
+        failed = []
+
         samples = {}
-        for d in self.dicts:
+        invalid = []
+        for d in batch:
+            msgs, fatal = row_errors(d)
+            if fatal:
+                invalid.append((d['code'], '; '.join(msgs)))
+                continue
             self.fix_fields(d, dbh, method)
             samples[d['code']] = d
         code_list = samples.keys()
@@ -186,22 +534,27 @@ class SampleUploadJob(UploadJob):
         q = dbh.session().query(dbh.Sample.code).filter(dbh.Sample.code.in_(code_list))
         existing_codes = set([t[0] for t in q])
 
+        if bulk:
+            add_samples, update_samples = self._bulk_add_samples, self._bulk_update_samples
+        else:
+            add_samples, update_samples = self._add_samples, self._update_samples
+
         if method == 'add':
 
-            added, not_added, failed = self._add_samples(samples, existing_codes, user, dbh)
+            added, not_added, failed = add_samples(samples, existing_codes, user, dbh)
 
         elif method == 'update':
 
-            updated, failed = self._update_samples(samples, existing_codes, user, dbh)
+            updated, failed = update_samples(samples, existing_codes, user, dbh)
 
         elif method == 'add_update':
 
             # we perform updates first before addition in case any of the updates fix inconsistency
             # or constraint that addition may cause
 
-            updated, failed = self._update_samples(samples, existing_codes, user, dbh)
+            updated, failed = update_samples(samples, existing_codes, user, dbh)
             dbh.session().flush()
-            added, not_added, failed_2 = self._add_samples(samples, existing_codes, user, dbh)
+            added, not_added, failed_2 = add_samples(samples, existing_codes, user, dbh)
             if len(not_added) != (len(updated) + len(failed)):
                 raise RuntimeError('samples not being added is not in the set of being updated!')
             else:
@@ -211,7 +564,7 @@ class SampleUploadJob(UploadJob):
         else:
             raise RuntimeError('method is not registered')
 
-        return added, not_added, updated, failed
+        return added, not_added, updated, invalid + failed
 
     def _add_samples(self, samples, existing_codes, user, dbh):
         added = []
@@ -268,7 +621,7 @@ class SampleUploadJob(UploadJob):
                                                  f'{user.login} is not a member of {collection}'))
                         continue
                 if (collection_id := sample.get('collection_id', None)):
-                    if not self.is_collection_membet(collection_id, user, dbh):
+                    if not self.is_collection_member(collection_id, user, dbh):
                         failed.append((obj.code, f'either collection_id {collection_id} does not exist or '
                                                  f'{user.login} is not a member the collection'))
                         continue
@@ -283,33 +636,287 @@ class SampleUploadJob(UploadJob):
 
         return updated, failed
 
-    def check_duplicate_codes(self):
-        """ check for duplicate sample codes & acc_codes and also existing codes """
+    def _bulk_add_samples(self, samples, existing_codes, user, dbh):
+        """ create new samples with collection, institution and EK ids already resolved,
+            so that the flush can insert them in batches (insertmanyvalues)
+        """
+        added = []
+        not_added = []
+        failed = []
+        new_samples = []
+        ek_groups = self.get_ek_groups(dbh)
+        for d in samples.values():
+            try:
+                if d['code'] in existing_codes:
+                    not_added.append(d['code'])
+                    continue
+                if not d.get('collection', None):
+                    if self.collection_id < 0:
+                        raise ValueError('Please either set the collection in the file '
+                                         'or use correct collection_id')
+                    d = dict(d, collection_id=self.collection_id)
+                    d.pop('collection', None)
+                else:
+                    collection = d['collection']
+                    if not self.is_collection_member(collection, user, dbh):
+                        failed.append((d['code'], f'either collection {collection} does not exist or '
+                                                     f'{user.login} is not a member of {collection}'))
+                        continue
+
+                values = self.sample_values(d, dbh)
+                for f, key in (('passage', 'original'), ('species', 'no-species')):
+                    if not values.get(f'{f}_id', None):
+                        values[f'{f}_id'] = self.get_ek_id(key, ek_groups[f], dbh)
+
+                obj = dbh.Sample()
+                obj.update_fields_with_dict(values)
+                obj.uuid = GUID.new()
+                new_samples.append(obj)
+                added.append(obj.code)
+
+            except AssertionError as err:
+                raise RuntimeError(
+                    f'Error while processing sample code {d["code"]} with message:\n{str(err)}'
+                ) from err
+
+        dbh.session().add_all(new_samples)
+        return added, not_added, failed
+
+    def _bulk_update_samples(self, samples, existing_codes, user, dbh):
+        """ load all existing samples with a single query and only set fields whose values
+            differ from the stored ones
+        """
+        updated = []
+        failed = []
+        q = dbh.Sample.query(dbh.session()).filter(dbh.Sample.code.in_(existing_codes)).options(
+            selectinload(dbh.Sample.collection).joinedload(dbh.Collection.group)
+        )
+        for obj in q:
+            code = obj.code
+            try:
+                if not obj.can_modify(user):
+                    failed.append((obj.code, f'{user.login} do not have permission to modify'))
+                    continue
+
+                sample = samples[code]
+                if (collection := sample.get('collection', None)):
+                    if not self.is_collection_member(collection, user, dbh):
+                        failed.append((obj.code, f'either collection {collection} does not exist or '
+                                                 f'{user.login} is not a member of {collection}'))
+                        continue
+                if (collection_id := sample.get('collection_id', None)):
+                    if not self.is_collection_member(collection_id, user, dbh):
+                        failed.append((obj.code, f'either collection_id {collection_id} does not exist or '
+                                                 f'{user.login} is not a member the collection'))
+                        continue
+
+                # fields other than columns (eg. host_age or outbreak) are not attributes
+                # of Sample, and are skipped by update_fields_with_dict() as well
+                columns = self.get_sample_columns(dbh)
+                changes = {f: v for f, v in self.sample_values(sample, dbh).items()
+                           if f in columns and getattr(obj, f) != v}
+                if changes:
+                    obj.update_fields_with_dict(changes)
+                updated.append(code)
+
+            except Exception as err:
+                raise RuntimeError(
+                    f'Error while processing sample code {code} with message:\n{str(err)}'
+                ) from err
+
+        return updated, failed
+
+    def sample_values(self, d, dbh):
+        """ return {attribute: value} of a fixed sample dict, with collection, institutions
+            and EK keys resolved to ids from the caches and dates parsed
+        """
+        d = dict(d)
+        values = {}
+
+        if (collection := d.pop('collection', None)):
+            values['collection_id'] = self.get_collection_id(collection, dbh)
 
-        composite_codes = [(r['code'], r.get('acc_code', '')) for r in self.dicts]
-        codes = {}
-        acc_codes = {}
+        for f in ('originating_institution', 'sampling_institution'):
+            inst_id = d.pop(f'{f}_id', None)
+            if (code := d.pop(f, None)):
+                values[f'{f}_id'] = inst_id or self.get_institution(code, dbh).id
+
+        for f, group in self.get_ek_groups(dbh).items():
+            if f in d:
+                values[f'{f}_id'] = self.get_ek_id(d.pop(f), group, dbh)
+
+        now = datetime.date.today()
+        for f in sample_date_fields:
+            convert_date(d, f, now)
+
+        values.update(d)
+        return values
+
+    @functools.cache
+    def get_ek_groups(self, dbh):
+        """ return {ek_field: ek_group} of Sample class """
+        return {f: dbh.Sample.get_ek_metainfo()[f][1] for f in dbh.Sample.__ek_fields__}
+
+    @functools.cache
+    def get_sample_columns(self, dbh):
+        """ return set of column attribute names of Sample class """
+        return {attr.key for attr in inspect(dbh.Sample).column_attrs}
+
+    def get_ek_id(self, key, group, dbh):
+        t = (key, group)
+        if t not in self.ekid_cache:
+            self.ekid_cache[t] = dbh.get_ek_id(key, group)
+        return self.ekid_cache[t]
+
+    def get_collection_id(self, code, dbh):
+        if code not in self.collection_ids:
+            self.collection_ids[code] = dbh.get_collections_by_codes(
+                code, groups=None, ignore_acl=True)[0].id
+        return self.collection_ids[code]
+
+    def check_duplicate_codes(self, dicts, codes, acc_codes):
+        """ check for duplicate sample codes & acc_codes and also existing codes;
+            codes and acc_codes are sets of codes seen in previous batches, and will be
+            updated with the codes of dicts
+        """
+
+        composite_codes = [(r['code'], r.get('acc_code', '')) for r in dicts]
+        batch_codes = set()
+        batch_acc_codes = set()
         err_msgs = []
         for (c, ac) in composite_codes:
             if c in codes:
                 err_msgs.append(f'Duplicate code: {c}')
             else:
-                codes[c] = True
+                codes.add(c)
+                batch_codes.add(c)
             if ac and ac in acc_codes:
                 err_msgs.append(f'Duplicate acc_code: {ac}')
             else:
-                acc_codes[ac] = True
+                acc_codes.add(ac)
+                batch_acc_codes.add(ac)
 
         dbh = get_dbhandler()
 
-        q = dbh.session().query(dbh.Sample.code).filter(dbh.Sample.code.in_(codes.keys()))
+        q = dbh.session().query(dbh.Sample.code).filter(dbh.Sample.code.in_(batch_codes))
         existing_codes = set([t[0] for t in q])
 
-        q = dbh.session().query(dbh.Sample.acc_code).filter(dbh.Sample.acc_code.in_(acc_codes.keys()))
+        q = dbh.session().query(dbh.Sample.acc_code).filter(dbh.Sample.acc_code.in_(batch_acc_codes))
         existing_acc_codes = set([t[0] for t in q])
 
         return err_msgs, existing_codes, existing_acc_codes
 
+    def prefetch(self, dbh, user=None):
+        """ collect the distinct institution codes, EK keys and collections across the
+            whole upload and resolve them into the caches with a constant number of queries;
+            entries already in the caches (eg. set from the confirmation page) are kept
+        """
+
+        ek_groups = self.get_ek_groups(dbh)
+        inst_codes = {'NOT-AVAILABLE'}
+        ek_keys = {}
+        collections = set()
+        collection_ids = set()
+
+        for f, v in sample_defaults.items():
+            if f in ek_groups:
+                ek_keys.setdefault(ek_groups[f], set()).add(v)
+
+        for batch in self.batches():
+            for d in batch:
+                for f in ('originating_institution', 'sampling_institution'):
+                    if (code := d.get(f, None)):
+                        inst_codes.add(code)
+                for f, group in ek_groups.items():
+                    if f in d:
+                        ek_keys.setdefault(group, set()).add(d[f])
+                if (collection := d.get('collection', None)):
+                    collections.add(collection)
+                if (collection_id := d.get('collection_id', None)):
+                    collection_ids.add(collection_id)
+
+        self.prefetch_institutions(inst_codes - self.institution_cache.keys(), dbh)
+        for group, keys in ek_keys.items():
+            self.prefetch_ekeys({k for k in keys if (k, group) not in self.ekey_cache},
+                                group, dbh)
+
+        if user is not None:
+            self.prefetch_collections(collections - self.collection_cache.keys(),
+                                      collection_ids - self.collection_cache.keys(), user, dbh)
+
+    def prefetch_institutions(self, codes, dbh):
+        """ resolve exact codes with a single query, and the rest with fuzzy search whose
+            hits are loaded with a single query
+        """
+
+        if not codes:
+            return
+        for inst in dbh.get_institutions_by_codes(list(codes), None):
+            self.institution_cache[inst.code] = institution_ref(inst)
+
+        leftovers = {}
+        for code in codes - self.institution_cache.keys():
+            dbids = dbh.Institution.search_text(code, dbh.session(), 1, id_only=True)
+            leftovers[code] = dbids[0] if dbids else None
+
+        insts = {inst.id: inst for inst in hydrate(
+            dbh.Institution, [dbid for dbid in leftovers.values() if dbid], dbh.session())}
+        for code, dbid in leftovers.items():
+            self.institution_cache[code] = institution_ref(insts.get(dbid, None))
+
+    def prefetch_ekeys(self, keys, group, dbh):
+        """ resolve keys of an EK group with a single query, and the rest with fuzzy
+            search whose hits are loaded with a single query
+        """
+
+        if not keys:
+            return
+        group_ek = dbh.get_ekey(group)
+        lower_keys = {k.lower(): k for k in keys}
+        q = dbh.session().query(dbh.EK.id, dbh.EK.key).filter(
+            dbh.EK.member_of_id == group_ek.id, func.lower(dbh.EK.key).in_(lower_keys.keys()))
+        for ek_id, ek_key in q:
+            key = lower_keys[ek_key.lower()]
+            self.ekey_cache[(key, group)] = key
+            self.ekid_cache[(key, group)] = ek_id
+
+        # the EK index covers all groups, hence only hits within group are accepted and
+        # keys without such hit are left to the per-key get_ekey() and get_ek_id()
+        leftovers = {}
+        for key in keys:
+            if (key, group) in self.ekey_cache:
+                continue
+            leftovers[key] = dbh.EK.search_text(key.replace('-', ' '), dbh.session(), 5,
+                                                id_only=True)
+
+        eks = {ek.id: ek for ek in hydrate(
+            dbh.EK, list({dbid for dbids in leftovers.values() for dbid in dbids}),
+            dbh.session())}
+        for key, dbids in leftovers.items():
+            for dbid in dbids:
+                if dbid in eks and eks[dbid].member_of_id == group_ek.id:
+                    self.ekey_cache[(key, group)] = eks[dbid].key
+                    self.ekid_cache[(eks[dbid].key, group)] = dbid
+                    break
+
+    def prefetch_collections(self, codes, ids, user, dbh):
+        """ resolve collection membership of the user with one query for codes and one
+            for ids; collections not returned are either missing or not accessible
+        """
+
+        if codes:
+            found = {c.code: c.id for c in dbh.get_collections_by_codes(list(codes), groups=None,
+                                                                         user=user)}
+            self.collection_ids.update(found)
+            for code in codes:
+                self.collection_cache[code] = code in found
+
+        if ids:
+            found = {c.id for c in dbh.get_collections_by_ids([int(i) for i in ids],
+                                                               groups=None, user=user)}
+            for collection_id in ids:
+                self.collection_cache[collection_id] = int(collection_id) in found
+
     def get_institution(self, inst_code, dbh):
         if inst_code not in self.institution_cache:
             inst = self.institution_cache[inst_code] = self._get_institution(inst_code, dbh)
@@ -324,15 +931,15 @@ class SampleUploadJob(UploadJob):
         if len(inst_code.split()) == 1:
             inst = dbh.get_institutions_by_codes(inst_code, None)
             if len(inst) == 1:
-                return inst[0]
+                return institution_ref(inst[0])
 
-        inst = dbh.Institution.search_text(inst_code, dbh.session(), 1)[0]
-        return inst
+        insts = dbh.Institution.search_text(inst_code, dbh.session(), 1)
+        return institution_ref(insts[0]) if insts else None
 
     def get_ekey(self, key, group, dbh):
         t = (key, group)
         if t not in self.ekey_cache:
-            ekey = self._get_ekey(key, group, dbh)
+            ekey = self.ekey_cache[t] = self._get_ekey(key, group, dbh)
         else:
             ekey = self.ekey_cache[t]
 
@@ -441,8 +1048,9 @@ class SampleUploadJob(UploadJob):
             if f in d:
                 err_msgs.extend(self.fix_ekey(d, f, dbh))
 
+        # values from tabular files have been converted by coerce_frame()
         for f, c in sample_converters.items():
-            if f in d:
+            if f in d and isinstance(d[f], str):
                 try:
                     d[f] = c[0](d[f])
                 except Exception:
@@ -451,10 +1059,58 @@ class SampleUploadJob(UploadJob):
         return err_msgs
 
 
+@register_upload_job
 class SampleGISAIDUploadJob(SampleUploadJob):
 
-    def stream_to_dicts(self, instream):
-        return converter.import_gisaid_csv(instream)
+    def read_frames(self, instream):
+        return converter.iter_gisaid_frames(instream, self.batch_size)
+
+
+def coerce_numeric(df, field, convert, default):
+    """ convert non-empty cells of df[field] to numbers, unparseable cells get default """
+
+    col = df[field]
+    present = col.notna() & (col.astype(str) != '')
+    values = pd.to_numeric(col.where(present), errors='coerce')
+    invalid = present & values.isna()
+    values = values.where(~invalid, default)
+
+    # python int/float instead of numpy scalars, which are not accepted by all DB drivers
+    df[field] = pd.Series([convert(v) if p else None for v, p in zip(values, present)],
+                          index=df.index, dtype=object)
+
+    return {idx: f'{field}: "{col[idx]}" is not a number, set to {default}'
+            for idx in df.index[invalid]}
+
+
+def coerce_date(df, field, today):
+    """ convert non-empty cells of df[field] to date; full ISO dates are parsed at once and
+        only the remaining cells are parsed by dateutil, using default_date for missing parts
+    """
+
+    col = df[field]
+    present = col.notna() & (col.astype(str) != '')
+    text = col[present].astype(str)
+    parsed = pd.to_datetime(text, format='%Y-%m-%d', errors='coerce')
+
+    errors = {}
+    default = datetime.datetime.combine(default_date, datetime.time())
+    for idx in parsed.index[parsed.isna()]:
+        try:
+            parsed[idx] = pd.Timestamp(dateutil.parser.parse(text[idx], default=default))
+        except (ValueError, OverflowError):
+            errors[idx] = f'{field}: invalid date "{text[idx]}"'
+
+    future = parsed > pd.Timestamp(today)
+    for idx in parsed.index[future]:
+        errors[idx] = f'{field}: invalid date in the future "{text[idx]}"'
+
+    dates = pd.Series(None, index=df.index, dtype=object)
+    valid = parsed.notna() & ~future
+    dates[valid[valid].index] = parsed[valid].dt.date
+    df[field] = dates
+
+    return errors
 
 
 # convert values to their proper format
@@ -471,6 +1127,10 @@ sample_converters = {
 }
 
 
+# date fields, parsed and checked against future dates
+sample_date_fields = ['collection_date', 'received_date', 'host_dob']
+
+
 # fill-in default values
 sample_defaults = {
     'host': 'no-species',
@@ -482,16 +1142,12 @@ sample_defaults = {
 }
 
 
+@register_upload_job
 class CollectionUploadJob(UploadJob):
 
     def __init__(self, user_id, filename, instream):
         super().__init__(user_id)
-        # save to memory
-        self.filename = filename
-        self.dicts = self.stream_to_dicts(instream)
-
-    def confirm(self):
-        pass
+        self.save_stream(filename, instream)
 
     def commit(self):
         pass
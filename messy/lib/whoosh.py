@@ -1,16 +1,23 @@
 
 # this class provide whoosh interface
 
-from whoosh.fields import SchemaClass, TEXT, ID, NUMERIC, STORED, KEYWORD
+from whoosh.fields import SchemaClass, TEXT, ID, NUMERIC, STORED, KEYWORD, BOOLEAN
 from whoosh.index import create_in, open_dir, exists_in
 from whoosh.qparser import QueryParser
-from whoosh.query import Term, FuzzyTerm
+from whoosh.query import Term, FuzzyTerm, And, Or
 
 from rhombus.models.meta import RhoSession
-from rhombus.lib.utils import get_dbhandler, cerr, cexit
-from sqlalchemy import event
+from rhombus.lib.utils import get_dbhandler, get_dbhandler_class, cerr, cexit
+from sqlalchemy import event, select, inspect
 
+import collections
+import contextlib
 import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
 
 
 class SearchScheme(SchemaClass):
@@ -20,25 +27,199 @@ class SearchScheme(SchemaClass):
     text = TEXT
 
 
+def create_schema(filters):
+    """ return SearchScheme with additional filter fields; fields ending with _id are
+        numeric (eg. group_id, collection_id), the others are boolean (eg. public)
+    """
+    schema = SearchScheme()
+    for f in filters:
+        schema.add(f, NUMERIC() if f.endswith('_id') else BOOLEAN())
+    return schema
+
+
 class Searchable(object):
 
-    __slots__ = ['dbid', 'mtime', 'text']
+    __slots__ = ['dbid', 'mtime', 'text', 'filters']
 
-    def __init__(self, dbid, mtime, text):
+    def __init__(self, dbid, mtime, text, filters=None):
         self.dbid = dbid
         self.mtime = mtime
         self.text = text
+        self.filters = filters or {}
 
 
 class ClassIndexer(object):
+    """ base class for the index of a single registered class; subclasses implement
+        the search backend (Whoosh or SQLite FTS5)
+    """
 
-    def __init__(self, ix, fields):
-        self.ix = ix
+    def __init__(self, fields, filters=()):
         self.fields = fields
+        self.filters = list(filters)
 
     def text(self, obj):
         return ' '.join((getattr(obj, f) or '') for f in self.fields)
 
+    def searchable(self, obj):
+        return Searchable(obj.id, obj.stamp, self.text(obj),
+                          {f: getattr(obj, f) for f in self.filters})
+
+    def check_filters(self, groups, filters):
+        if groups is not None and 'group_id' not in self.filters:
+            raise ValueError('search by groups requires group_id as filter field')
+        if filters and not set(filters).issubset(self.filters):
+            raise ValueError(f'unknown filter field(s): {set(filters) - set(self.filters)}')
+
+    def write(self, changeset):
+        """ apply ChangeSet to the index """
+        raise NotImplementedError()
+
+    def search(self, terms, limit=None, groups=None, filters=None):
+        """ return list of dbids matching any of the terms, ordered by score
+
+            groups: list of group ids, restricting the results to documents owned by
+                    the groups or flagged as public or refctrl
+            filters: {field: value} of exact match restriction
+        """
+        raise NotImplementedError()
+
+    def generation(self):
+        """ return a value that changes whenever the index content changes """
+        raise NotImplementedError()
+
+    def mtimes(self):
+        """ return {dbid: mtime} of all indexed documents """
+        raise NotImplementedError()
+
+    def rebuild(self, searchables, procs=None):
+        """ replace the whole index with searchables, return number of documents """
+        raise NotImplementedError()
+
+
+class WhooshClassIndexer(ClassIndexer):
+
+    def __init__(self, path, fields, filters=()):
+        super().__init__(fields, filters)
+        self.path = path
+
+        if not os.path.exists(path):
+            self.recover_swap()
+
+        if exists_in(path):
+            self.ix = open_dir(path)
+            if not set(self.filters).issubset(self.ix.schema.names()):
+                # index was created before the filter fields were declared
+                cerr(f'[WARN: recreating index at {path} to add filter fields, '
+                     f'run whoosh reindex to repopulate]')
+                self.ix = create_in(path, create_schema(self.filters))
+        else:
+            if not os.path.exists(path):
+                os.makedirs(path)
+            self.ix = create_in(path, create_schema(self.filters))
+
+        self.query_parser = QueryParser('text', schema=self.ix.schema, termclass=CustomFuzzyTerm)
+        self.swaps = 0
+        self.searcher = None
+        self.searcher_generation = None
+
+    def write(self, changeset):
+        with self.ix.writer() as writer:
+            for field, value in changeset.delete_terms:
+                writer.delete_by_term(field, value)
+            for dbid in changeset.deletes:
+                writer.delete_by_term('dbid', dbid)
+            for obj in changeset.upserts.values():
+                writer.update_document(dbid=obj.dbid, mtime=obj.mtime, text=obj.text,
+                                       **obj.filters)
+
+    def generation(self):
+        return (self.swaps, self.ix.latest_generation())
+
+    def search(self, terms, limit=None, groups=None, filters=None):
+
+        self.check_filters(groups, filters)
+
+        # reopen searcher only if the index has changed since it was opened
+        generation = self.generation()
+        if self.searcher is None or generation != self.searcher_generation:
+            if self.searcher is not None:
+                self.searcher.close()
+            self.searcher = self.ix.searcher()
+            self.searcher_generation = generation
+
+        query = self.query_parser.parse(' OR '.join(terms))
+        return [r['dbid'] for r in self.searcher.search(
+            query, limit=limit, filter=self.filter_query(groups, filters))]
+
+    def filter_query(self, groups, filters):
+        """ return query restricting the documents before scoring, or None """
+
+        clauses = [Term(f, v) for f, v in (filters or {}).items()]
+        if groups is not None:
+            clauses.append(Or([Term('group_id', gid) for gid in groups]
+                              + [Term(f, True) for f in ('public', 'refctrl')
+                                 if f in self.filters]))
+        if not clauses:
+            return None
+        return And(clauses)
+
+    def mtimes(self):
+        with self.ix.searcher() as searcher:
+            return {d['dbid']: d.get('mtime', None) for d in searcher.all_stored_fields()}
+
+    def rebuild(self, searchables, procs=None):
+        """ build a new index in a sibling directory using procs worker processes, then
+            swap it with the current index directory
+        """
+
+        procs = procs or os.cpu_count() or 1
+        parent_dir = os.path.dirname(os.path.normpath(self.path))
+        basename = os.path.basename(os.path.normpath(self.path))
+        new_path = tempfile.mkdtemp(prefix=f'.{basename}-new-', dir=parent_dir)
+        old_path = new_path.replace('-new-', '-old-')
+
+        try:
+            ix = create_in(new_path, create_schema(self.filters))
+            count = 0
+            with ix.writer(procs=procs, multisegment=(procs > 1)) as writer:
+                for obj in searchables:
+                    writer.add_document(dbid=obj.dbid, mtime=obj.mtime, text=obj.text,
+                                        **obj.filters)
+                    count += 1
+        except Exception:
+            shutil.rmtree(new_path, ignore_errors=True)
+            raise
+
+        # each rename is atomic, but the pair is not: in between, the index path does not
+        # exist and is restored from the old directory by recover_swap() if the process
+        # stops there
+        os.rename(self.path, old_path)
+        os.rename(new_path, self.path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+        self.ix = open_dir(self.path)
+        self.swaps += 1
+        return count
+
+    def recover_swap(self):
+        """ move back the old index directory of a rebuild interrupted during the swap """
+
+        parent_dir = os.path.dirname(os.path.normpath(self.path))
+        prefix = f'.{os.path.basename(os.path.normpath(self.path))}-old-'
+        if not os.path.isdir(parent_dir):
+            return
+        old_paths = sorted((os.path.join(parent_dir, d) for d in os.listdir(parent_dir)
+                            if d.startswith(prefix)), key=os.path.getmtime)
+        for old_path in reversed(old_paths):
+            if exists_in(old_path):
+                cerr(f'[WARN: restoring index at {self.path} from interrupted rebuild]')
+                try:
+                    os.rename(old_path, self.path)
+                except OSError:
+                    # the swap has been completed in the meantime
+                    pass
+                return
+
 
 class Updater(object):
 
@@ -49,14 +230,146 @@ class Updater(object):
         self.created_objects = {}
         self.updated_objects = {}
         self.deleted_objects = {}
+        self.deleted_terms = {}
+
+
+class ChangeSet(object):
+    """ merged index changes of a single class, ready to be written by one writer """
+
+    def __init__(self):
+        self.upserts = {}
+        self.deletes = set()
+        self.delete_terms = set()
+
+    def delete(self, dbid):
+        self.upserts.pop(dbid, None)
+        self.deletes.add(dbid)
+
+    def delete_term(self, field, value):
+        """ delete all documents whose filter field has value """
+        self.upserts = {dbid: obj for dbid, obj in self.upserts.items()
+                        if obj.filters.get(field, None) != value}
+        self.delete_terms.add((field, value))
+
+    def upsert(self, searchable):
+        self.deletes.discard(searchable.dbid)
+        self.upserts[searchable.dbid] = searchable
+
+
+def merge_changes(batches):
+    """ merge a list of (deleted_objects, created_objects, updated_objects, deleted_terms)
+        batches, in commit order, into {class_: ChangeSet}
+    """
+
+    changesets = {}
+    for deleted_objects, created_objects, updated_objects, deleted_terms in batches:
+
+        for class_, terms in deleted_terms.items():
+            cs = changesets.setdefault(class_, ChangeSet())
+            for field, value in terms:
+                cs.delete_term(field, value)
+
+        for class_, dbids in deleted_objects.items():
+            cs = changesets.setdefault(class_, ChangeSet())
+            for dbid in dbids:
+                cs.delete(dbid)
+
+        for objects in (created_objects, updated_objects):
+            for class_, searchables in objects.items():
+                cs = changesets.setdefault(class_, ChangeSet())
+                for obj in searchables.values():
+                    cs.upsert(obj)
+
+    return changesets
+
+
+class IndexWriterWorker(threading.Thread):
+    """ background thread that drains the queue of committed changes and writes
+        them to the Whoosh indexes, one writer per class per batch
+    """
+
+    def __init__(self, index_service, batch_size=1000, retries=3, retry_delay=1.0):
+        super().__init__(name='whoosh-index-writer', daemon=True)
+        self.index_service = index_service
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queue = queue.Queue()
+
+    def enqueue(self, deleted_objects, created_objects, updated_objects, deleted_terms):
+        self.queue.put((deleted_objects, created_objects, updated_objects, deleted_terms))
+
+    def barrier(self):
+        """ return an Event that will be set once all changes queued before it
+            have been written
+        """
+        event = threading.Event()
+        self.queue.put(event)
+        return event
+
+    def run(self):
+
+        while True:
+
+            # block for the first item, then drain whatever else is already queued
+            items = [self.queue.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            batches = []
+            for item in items:
+                if isinstance(item, threading.Event):
+                    # write everything queued before the barrier first
+                    self.write(batches)
+                    batches = []
+                    item.set()
+                else:
+                    batches.append(item)
+            self.write(batches)
+
+            for _ in items:
+                self.queue.task_done()
+
+    def write(self, batches):
+        """ write batches, retrying with increasing delay; changes that can not be written
+            mark their indexes as dirty
+        """
+        if not batches:
+            return
+        changesets = merge_changes(batches)
+        for attempt in range(self.retries + 1):
+            try:
+                # rewriting changesets that were partially written is harmless
+                self.index_service.write_changes(changesets)
+                return
+            except Exception as err:
+                cerr(f'[ERR: Whoosh background writer failed with error: {err}]')
+                if attempt < self.retries:
+                    time.sleep(self.retry_delay * 2 ** attempt)
+        self.index_service.mark_dirty(changesets.keys())
 
 
 class IndexService(object):
 
-    def __init__(self, basepath):
+    def __init__(self, basepath, background=False, backend='whoosh'):
         self.basepath = basepath
+        self.backend = backend
         self.cis = {}
 
+        # if background is True, after_commit only enqueues the changes and a single
+        # worker thread performs the actual index writing
+        self.worker = None
+        if background:
+            self.worker = IndexWriterWorker(self)
+            self.worker.start()
+
+        if (dirty := self.dirty_classes()):
+            cerr(f'[WARN: indexes of {", ".join(sorted(dirty))} are missing committed changes, '
+                 f'run messy-run mgr --whoosh_reindex]')
+
         event.listen(RhoSession, "after_flush", self.after_flush)
         event.listen(RhoSession, "after_commit", self.after_commit)
         event.listen(RhoSession, "after_rollback", self.after_rollback)
@@ -65,36 +378,59 @@ class IndexService(object):
         from messy.models import dbschema
         self.register_class(dbschema.EK, 'key', 'desc')
         self.register_class(dbschema.Institution)
+        self.register_class(dbschema.Sample)
+        self.register_class(dbschema.Collection)
+        self.register_class(dbschema.Plate)
+
+        # documents removed by the database cascade of a deleted object, as
+        # {class_: [(document class, filter field holding the id of the deleted object)]}
+        self.cascades = {dbschema.Collection: [(dbschema.Sample, 'collection_id')]}
+
+        # classes provided by extensions, if they are enabled
+        dbh_class = get_dbhandler_class()
+        for name in ['NGSRun', 'Panel']:
+            if hasattr(dbh_class, name):
+                self.register_class(getattr(dbh_class, name))
 
     def register_class(self, class_, *fields):
 
         if class_ in self.cis:
             raise RuntimeError(f'Class f{class_} is already registered in whoosh!')
 
-        path = os.path.join(self.basepath, class_.__name__)
-
-        if exists_in(path):
-            ix = open_dir(path)
-        else:
-            if not os.path.exists(path):
-                os.makedirs(path)
-            ix = create_in(path, SearchScheme)
-
         search_fields = list(getattr(class_, '__searchable__', []))
         if len(fields) > 0:
             search_fields = search_fields + list(fields)
 
-        self.cis[class_] = ClassIndexer(ix, search_fields)
+        filters = getattr(class_, '__searchable_filters__', [])
+        self.cis[class_] = self.create_class_indexer(class_, search_fields, filters)
         class_.search_text = TextSearcher(class_, self.cis[class_])
 
+    def create_class_indexer(self, class_, fields, filters=()):
+
+        if self.backend == 'whoosh':
+            return WhooshClassIndexer(os.path.join(self.basepath, class_.__name__), fields,
+                                      filters)
+
+        elif self.backend == 'sqlite':
+            from messy.lib.sqlitefts import SQLiteClassIndexer
+            os.makedirs(self.basepath, exist_ok=True)
+            return SQLiteClassIndexer(os.path.join(self.basepath, 'fts5.sqlite'),
+                                      class_.__name__, fields, filters)
+
+        raise ValueError(f'unknown search backend: {self.backend}')
+
     def after_flush(self, session, context):
+        with collection_groups(session, [*session.new, *session.dirty]):
+            self.update_objects(session)
+
+    def update_objects(self, session):
 
         updater = self.get_updater(session)
 
         for n in session.new:
             ci = self.cis.get(n.__class__, None)
             if ci:
-                s = Searchable(n.id, n.stamp, ci.text(n))
+                s = ci.searchable(n)
                 try:
                     updater.created_objects[n.__class__][n.id] = s
                 except KeyError:
@@ -103,7 +439,7 @@ class IndexService(object):
         for n in session.dirty:
             ci = self.cis.get(n.__class__, None)
             if ci:
-                s = Searchable(n.id, n.stamp, ci.text(n))
+                s = ci.searchable(n)
                 try:
                     updater.updated_objects[n.__class__][n.id] = s
                 except KeyError:
@@ -116,33 +452,87 @@ class IndexService(object):
                     updater.deleted_objects[n.__class__][n.id] = None
                 except KeyError:
                     updater.deleted_objects[n.__class__] = {n.id: None}
+            for class_, field in self.cascades.get(n.__class__, []):
+                if class_ in self.cis:
+                    updater.deleted_terms.setdefault(class_, {})[(field, n.id)] = None
 
     def after_commit(self, session):
 
         updater = self.get_updater(session)
+        batch = (updater.deleted_objects, updater.created_objects, updater.updated_objects,
+                 updater.deleted_terms)
+        # reset() creates new dictionaries, so the batch above is safe to be passed around
+        updater.reset()
 
-        for class_ in updater.deleted_objects:
-            with self.cis[class_].ix.writer() as writer:
-                for dbid in updater.deleted_objects[class_]:
-                    writer.delete_by_term('dbid', dbid)
+        if not any(batch):
+            return
 
-        for class_ in updater.created_objects:
-            with self.cis[class_].ix.writer() as writer:
-                for obj in updater.created_objects[class_].values():
-                    writer.add_document(dbid=obj.dbid, mtime=obj.mtime, text=obj.text)
+        if self.worker:
+            self.worker.enqueue(*batch)
+        else:
+            self.write_changes(merge_changes([batch]))
+
+    def write_changes(self, changesets):
+        """ write {class_: ChangeSet} to the indexes, using a single writer per class """
+
+        for class_, cs in changesets.items():
+            self.cis[class_].write(cs)
+
+    def dirty_path(self):
+        return os.path.join(self.basepath, 'DIRTY')
+
+    def dirty_classes(self):
+        """ return set of class names whose indexes are missing committed changes """
+        if not os.path.exists(self.dirty_path()):
+            return set()
+        with open(self.dirty_path()) as f:
+            return {line.strip() for line in f if line.strip()}
+
+    def mark_dirty(self, classes):
+        """ record classes whose indexes are missing committed changes, until the next
+            reindex()
+        """
+        names = [class_.__name__ for class_ in classes]
+        os.makedirs(self.basepath, exist_ok=True)
+        with open(self.dirty_path(), 'a') as f:
+            f.writelines(f'{name}\n' for name in names)
+        cerr(f'[ERR: indexes of {", ".join(names)} are missing committed changes, '
+             f'run messy-run mgr --whoosh_reindex]')
+
+    def clear_dirty(self):
+        if os.path.exists(self.dirty_path()):
+            os.remove(self.dirty_path())
+
+    def flush(self, timeout=None):
+        """ wait until all changes committed so far have been written to the indexes,
+            return False if timeout expires before that
+        """
+        if not self.worker:
+            return True
+        return self.worker.barrier().wait(timeout)
 
-        for class_ in updater.updated_objects:
-            with self.cis[class_].ix.writer() as writer:
-                for obj in updater.updated_objects[class_].values():
-                    writer.delete_by_term('dbid', obj.dbid)
-                    writer.add_document(dbid=obj.dbid, mtime=obj.mtime, text=obj.text)
+    def after_rollback(self, session):
 
+        updater = self.get_updater(session)
         updater.reset()
 
-    def after_rollback(self, session):
+    def reindex_objects(self, session, class_, dbids, chunk_size=500):
+        """ queue the documents of class_ with dbids to be rewritten when session commits,
+            for changes that bypass the unit of work (eg. set-based UPDATE statements)
+            and hence are not seen by after_flush()
+        """
+
+        if (ci := self.cis.get(class_, None)) is None:
+            return
 
         updater = self.get_updater(session)
-        updater.reset()
+        searchables = updater.updated_objects.setdefault(class_, {})
+        dbids = list(dbids)
+        for i in range(0, len(dbids), chunk_size):
+            objs = hydrate(class_, dbids[i:i + chunk_size], session, populate=True)
+            with collection_groups(session, objs):
+                for obj in objs:
+                    searchables[obj.id] = ci.searchable(obj)
 
     def get_updater(self, session):
 
@@ -170,21 +560,105 @@ def get_index_service():
     return _INDEX_SERVICE_
 
 
+def reindex_objects(session, class_, dbids):
+    """ queue documents of class_ with dbids for reindexing, if an IndexService is set """
+    if _INDEX_SERVICE_ is not None:
+        _INDEX_SERVICE_.reindex_objects(session, class_, dbids)
+
+
+def create_index_service(settings):
+    """ create IndexService based on configuration settings """
+    from messy import configkeys as ck
+    from pyramid.settings import asbool
+    return IndexService(settings[ck.msy_whoosh_path],
+                        background=asbool(settings.get(ck.msy_whoosh_background, False)),
+                        backend=settings.get(ck.msy_search_backend, 'whoosh'))
+
+
 # utilities
 
-def reindex():
+def reindex(full=False, procs=None, chunk_size=1000):
+    """ synchronize the indexes of all registered classes with the database
+
+        incremental mode (default) compares the stored mtime of each document with
+        the stamp of its database row, and only rewrites changed documents and drops
+        documents whose ids no longer exist.
+        full mode rebuilds each index from scratch and swaps it in place; the Whoosh
+        backend builds the new segments using procs worker processes.
+        indexes marked as dirty by failed background writes are clean afterwards.
+    """
 
     dbh = get_dbhandler()
     index_service = get_index_service()
 
-    for class_ in index_service.cis:
-        ci = index_service.cis[class_]
-        with ci.ix.writer() as writer:
+    for class_, ci in index_service.cis.items():
+        start_time = time.monotonic()
+        if full:
+            counts = rebuild_class_index(class_, ci, dbh.session(), procs, chunk_size)
+            msg = f'{counts} indexed'
+        else:
+            updated, deleted = update_class_index(class_, ci, dbh.session(), chunk_size)
+            msg = f'{updated} updated, {deleted} deleted'
+        cerr(f'[reindex {class_.__name__}: {msg} in {time.monotonic() - start_time:.1f}s]')
+
+    index_service.clear_dirty()
+
+
+def update_class_index(class_, ci, session, chunk_size=1000):
+    """ incrementally update index of class_, return (updated, deleted) counts """
+
+    indexed = ci.mtimes()
+    stamps = dict(session.query(class_.id, class_.stamp))
+
+    changed_ids = [dbid for dbid, stamp in stamps.items() if indexed.get(dbid, None) != stamp]
+    deleted_ids = [dbid for dbid in indexed if dbid not in stamps]
 
-            for obj in class_.query(dbh.session()):
-                writer.delete_by_term('dbid', obj.id)
-                writer.add_document(dbid=obj.id, mtime=obj.stamp, text=ci.text(obj))
-                cerr(f'reindex {class_.__name__}: {obj.id}')
+    cs = ChangeSet()
+    for dbid in deleted_ids:
+        cs.delete(dbid)
+    for i in range(0, len(changed_ids), chunk_size):
+        for obj in hydrate(class_, changed_ids[i:i + chunk_size], session,
+                           chunk_size=chunk_size):
+            cs.upsert(ci.searchable(obj))
+
+    if cs.deletes or cs.upserts:
+        ci.write(cs)
+
+    return len(changed_ids), len(deleted_ids)
+
+
+@contextlib.contextmanager
+def collection_groups(session, objs):
+    """ resolve the group ids of the collections of the samples in objs with a single
+        query, to be used by Sample.group_id instead of loading the collection of each
+        sample while their searchables are built
+    """
+
+    from messy.models.dbschema import Sample, Collection
+
+    collection_ids = {obj.collection_id for obj in objs if isinstance(obj, Sample)
+                      and 'collection' not in inspect(obj).dict}
+    if not collection_ids:
+        yield
+        return
+
+    session.info['collection_group_ids'] = dict(session.execute(
+        select(Collection.id, Collection.group_id).where(Collection.id.in_(collection_ids))
+    ).all())
+    try:
+        yield
+    finally:
+        session.info.pop('collection_group_ids', None)
+
+
+def rebuild_class_index(class_, ci, session, procs=None, chunk_size=1000):
+    """ rebuild the whole index of class_, return the number of indexed documents """
+
+    return ci.rebuild(
+        (ci.searchable(obj)
+         for obj in class_.query(session).yield_per(chunk_size)),
+        procs=procs
+    )
 
 
 class CustomFuzzyTerm(FuzzyTerm):
@@ -197,21 +671,87 @@ class CustomFuzzyTerm(FuzzyTerm):
 
 
 class TextSearcher(object):
+    """ callable to search text of a registered class
 
-    def __init__(self, class_, ci):
+        the backend keeps its searcher open across calls, and results (as dbids) are
+        cached in an LRU cache which is cleared whenever the index generation changes
+    """
+
+    def __init__(self, class_, ci, cache_size=4096):
         self.class_ = class_
         self.ci = ci
-        self.query_parser = QueryParser('text', schema=ci.ix.schema, termclass=CustomFuzzyTerm)
-
-    def __call__(self, text, session, limit=None, id_only=False):
-
-        text = ' OR '.join(text.replace(' or ', ' ').replace(' and ', ' ').split())
-        query = self.query_parser.parse(text)
-        with self.ci.ix.searcher() as searcher:
-            results = searcher.search(query, limit=limit)
-            dbids = [r['dbid'] for r in results]
+        self.lock = threading.Lock()
+        self.generation = None
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.hits = self.misses = 0
+
+    def __call__(self, text, session, limit=None, id_only=False, options=None,
+                 groups=None, filters=None):
+        """ return objects (or dbids if id_only is True) matching text, ordered by
+            score; options are SQLAlchemy loader options (eg. selectinload) applied
+            when hydrating the objects.
+            groups (list of group ids) and filters ({field: value}) restrict the
+            results inside the index, see ClassIndexer.search()
+        """
+
+        terms = text.replace(' or ', ' ').replace(' and ', ' ').split()
+        dbids = self.search(terms, limit, groups, filters)
         if id_only:
             return dbids
-        return [self.class_.query(session).get(dbid) for dbid in dbids]
+        return hydrate(self.class_, dbids, session, options=options)
+
+    def search(self, terms, limit, groups=None, filters=None):
+        """ return a list of dbids matching any of the terms """
+
+        key = (tuple(terms), limit,
+               None if groups is None else tuple(sorted(groups)),
+               tuple(sorted((filters or {}).items())))
+        with self.lock:
+
+            generation = self.ci.generation()
+            if generation != self.generation:
+                self.cache.clear()
+                self.generation = generation
+
+            try:
+                dbids = self.cache[key]
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return list(dbids)
+            except KeyError:
+                self.misses += 1
+
+            dbids = self.ci.search(terms, limit, groups, filters)
+
+            self.cache[key] = tuple(dbids)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return dbids
+
+    def cache_info(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self.cache),
+                    generation=self.generation)
+
+
+def hydrate(class_, dbids, session, options=None, chunk_size=500, populate=False):
+    """ load objects of class_ with ids in dbids using IN (...) queries of at most
+        chunk_size ids, and return them in the same order as dbids; ids that no longer
+        exist in the database are skipped. if populate is True, objects already in the
+        session are refreshed with the current database values
+    """
+
+    objects = {}
+    for i in range(0, len(dbids), chunk_size):
+        q = class_.query(session).filter(class_.id.in_(dbids[i:i + chunk_size]))
+        if options:
+            q = q.options(*options)
+        if populate:
+            q = q.populate_existing()
+        for obj in q:
+            objects[obj.id] = obj
+
+    return [objects[dbid] for dbid in dbids if dbid in objects]
 
 # EOF
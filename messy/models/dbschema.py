@@ -2,11 +2,12 @@
 from rhombus.lib.utils import cerr, cout, get_dbhandler
 from rhombus.models.core import (Base, BaseMixIn, metadata, deferred, relationship,
                                  registered, declared_attr, column_property)
-from rhombus.models.ek import EK
+from messy.lib.ekcache import ek_proxy
 from rhombus.models.user import Group, User
 from rhombus.models.fileattach import FileAttachment
 from rhombus.models.auxtypes import GUID
 import messy.lib.roles as r
+from messy.lib.acl import get_acl_context
 from messy.lib import nomenclature
 import dateutil.parser
 import datetime
@@ -14,7 +15,7 @@ from sqlalchemy.sql import func, False_
 from sqlalchemy.orm import object_session
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy import (exists, Table, Column, types, ForeignKey, UniqueConstraint,
-                        Identity, select)
+                        Identity, select, inspect)
 
 from pathlib import Path
 
@@ -92,7 +93,7 @@ class Institution(BaseMixIn, Base):
 
     @classmethod
     def can_modify(cls, user):
-        if user.has_roles(* cls.__managing_roles__):
+        if get_acl_context(user).has_roles(* cls.__managing_roles__):
             return True
         return False
 
@@ -155,6 +156,9 @@ class Collection(BaseMixIn, Base):
                                     collection_class=attribute_mapped_collection('id'),
                                     order_by=FileAttachment.filename)
 
+    __searchable__ = ['code', 'description']
+    __searchable_filters__ = ['group_id', 'public', 'refctrl']
+
     __managing_roles__ = BaseMixIn.__managing_roles__ | {r.COLLECTION_MANAGE}
     __modifying_roles__ = __managing_roles__ | {r.COLLECTION_MODIFY}
 
@@ -167,6 +171,10 @@ class Collection(BaseMixIn, Base):
 
             dbh = get_dbhandler()
 
+            from messy.lib import propagation
+            flags = propagation.collection_flags(self) if self.id else None
+            group_id = self.group_id
+
             if 'group' in obj:
                 self.group_id = dbh.get_group(obj['group']).id
 
@@ -180,6 +188,14 @@ class Collection(BaseMixIn, Base):
 
             self.update_fields_with_dict(obj, additional_fields=['attachment'])
 
+            # propagate changed flags to all samples with a single UPDATE statement
+            if flags is not None and flags != propagation.collection_flags(self):
+                propagation.propagate_collection(self)
+
+            # sample search documents hold the group id of their collection as ACL filter
+            if flags is not None and group_id != self.group_id:
+                propagation.reindex_samples(self)
+
             # check if UUID still  None, then create one
             if self.uuid is None:
                 self.uuid = GUID.new()
@@ -189,9 +205,10 @@ class Collection(BaseMixIn, Base):
         return self
 
     def can_upload(self, user):
-        if user.has_roles(* self.__managing_roles__):
+        acl = get_acl_context(user)
+        if acl.has_roles(* self.__managing_roles__):
             return True
-        if user.in_group(self.group):
+        if acl.in_group(self.group_id):
             return True
         return False
 
@@ -199,9 +216,10 @@ class Collection(BaseMixIn, Base):
         return self.code
 
     def can_modify(self, user):
-        if user.has_roles(* self.__managing_roles__):
+        acl = get_acl_context(user)
+        if acl.has_roles(* self.__managing_roles__):
             return True
-        if user.has_roles(* self.__modifying_roles__) and user.in_group(self.group):
+        if acl.has_roles(* self.__modifying_roles__) and acl.in_group(self.group_id):
             return True
         return False
 
@@ -209,7 +227,9 @@ class Collection(BaseMixIn, Base):
         d = super().as_dict(exclude=['institutions', 'samples'])
         d['institutions'] = [inst.code for inst in self.institutions]
         if export_samples:
-            d['samples'] = [samp.as_dict() for samp in self.samples]
+            dbh = get_dbhandler()
+            d['samples'] = [samp.as_dict()
+                            for samp in dbh.apply_load(self.samples, dbh.Sample, 'export')]
         return d
 
     @classmethod
@@ -267,10 +287,10 @@ class Sample(BaseMixIn, Base):
     related_sample_id = Column(types.Integer, ForeignKey('samples.id'), nullable=True)
 
     species_id = Column(types.Integer, ForeignKey('eks.id'), nullable=False)
-    species = EK.proxy('species_id', '@SPECIES', 'no-species')
+    species = ek_proxy('species_id', '@SPECIES', 'no-species')
 
     passage_id = Column(types.Integer, ForeignKey('eks.id'), nullable=False)
-    passage = EK.proxy('passage_id', '@PASSAGE', default='original')
+    passage = ek_proxy('passage_id', '@PASSAGE', default='original')
 
     collection_date = Column(types.Date, index=True, nullable=False)
     location = Column(types.String(64), nullable=False, index=True, server_default='')
@@ -283,13 +303,13 @@ class Sample(BaseMixIn, Base):
     day = Column(types.Integer, nullable=False, server_default='0')
 
     category_id = Column(types.Integer, ForeignKey('eks.id'), nullable=False)
-    category = EK.proxy('category_id', '@CATEGORY')
+    category = ek_proxy('category_id', '@CATEGORY')
 
     specimen_type_id = Column(types.Integer, ForeignKey('eks.id'), nullable=False)
-    specimen_type = EK.proxy('specimen_type_id', '@SPECIMEN_TYPE')
+    specimen_type = ek_proxy('specimen_type_id', '@SPECIMEN_TYPE')
 
     # ct_method_id = Column(types.Integer, ForeignKey('eks.id'), nullable=False)
-    # ct_method = EK.proxy('ct_method_id', '@CT_METHOD')
+    # ct_method = ek_proxy('ct_method_id', '@CT_METHOD')
 
     # ct_info = Column(types.String(64), nullable=False, server_default='')
 
@@ -311,12 +331,12 @@ class Sample(BaseMixIn, Base):
 
     # host related information
     host_id = Column(types.Integer, ForeignKey('eks.id'), nullable=False)
-    host = EK.proxy('host_id', '@SPECIES')
+    host = ek_proxy('host_id', '@SPECIES')
 
     host_info = Column(types.String(64), nullable=False, server_default='')
 
     host_status_id = Column(types.Integer, ForeignKey('eks.id'), nullable=False)
-    host_status = EK.proxy('host_status_id', '@HOST_STATUS')
+    host_status = ek_proxy('host_status_id', '@HOST_STATUS')
 
     host_severity = Column(types.Integer, nullable=False, server_default='-1')
 
@@ -374,6 +394,11 @@ class Sample(BaseMixIn, Base):
     #__ek_fields__ = ['species', 'passage', 'host', 'host_status', 'host_occupation',
     #                 'specimen_type', 'category']
 
+    __searchable__ = ['code', 'acc_code', 'originating_code', 'sampling_code',
+                      'location', 'location_info', 'host_info']
+    # fields used for restricting search results (eg. ACL) inside the index
+    __searchable_filters__ = ['collection_id', 'group_id', 'public', 'refctrl']
+
     __managing_roles__ = BaseMixIn.__managing_roles__ | {r.SAMPLE_MANAGE}
     __modifying_roles__ = __managing_roles__ | {r.SAMPLE_MODIFY}
 
@@ -387,6 +412,19 @@ class Sample(BaseMixIn, Base):
     def __repr__(self):
         return f"Sample('{self.code}')"
 
+    @property
+    def group_id(self):
+        """ samples are owned by the group of their collection; group ids resolved in bulk
+            for the session (eg. by the index service for flushed samples) are used when
+            the collection is not loaded
+        """
+        if 'collection' not in inspect(self).dict and \
+                (session := object_session(self)) is not None:
+            group_ids = session.info.get('collection_group_ids', None) or {}
+            if (group_id := group_ids.get(self.collection_id, None)) is not None:
+                return group_id
+        return self.collection.group_id
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -452,9 +490,11 @@ class Sample(BaseMixIn, Base):
     # access control
 
     def can_modify(self, user):
-        if user.has_roles(* self.__managing_roles__):
+        acl = get_acl_context(user)
+        if acl.has_roles(* self.__managing_roles__):
             return True
-        if user.has_roles(* self.__modifying_roles__) and user.in_group(self.collection.group):
+        if (acl.has_roles(* self.__modifying_roles__)
+                and acl.in_group(self.collection.group_id)):
             return True
         return False
 
@@ -530,10 +570,10 @@ class Plate(BaseMixIn, Base):
     date = Column(types.Date, nullable=False, server_default=func.current_date())
 
     specimen_type_id = Column(types.Integer, ForeignKey('eks.id'), nullable=False)
-    specimen_type = EK.proxy('specimen_type_id', '@SPECIMEN_TYPE')
+    specimen_type = ek_proxy('specimen_type_id', '@SPECIMEN_TYPE')
 
     experiment_type_id = Column(types.Integer, ForeignKey('eks.id'), nullable=False)
-    experiment_type = EK.proxy('experiment_type_id', '@EXPERIMENT_TYPE')
+    experiment_type = ek_proxy('experiment_type_id', '@EXPERIMENT_TYPE')
 
     storage = deferred(Column(types.String(64), nullable=False, server_default=''))
     remark = deferred(Column(types.Text, nullable=False, server_default=''))
@@ -553,6 +593,9 @@ class Plate(BaseMixIn, Base):
     positions = relationship(PlatePosition, order_by='PlatePosition.id', passive_deletes=True,
                              back_populates='plate')
 
+    __searchable__ = ['code']
+    __searchable_filters__ = ['group_id']
+
     __managing_roles__ = BaseMixIn.__managing_roles__ | {r.PLATE_MANAGE}
     __modifying_roles__ = __managing_roles__ | {r.PLATE_MODIFY}
 
@@ -613,9 +656,10 @@ class Plate(BaseMixIn, Base):
         return self.code
 
     def can_modify(self, user):
-        if user.has_roles(* self.__managing_roles__):
+        acl = get_acl_context(user)
+        if acl.has_roles(* self.__managing_roles__):
             return True
-        if user.has_roles(* self.__modifying_roles__) and user.in_group(self.group):
+        if acl.has_roles(* self.__modifying_roles__) and acl.in_group(self.group_id):
             return True
         return False
 
@@ -697,7 +741,8 @@ class UploadJob(BaseMixIn, Base):
         return self.__root_storage_path__
 
     def can_modify(self, user):
-        return user.is_admin() or (self.user_id == user.id)
+        acl = get_acl_context(user)
+        return acl.is_admin or (self.user_id == acl.user_id)
 
     def get_uploaded_count(self):
         count = 0
@@ -791,4 +836,65 @@ class UploadItem(BaseMixIn, Base):
         items = cls.query(dbh.session()).filter(cls.key == key).all()
         return items[0]
 
+
+# background jobs, claimed and executed by the worker processes of messy.lib.jobs
+
+class Job(BaseMixIn, Base):
+
+    __tablename__ = 'jobs'
+
+    user_id = Column(types.Integer, ForeignKey('users.id'), nullable=False)
+    user = relationship('User', uselist=False, foreign_keys=user_id)
+
+    job_type = Column(types.String(32), nullable=False)
+
+    # pending, running, completed or failed
+    status = Column(types.String(16), nullable=False, server_default='pending', index=True)
+
+    params = Column(types.JSON, nullable=False, server_default='null')
+    result = Column(types.JSON, nullable=True)
+
+    # percentage of completion and the latest progress message
+    progress = Column(types.Integer, nullable=False, server_default='0')
+    message = Column(types.String(256), nullable=False, server_default='')
+    log = deferred(Column(types.Text, nullable=False, server_default=''))
+
+    # worker holding the job, valid until lease_until unless renewed
+    worker = Column(types.String(64), nullable=False, server_default='')
+    lease_until = Column(types.DateTime, nullable=True)
+
+    submit_time = Column(types.DateTime, nullable=False, server_default=func.now())
+    start_time = Column(types.DateTime, nullable=True)
+    finish_time = Column(types.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<Job {self.id}: {self.job_type} [{self.status}]>'
+
+    def can_modify(self, user):
+        acl = get_acl_context(user)
+        return acl.is_admin or (self.user_id == acl.user_id)
+
+    def is_finished(self):
+        return self.status in ('completed', 'failed')
+
+
+class StatCounter(Base):
+    """ data statistics maintained incrementally by messy.lib.stats, eg. ('samples', 0) or
+        ('samples.species', species_id)
+    """
+
+    __tablename__ = 'statcounters'
+
+    id = Column(types.Integer, Identity(), primary_key=True)
+    name = Column(types.String(32), nullable=False)
+    key = Column(types.Integer, nullable=False, server_default='0')
+    value = Column(types.Integer, nullable=False, server_default='0')
+
+    __table_args__ = (
+        UniqueConstraint('name', 'key'),
+    )
+
+    def __repr__(self):
+        return f'<StatCounter {self.name}[{self.key}] = {self.value}>'
+
 # EOF
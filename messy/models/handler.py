@@ -5,8 +5,11 @@ from rhombus.lib.utils import cerr, cout
 # from .setup import setup
 
 from messy.models import dbschema
-from messy.lib import roles as r
+from messy.lib.ekcache import get_ek_cache
+from messy.lib.acl import get_acl_context
+from messy.lib import stats     # noqa: F401, registers the statistic counter listeners
 from sqlalchemy import or_, and_
+from sqlalchemy.orm import aliased, joinedload, selectinload, undefer
 
 
 class MessyQueryConstructor(rhombus_handler.QueryConstructor):
@@ -30,9 +33,53 @@ class MessyQueryConstructor(rhombus_handler.QueryConstructor):
         'uploadjob_id': dbschema.UploadJob.id,
         'uploadjob_sesskey': dbschema.UploadJob.sesskey,
         'uploaditem_id': dbschema.UploadItem.id,
+
+        'job_id': dbschema.Job.id,
     }
 
 
+_S = dbschema.Sample
+_C = dbschema.Collection
+_P = dbschema.Plate
+_PP = dbschema.PlatePosition
+
+# named eager-loading profiles, {class: {profile: [loader options]}}:
+#   list    - attributes shown in index tables
+#   detail  - attributes shown in single object views
+#   export  - everything read by as_dict(), including the deferred columns
+load_profiles = {
+    _S: {
+        'list': [joinedload(_S.collection)],
+        'detail': [joinedload(_S.collection), joinedload(_S.originating_institution),
+                   joinedload(_S.sampling_institution), joinedload(_S.attachment_file),
+                   selectinload(_S.additional_files), undefer(_S.remark), undefer(_S.comment)],
+        'export': [joinedload(_S.collection), joinedload(_S.originating_institution),
+                   joinedload(_S.sampling_institution), joinedload(_S.attachment_file),
+                   undefer(_S.remark), undefer(_S.comment), undefer(_S.extdata)],
+    },
+    _C: {
+        'list': [joinedload(_C.group)],
+        'detail': [joinedload(_C.group), selectinload(_C.institutions),
+                   joinedload(_C.attachment_file), selectinload(_C.additional_files),
+                   undefer(_C.remark), undefer(_C.data), undefer(_C.contact)],
+        'export': [joinedload(_C.group), selectinload(_C.institutions),
+                   joinedload(_C.attachment_file), undefer(_C.remark), undefer(_C.data),
+                   undefer(_C.contact)],
+    },
+    _P: {
+        'list': [joinedload(_P.user), undefer(_P.remark)],
+        'detail': [joinedload(_P.user), joinedload(_P.group), joinedload(_P.attachment_file),
+                   selectinload(_P.additional_files),
+                   selectinload(_P.positions).joinedload(_PP.sample),
+                   undefer(_P.remark), undefer(_P.storage)],
+        'export': [joinedload(_P.user), joinedload(_P.group), joinedload(_P.attachment_file),
+                   selectinload(_P.additional_files),
+                   selectinload(_P.positions).joinedload(_PP.sample),
+                   undefer(_P.remark), undefer(_P.storage)],
+    },
+}
+
+
 class DBHandler(rhombus_handler.DBHandler):
 
     # add additional class references
@@ -44,9 +91,13 @@ class DBHandler(rhombus_handler.DBHandler):
     PlatePosition = dbschema.PlatePosition
     UploadJob = dbschema.UploadJob
     UploadItem = dbschema.UploadItem
+    Job = dbschema.Job
+    StatCounter = dbschema.StatCounter
 
     query_constructor_class = MessyQueryConstructor
 
+    load_profiles = load_profiles
+
     def initdb(self, create_table=True, init_data=True, rootpasswd=None, ek_initlist=[]):
         """ initialize database """
         from .setup import ek_initlist as messy_ek_initlist
@@ -68,6 +119,15 @@ class DBHandler(rhombus_handler.DBHandler):
             raise rhombus_handler.exc.NoResultFound()
         return res
 
+    def apply_load(self, q, class_, load=None):
+        """ add loader options of the named load profile of class_ to query or select q """
+        if load is None:
+            return q
+        try:
+            return q.options(* self.load_profiles[class_][load])
+        except KeyError:
+            raise ValueError(f'ERR: unknown load profile {load} for {class_.__name__}')
+
     # Institutions
 
     def get_institutions(self, groups=None, specs=None, user=None, fetch=True,
@@ -91,11 +151,12 @@ class DBHandler(rhombus_handler.DBHandler):
     # Collections
 
     def get_collections(self, groups, specs=None, user=None, fetch=True, raise_if_empty=False,
-                        ignore_acl=False):
+                        ignore_acl=False, load=None):
 
-        q = self.construct_query(self.Collection, specs)
+        q = self.apply_load(self.construct_query(self.Collection, specs), self.Collection, load)
 
-        if user and user.has_roles(r.SYSADM, r.DATAADM, r.COLLECTION_MANAGE):
+        acl = get_acl_context(user)
+        if acl and acl.collection_manager:
             ignore_acl = True
             groups = None
 
@@ -103,12 +164,15 @@ class DBHandler(rhombus_handler.DBHandler):
             raise ValueError(
                 'ERR: get_collections() - either groups or user needs to be provided !')
 
-        if not ignore_acl and groups is None:
-            groups = user.groups
+        group_ids = None
+        if not ignore_acl:
+            group_ids = acl.group_ids if groups is None else [x[1] for x in groups]
+        elif groups is not None:
+            group_ids = [x[1] for x in groups]
 
-        if groups is not None:
+        if group_ids is not None:
             # enforce security
-            cond = (self.Collection.group_id.in_([x[1] for x in groups]))
+            cond = (self.Collection.group_id.in_(group_ids))
             q = q.filter(or_(self.Collection.public, self.Collection.refctrl, cond))
 
         if fetch:
@@ -117,26 +181,29 @@ class DBHandler(rhombus_handler.DBHandler):
         return self.fix_result(q, fetch, raise_if_empty)
 
     def get_collections_by_ids(self, ids, groups, user=None, fetch=True, raise_if_empty=False,
-                               ignore_acl=False):
+                               ignore_acl=False, load=None):
         return self.get_collections(groups, [{'collection_id': ids}], user=user, fetch=fetch,
-                                    raise_if_empty=raise_if_empty, ignore_acl=ignore_acl)
+                                    raise_if_empty=raise_if_empty, ignore_acl=ignore_acl,
+                                    load=load)
 
     def get_collections_by_codes(self, codes, groups, user=None, fetch=True, raise_if_empty=False,
-                                 ignore_acl=False):
+                                 ignore_acl=False, load=None):
         return self.get_collections(groups, [{'collection_code': codes}], user=user, fetch=fetch,
-                                    raise_if_empty=raise_if_empty, ignore_acl=ignore_acl)
+                                    raise_if_empty=raise_if_empty, ignore_acl=ignore_acl,
+                                    load=load)
 
     #
     # Samples
 
     def get_samples(self, groups, specs=None, user=None, fetch=True, raise_if_empty=False,
-                    ignore_acl=False):
+                    ignore_acl=False, load=None):
 
-        if user.has_roles(r.SYSADM, r.DATAADM, r.SAMPLE_MANAGE):
+        acl = get_acl_context(user)
+        if acl and acl.sample_manager:
             ignore_acl = True
             groups = None
 
-        q = self.construct_query(self.Sample, specs)
+        q = self.apply_load(self.construct_query(self.Sample, specs), self.Sample, load)
 
         # if groups is not None, we need to join sample with collection to get
         # all samples under collections owned by certain groups to enforce security
@@ -144,14 +211,16 @@ class DBHandler(rhombus_handler.DBHandler):
         if not ignore_acl and groups is None and user is None:
             raise ValueError('ERR: get_samples() - either groups or user needs to be provided!')
 
-        if not ignore_acl and groups is None:
-            if not user.has_roles(r.SYSADM, r.DATAADM, r.SAMPLE_MANAGE):
-                groups = user.groups
+        group_ids = None
+        if not ignore_acl:
+            group_ids = acl.group_ids if groups is None else [x[1] for x in groups]
+        elif groups is not None:
+            group_ids = [x[1] for x in groups]
 
-        if groups is not None:
+        if group_ids is not None:
             q = self.rejoin(q, self.Collection).filter(
                 or_(self.Sample.public, self.Sample.refctrl,
-                    self.Collection.group_id.in_([x[1] for x in groups]))
+                    self.Collection.group_id.in_(group_ids))
             )
 
         if fetch:
@@ -160,21 +229,94 @@ class DBHandler(rhombus_handler.DBHandler):
         return self.fix_result(q, fetch, raise_if_empty)
 
     def get_samples_by_ids(self, ids, groups, user=None, fetch=True, raise_if_empty=False,
-                           ignore_acl=False):
+                           ignore_acl=False, load=None):
         return self.get_samples(groups, [{'sample_id': ids}], user=user, fetch=fetch,
-                                raise_if_empty=raise_if_empty, ignore_acl=ignore_acl)
+                                raise_if_empty=raise_if_empty, ignore_acl=ignore_acl, load=load)
 
     def get_samples_by_codes(self, codes, groups, user=None, fetch=True, raise_if_empty=False,
-                             ignore_acl=False):
+                             ignore_acl=False, load=None):
         return self.get_samples(groups, [{'sample_code': codes}], user=user, fetch=fetch,
-                                raise_if_empty=raise_if_empty, ignore_acl=ignore_acl)
+                                raise_if_empty=raise_if_empty, ignore_acl=ignore_acl, load=load)
+
+    def get_sample_rows(self, groups, fields, specs=None, user=None, ignore_acl=False):
+        """ return query of named tuples of sample fields, with the same ACL as get_samples();
+            collection, institutions and EK fields are resolved to their codes or keys by
+            joins in the same query instead of per-row lazy loads
+        """
+
+        Sample = self.Sample
+        q = self.rejoin(
+            self.get_samples(groups, specs, user=user, fetch=False, ignore_acl=ignore_acl),
+            self.Collection
+        )
+
+        columns = []
+        for f in fields:
+            if f == 'collection':
+                columns.append(self.Collection.code.label(f))
+            elif f in ('originating_institution', 'sampling_institution'):
+                inst = aliased(self.Institution)
+                q = q.outerjoin(inst, getattr(Sample, f'{f}_id') == inst.id)
+                columns.append(inst.code.label(f))
+            elif self.is_ek_field(Sample, f):
+                ek = aliased(self.EK)
+                q = q.outerjoin(ek, getattr(Sample, f'{f}_id') == ek.id)
+                columns.append(ek.key.label(f))
+            else:
+                columns.append(getattr(Sample, f).label(f))
+
+        return q.with_entities(*columns)
+
+    def is_ek_field(self, class_, field):
+        """ check whether field is an EK proxy of class_, ie. backed by a field_id column
+            referencing EK table
+        """
+        column = class_.__table__.columns.get(f'{field}_id', None)
+        return (column is not None and field not in class_.__table__.columns
+                and any(fk.column.table is self.EK.__table__ for fk in column.foreign_keys))
+
+    def get_ek_id(self, key, group=None):
+        """ return EK id of key within group, using the EK cache """
+        if (ek_id := get_ek_cache().get_id(key, group, self.session())) is not None:
+            return ek_id
+        return self.EK.getid(key, grp=group, dbsession=self.session())
+
+    def get_ek_key(self, ek_id):
+        """ return EK key of ek_id, using the EK cache """
+        if (key := get_ek_cache().get_key(ek_id, self.session())) is not None:
+            return key
+        return self.EK.get(ek_id, self.session()).key
+
+    def search_samples(self, text, groups, user=None, limit=None, id_only=False,
+                       ignore_acl=False):
+        """ full-text search of samples, ordered by score; ACL restriction is performed
+            inside the search index using the same rule as get_samples()
+        """
+
+        acl = get_acl_context(user)
+        if acl and acl.sample_manager:
+            ignore_acl = True
+
+        group_ids = None
+        if not ignore_acl:
+            if groups is not None:
+                group_ids = [x[1] for x in groups]
+            elif acl is None:
+                raise ValueError('ERR: search_samples() - either groups or user needs to be '
+                                 'provided!')
+            else:
+                group_ids = list(acl.group_ids)
+
+        return self.Sample.search_text(
+            text, self.session(), limit=limit, id_only=id_only, groups=group_ids
+        )
 
     # Plates
 
     def get_plates(self, groups, specs=None, user=None, fetch=True, raise_if_empty=False,
-                   ignore_acl=False):
+                   ignore_acl=False, load=None):
 
-        q = self.construct_query(self.Plate, specs)
+        q = self.apply_load(self.construct_query(self.Plate, specs), self.Plate, load)
         if fetch:
             q = q.order_by(self.Plate.id.desc())
 
@@ -184,14 +326,14 @@ class DBHandler(rhombus_handler.DBHandler):
         return self.fix_result(q, fetch, raise_if_empty)
 
     def get_plates_by_ids(self, ids, groups, user=None, fetch=True, raise_if_empty=False,
-                          ignore_acl=False):
+                          ignore_acl=False, load=None):
         return self.get_plates(groups, [{'plate_id': ids}], user=user, fetch=fetch,
-                               raise_if_empty=raise_if_empty, ignore_acl=False)
+                               raise_if_empty=raise_if_empty, ignore_acl=False, load=load)
 
     def get_plates_by_codes(self, codes, groups, user=None, fetch=True, raise_if_empty=False,
-                            ignore_acl=False):
+                            ignore_acl=False, load=None):
         return self.get_plates(groups, [{'plate_code': codes}], user=user, fetch=fetch,
-                               ignore_acl=False, raise_if_empty=raise_if_empty)
+                               ignore_acl=False, raise_if_empty=raise_if_empty, load=load)
 
     # UploadJob
 
@@ -229,4 +371,30 @@ class DBHandler(rhombus_handler.DBHandler):
                                    user=user, fetch=fetch, class_=class_,
                                    raise_if_empty=raise_if_empty)
 
+    # Job
+
+    def get_jobs(self, groups, specs=None, user=None, fetch=True, raise_if_empty=False,
+                 ignore_acl=False):
+
+        q = self.construct_query(self.Job, specs)
+
+        if groups is None:
+            ignore_acl = True
+
+        if not ignore_acl:
+            if user:
+                q = q.filter(self.Job.user_id == user.id)
+            else:
+                raise ValueError('user argument must be assigned')
+
+        if fetch:
+            q = q.order_by(self.Job.submit_time.desc())
+
+        return self.fetch_query(q, fetch, raise_if_empty)
+
+    def get_jobs_by_ids(self, ids, groups, user=None, fetch=True, raise_if_empty=False,
+                        ignore_acl=False):
+        return self.get_jobs(groups, [{'job_id': ids}], user=user, fetch=fetch,
+                             raise_if_empty=raise_if_empty, ignore_acl=ignore_acl)
+
 # EOF
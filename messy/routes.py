@@ -1,11 +1,14 @@
-from messy.lib.whoosh import IndexService, set_index_service
+from messy.lib.whoosh import create_index_service, set_index_service
+from messy.lib import ekcache
+from messy.lib.acl import request_acl
 from messy import configkeys as ck
 
 from rhombus.routes import add_route_view, add_route_view_class
 from rhombus.lib.utils import cerr, cout
 
 
-from pyramid.events import BeforeRender
+from pyramid.events import BeforeRender, NewRequest, NewResponse
+from pyramid.settings import asbool
 from pyramid.renderers import JSON
 import simplejson
 import datetime
@@ -19,6 +22,9 @@ def includeme(config):
 
     config.add_subscriber(add_global, BeforeRender)
 
+    # per-request ACL context, request.acl
+    config.add_request_method(request_acl, 'acl', reify=True)
+
     config.add_static_view('static', 'static', cache_max_age=3600)
 
     # override assets here
@@ -53,6 +59,20 @@ def includeme(config):
     config.add_route('upload-commit', '/upload/commit')
     config.add_view('messy.views.upload.UploadViewer', attr='commit', route_name='upload-commit')
 
+    config.add_route('upload-status', '/upload/status')
+    config.add_view('messy.views.upload.UploadViewer', attr='status', route_name='upload-status',
+                    renderer='json')
+
+    config.add_route('messy.job', '/job')
+    config.add_view('messy.views.job.JobViewer', attr='index', route_name='messy.job')
+
+    config.add_route('messy.job-status', '/job/{id}@@status')
+    config.add_view('messy.views.job.JobViewer', attr='status', route_name='messy.job-status',
+                    renderer='json')
+
+    config.add_route('messy.job-view', '/job/{id}')
+    config.add_view('messy.views.job.JobViewer', attr='view', route_name='messy.job-view')
+
     config.add_route('tools', '/tools')
     config.add_view('messy.views.tools.ToolsViewer', attr='index', route_name='tools')
 
@@ -87,6 +107,7 @@ def includeme(config):
         ('/sample/@@lookup', 'lookup', 'json'),
         '/sample/@@gridview',
         ('/sample/@@grid', 'grid', 'json'),
+        ('/sample/@@datatable', 'datatable', 'json'),
         '/sample/{id}@@edit',
         '/sample/{id}@@save',
         ('/sample/{id}@@attachment/{fieldname}', 'attachment'),
@@ -124,7 +145,14 @@ def includeme(config):
 
     # whoosh
 
-    set_index_service(IndexService(config.registry.settings['messy.whoosh.path']))
+    set_index_service(create_index_service(settings))
+
+    # EK id/key cache
+
+    ekcache.set_ek_cache(ekcache.create_ek_cache(settings))
+    if asbool(settings.get(ck.msy_ekcache_log_stats, False)):
+        config.add_subscriber(ekcache.start_request_stats, NewRequest)
+        config.add_subscriber(ekcache.log_request_stats, NewResponse)
 
     # add addtional setup here
 
@@ -0,0 +1,129 @@
+
+# benchmark of GISAID metadata import, the row-by-row (iterrows) conversion vs the
+# columnar conversion of converter.iter_gisaid_frames(), on a synthetic metadata file
+#
+# usage: messy-run bench_gisaid [--count 500000]
+
+from rhombus.scripts import arg_parser
+from rhombus.lib.utils import cout
+
+from messy.lib import converter
+
+import os
+import random
+import tempfile
+import time
+
+import pandas as pd
+
+
+def init_argparser(parser=None):
+
+    if parser is None:
+        p = arg_parser('bench_gisaid [options]')
+    else:
+        p = parser
+
+    p.add_argument('--count', type=int, default=500000,
+                   help='number of rows in synthetic GISAID metadata file')
+    p.add_argument('--batch_size', type=int, default=10000,
+                   help='number of rows in each batch of the columnar conversion')
+    p.add_argument('--seed', type=int, default=42)
+
+    return p
+
+
+def main(args):
+
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'gisaid.csv')
+        write_metadata(path, args.count, rng)
+        cout(f'rows: {args.count}, file size: {os.path.getsize(path) / 1e6:.1f} MB\n')
+        cout(f'{"method":<10}{"time (s)":>12}{"rows/s":>12}\n')
+
+        start_time = time.perf_counter()
+        count = sum(len(converter.frame_to_records(df))
+                    for df in converter.iter_gisaid_frames(path, args.batch_size))
+        columnar_time = time.perf_counter() - start_time
+        cout(f'{"columnar":<10}{columnar_time:>12.2f}{count / columnar_time:>12.0f}\n')
+
+        start_time = time.perf_counter()
+        count = len(import_gisaid_csv_iterrows(path))
+        iterrows_time = time.perf_counter() - start_time
+        cout(f'{"iterrows":<10}{iterrows_time:>12.2f}{count / iterrows_time:>12.0f}\n')
+
+    cout(f'speed-up: {iterrows_time / columnar_time:.1f}x\n')
+
+
+def write_metadata(path, count, rng):
+
+    ages = ['34', '5 months', 'unknown', '', '61', '12 Months', '0.5']
+    genders = ['Male', 'Female', 'unknown', '']
+    with open(path, 'w') as outstream:
+        outstream.write(
+            'fn,covv_provider_sample_id,covv_subm_sample_id,covv_virus_name,covv_type,'
+            'covv_passage,covv_collection_date,covv_location,covv_add_location,covv_host,'
+            'covv_add_host_info,covv_gender,covv_patient_age,covv_patient_status,'
+            'covv_specimen,covv_outbreak,covv_last_vaccinated,covv_treatment,covv_orig_lab\n'
+        )
+        for i in range(count):
+            outstream.write(
+                f'FN{i:07d},{"PS%07d" % i if rng.random() < 0.5 else ""},SUB{i:07d},'
+                f'hCoV-19/Indonesia/X-{i}/2021,betacoronavirus,Original,'
+                f'2021-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d},'
+                f'Asia / Indonesia / Jakarta,,Human,,{rng.choice(genders)},{rng.choice(ages)},'
+                f'unknown,Nasopharyngeal swab,,{"2021-06-01" if rng.random() < 0.3 else ""},,'
+                f'LAB-{rng.randint(1, 50)}\n'
+            )
+
+
+def import_gisaid_csv_iterrows(filename):
+    """ the previous row-by-row conversion, kept as the baseline of this benchmark """
+
+    df = pd.read_table(filename, sep=',', keep_default_na=False)
+    for f in ['fn', 'covv_subm_sample_id', 'covv_add_host_info', 'covv_last_vaccinated',
+              'covv_outbreak']:
+        df[f] = df[f].fillna('').astype('str')
+
+    a_list = []
+    for _, r in df.iterrows():
+        d = dict(
+            collection=r.get('collection', ''),
+            code=r['covv_provider_sample_id'] or r['fn'],
+            acc_code=r['covv_subm_sample_id'],
+            sequence_name=r['covv_virus_name'],
+            species=r['covv_type'],
+            passage=r['covv_passage'],
+            collection_date=r['covv_collection_date'],
+            location=r['covv_location'],
+            add_location=r['covv_add_location'],
+            received_date='1970-01-01',
+            host=r['covv_host'],
+            host_info=r['covv_add_host_info'] or '',
+            host_gender=r['covv_gender'][0] if r['covv_gender'] else '',
+            host_age=r['covv_patient_age'],
+            host_status=r['covv_patient_status'],
+            host_occupation='other',
+            specimen_type=r['covv_specimen'],
+            outbreak=r['covv_outbreak'],
+            last_vaccinated_info=r['covv_last_vaccinated'],
+            treatment=r['covv_treatment'],
+            originating_institution=r['covv_orig_lab'],
+            sampling_institution=r['covv_orig_lab'],
+            ct_method='rtpcr',
+        )
+        d['category'] = 'r-ra' if not d['last_vaccinated_info'] else 'F-PO'
+        if type(d['host_age']) == str:
+            if 'month' in d['host_age'].lower():
+                d['host_age'] = int(d['host_age'].split()[0]) / 12
+            elif ('unknown' in d['host_age'].lower()) or (d['host_age'] == ''):
+                d['host_age'] = -1
+            else:
+                d['host_age'] = float(d['host_age'])
+        a_list.append(d)
+
+    return a_list
+
+# EOF
@@ -0,0 +1,93 @@
+
+# benchmark of full-text search backends (Whoosh vs SQLite FTS5) on a synthetic corpus
+#
+# usage: messy-run bench_search [--size 50000] [--queries 1000] [--limit 10]
+
+from rhombus.scripts import arg_parser
+from rhombus.lib.utils import cout
+
+from messy.lib.whoosh import WhooshClassIndexer, Searchable
+from messy.lib.sqlitefts import SQLiteClassIndexer
+
+import datetime
+import os
+import random
+import statistics
+import string
+import tempfile
+import time
+
+
+def init_argparser(parser=None):
+
+    if parser is None:
+        p = arg_parser('bench_search [options]')
+    else:
+        p = parser
+
+    p.add_argument('--size', type=int, default=50000,
+                   help='number of documents in synthetic corpus')
+    p.add_argument('--vocabulary', type=int, default=20000,
+                   help='number of distinct words in synthetic corpus')
+    p.add_argument('--queries', type=int, default=1000,
+                   help='number of queries to be timed')
+    p.add_argument('--limit', type=int, default=10)
+    p.add_argument('--procs', type=int, default=None,
+                   help='number of worker processes for building Whoosh index')
+    p.add_argument('--seed', type=int, default=42)
+
+    return p
+
+
+def main(args):
+
+    rng = random.Random(args.seed)
+    words = generate_words(rng, args.vocabulary)
+    stamp = datetime.datetime.now()
+    corpus = [Searchable(i, stamp, ' '.join(rng.choices(words, k=rng.randint(3, 8))))
+              for i in range(1, args.size + 1)]
+    queries = [generate_query(rng, corpus) for _ in range(args.queries)]
+
+    cout(f'corpus: {args.size} documents, {args.vocabulary} words, {args.queries} queries\n')
+    cout(f'{"backend":<10}{"build (s)":>12}{"p50 (ms)":>12}{"p99 (ms)":>12}{"hits/query":>12}\n')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+
+        backends = [
+            ('whoosh', lambda: WhooshClassIndexer(os.path.join(tmpdir, 'Bench'), [])),
+            ('sqlite', lambda: SQLiteClassIndexer(os.path.join(tmpdir, 'fts5.sqlite'), 'Bench', [])),
+        ]
+
+        for name, factory in backends:
+            ci = factory()
+
+            start_time = time.perf_counter()
+            ci.rebuild(corpus, procs=args.procs)
+            build_time = time.perf_counter() - start_time
+
+            latencies = []
+            hits = 0
+            for terms in queries:
+                start_time = time.perf_counter()
+                hits += len(ci.search(terms, args.limit))
+                latencies.append((time.perf_counter() - start_time) * 1000)
+
+            percentiles = statistics.quantiles(latencies, n=100)
+            cout(f'{name:<10}{build_time:>12.2f}{percentiles[49]:>12.2f}{percentiles[98]:>12.2f}'
+                 f'{hits / len(queries):>12.1f}\n')
+
+
+def generate_words(rng, count):
+    return [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 10)))
+            for _ in range(count)]
+
+
+def generate_query(rng, corpus):
+    """ take 1-2 words from a random document, with a typo in one of them """
+    terms = rng.sample(corpus[rng.randrange(len(corpus))].text.split(), k=rng.randint(1, 2))
+    word = terms[0]
+    pos = rng.randrange(len(word))
+    terms[0] = word[:pos] + rng.choice(string.ascii_lowercase) + word[pos + 1:]
+    return terms
+
+# EOF
@@ -0,0 +1,92 @@
+
+# benchmark of sample upload commit paths (per-row ORM vs set-based bulk) against the
+# database configured in the settings file, eg. a SQLite and a PostgreSQL configuration
+#
+# usage: messy-run bench_upload --collection CODE --login USER [--count 10000]
+#
+# all changes are rolled back at the end of each run
+
+from rhombus.scripts import setup_settings, arg_parser
+from rhombus.lib.utils import cout, get_dbhandler
+from rhombus.models.core import set_func_userid
+
+from messy.lib import uploads
+
+import io
+import random
+import string
+import tempfile
+import time
+import transaction
+
+
+def init_argparser(parser=None):
+
+    if parser is None:
+        p = arg_parser('bench_upload [options]')
+    else:
+        p = parser
+
+    p.add_argument('--count', type=int, default=10000,
+                   help='number of synthetic samples to be uploaded')
+    p.add_argument('--collection', required=True,
+                   help='code of the collection to upload the samples into')
+    p.add_argument('--login', required=True,
+                   help='login of the user performing the upload')
+    p.add_argument('--institution', default='NOT-AVAILABLE',
+                   help='code of originating institution of the samples')
+    p.add_argument('--seed', type=int, default=42)
+
+    return p
+
+
+def main(args):
+
+    settings = setup_settings(args)
+    dbh = get_dbhandler(settings)
+    user = dbh.get_user(args.login).user_instance()
+    set_func_userid(lambda: user.id)
+    collection = dbh.get_collections_by_codes(args.collection, groups=None, ignore_acl=True)[0]
+
+    rng = random.Random(args.seed)
+    prefix = ''.join(rng.choices(string.ascii_uppercase, k=4))
+    codes = [f'{prefix}{i:06d}' for i in range(args.count)]
+
+    cout(f'database: {dbh.session().get_bind().dialect.name}, samples: {args.count}\n')
+    cout(f'{"path":<8}{"add (s)":>12}{"update (s)":>12}{"add/s":>12}{"update/s":>12}\n')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        uploads.set_temp_directory(tmpdir)
+
+        results = {}
+        for bulk in (False, True):
+            add_time = run_job(codes, 'add', collection, user, args, bulk, 'location-A')
+            update_time = run_job(codes, 'update', collection, user, args, bulk, 'location-B')
+            transaction.abort()
+
+            results[bulk] = (add_time, update_time)
+            cout(f'{"bulk" if bulk else "row":<8}{add_time:>12.2f}{update_time:>12.2f}'
+                 f'{args.count / add_time:>12.0f}{args.count / update_time:>12.0f}\n')
+
+    cout(f'speed-up: add {results[False][0] / results[True][0]:.1f}x, '
+         f'update {results[False][1] / results[True][1]:.1f}x\n')
+
+
+def run_job(codes, method, collection, user, args, bulk, location):
+    """ upload synthetic samples and return the elapsed time of commit() including flush """
+
+    buf = io.StringIO()
+    buf.write('code\tcollection\tcollection_date\tlocation\toriginating_institution\n')
+    for code in codes:
+        buf.write(f'{code}\t{collection.code}\t2022-01-15\t{location}\t{args.institution}\n')
+
+    job = uploads.SampleUploadJob(user.id, 'bench.tsv', io.BytesIO(buf.getvalue().encode()),
+                                  collection.id)
+
+    dbh = get_dbhandler()
+    start_time = time.perf_counter()
+    job.commit(method, user, bulk=bulk)
+    dbh.session().flush()
+    return time.perf_counter() - start_time
+
+# EOF
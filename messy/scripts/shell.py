@@ -3,7 +3,7 @@
 from rhombus.lib.utils import cerr, get_dbhandler
 from rhombus.scripts import setup_settings, arg_parser
 from messy.scripts import run
-from messy.lib.whoosh import set_index_service, IndexService
+from messy.lib.whoosh import set_index_service, create_index_service
 
 import sys
 
@@ -27,7 +27,7 @@ def main():
 
     settings = setup_settings( args )
     dbh = get_dbhandler(settings)
-    set_index_service( IndexService(settings['messy.whoosh.path']) )
+    set_index_service(create_index_service(settings))
 
     from IPython import embed
     import transaction
@@ -0,0 +1,62 @@
+
+# run background job workers
+#
+# usage: messy-run worker [--procs 2] [--poll 2]
+
+from rhombus.scripts import setup_settings, arg_parser
+from rhombus.lib.utils import cerr
+
+from messy.lib import jobs
+
+import multiprocessing
+import signal
+
+
+def init_argparser(parser=None):
+
+    if parser is None:
+        p = arg_parser('worker [options]')
+    else:
+        p = parser
+
+    p.add_argument('--procs', type=int, default=1,
+                   help='number of worker processes')
+    p.add_argument('--poll', type=float, default=2.0,
+                   help='interval in seconds between polling for pending jobs')
+    p.add_argument('--lease', type=int, default=jobs.LEASE_TIME,
+                   help='seconds a job is held by a worker without renewal')
+
+    return p
+
+
+def main(args):
+
+    settings = setup_settings(args)
+
+    if args.procs <= 1:
+        jobs.run_worker(settings, jobs.worker_name(), args.poll, args.lease)
+        return
+
+    # the database handler is created after forking, so that each process has its own
+    # connection pool
+    ctx = multiprocessing.get_context('fork')
+    procs = [ctx.Process(target=run_process, args=(settings, idx, args.poll, args.lease),
+                         daemon=True)
+             for idx in range(args.procs)]
+    for proc in procs:
+        proc.start()
+
+    def terminate(signum, frame):
+        for proc in procs:
+            proc.terminate()
+
+    signal.signal(signal.SIGTERM, terminate)
+    for proc in procs:
+        proc.join()
+    cerr('[Job workers stopped]')
+
+
+def run_process(settings, idx, poll_interval, lease_time):
+    jobs.run_worker(settings, jobs.worker_name(idx), poll_interval, lease_time)
+
+# EOF
@@ -172,7 +172,7 @@ class BaseViewer(rb_BaseViewer):
 
 def generate_file_table(files, request, obj, route_name):
 
-    not_guest = not request.user.has_roles(r.GUEST) or obj.can_modify(request.user)
+    not_guest = not request.acl.is_guest or obj.can_modify(request.user)
 
     table_body = t.tbody()
 
@@ -3,6 +3,7 @@ from messy.views import (BaseViewer, r, get_dbhandler, m_roles, ParseFormError,
                          render_to_response, form_submit_bar, select2_lookup, or_,
                          Response, modal_delete, modal_error, HTTPFound, generate_file_table,
                          validate_code)
+from messy.lib import stats
 from rhombus.lib import exceptions as exc
 import rhombus.lib.tags as t
 import sqlalchemy.exc
@@ -36,24 +37,24 @@ class CollectionViewer(BaseViewer):
         # make sure the user has the right roles and/or the right membership
         if obj is not None and obj.can_modify(self.request.user):
             return True
-        return super().can_modify(obj) and self.request.user.in_group(obj.group_id)
+        return super().can_modify(obj) and self.request.acl.in_group(obj.group_id)
 
     @m_roles(r.PUBLIC)
     def index(self):
 
         group_id = int(self.request.params.get('group_id', 0))
         if group_id:
-            if self.request.user.in_group(group_id):
-                collections = self.dbh.get_collections(groups=[(None, group_id)])
+            if self.request.acl.in_group(group_id):
+                collections = self.dbh.get_collections(groups=[(None, group_id)], load='list')
             else:
                 raise exc.AuthError(
                     f'You login [{self.request.user.login}] does not have access to view '
                     f'collections that belong to group with group id: {group_id}')
 
         elif self.request.user.has_roles(r.SYSADM, r.DATAADM, r.SYSVIEW, r.DATAVIEW, r.COLLECTION_MANAGE):
-            collections = self.dbh.get_collections(groups=None, ignore_acl=True)
+            collections = self.dbh.get_collections(groups=None, ignore_acl=True, load='list')
         else:
-            collections = self.dbh.get_collections(groups=self.request.user.groups)
+            collections = self.dbh.get_collections(groups=self.request.user.groups, load='list')
 
         html, code = generate_collection_table(collections, self.request)
 
@@ -226,7 +227,10 @@ def generate_collection_table(collections, request):
 
     table_body = t.tbody()
 
-    not_guest = not request.user.has_roles(r.GUEST)
+    not_guest = not request.acl.is_guest
+
+    # sample counts of all collections, maintained incrementally by messy.lib.stats
+    sample_counts = stats.get_keyed_counters(get_dbhandler().session(), 'samples.collection')
 
     for collection in collections:
         table_body.add(
@@ -235,7 +239,7 @@ def generate_collection_table(collections, request):
                      if not_guest else ''),
                 t.td(t.a(collection.code, href=request.route_url('messy.collection-view', id=collection.id))),
                 t.td(collection.description or '-'),
-                t.td(t.a(collection.samples.count(),
+                t.td(t.a(sample_counts.get(collection.id, 0),
                          href=request.route_url('messy.sample', _query={'q': '%d[collection_id]' % collection.id}))),
                 t.td(t.a(collection.group.name,
                          href=request.route_url('messy.collection', _query={'group_id': collection.group.id}))),
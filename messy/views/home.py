@@ -1,6 +1,7 @@
 
 from messy.views import roles, render_to_response, get_dbhandler
 from messy.lib import roles as r
+from messy.lib import stats
 
 from rhombus.lib import tags_b46 as t
 from rhombus.views.home import login as rb_login, logout as rb_logout
@@ -9,46 +10,13 @@ from pyramid.response import FileResponse
 
 import docutils.core
 import os
-import time
-import threading
-
-
-# rudimentary caching mechanism for stats
-
-class StatStatus(object):
-
-    def __init__(self, duration=300):
-        self.duration = duration
-        self.last_update = 0
-        self.collections = -1
-        self.samples = -1
-        self.lock = threading.Lock()
-
-    def update(self, request):
-        dbh = get_dbhandler()
-        dbsess = dbh.session()
-        self.collections = dbh.Collection.query(dbsess).filter(~dbh.Collection.refctrl).count()
-        self.samples = dbh.Sample.query(dbsess).filter(~dbh.Sample.refctrl).count()
-
-    def get_stats(self, request):
-        if ((current_time := time.monotonic()) - self.last_update) > self.duration:
-            if self.lock.acquire(blocking=False):
-                self.last_update = current_time
-                self.update(request)
-                self.lock.release()
-            else:
-                # stats is being updated, sleep for 1 sec to allow for getting latest update
-                time.sleep(1)
-        return (self.collections, self.samples)
-
-
-_stats_ = StatStatus(300)  # caching duration 300 secs or 5 mins
 
 
 def index(request):
-    global _stats_
 
-    total_collections, total_samples = _stats_.get_stats(request)
+    # non-refctrl counts, maintained incrementally by messy.lib.stats
+    counts = stats.get_counters(get_dbhandler().session(), 'collections', 'samples')
+    total_collections, total_samples = counts['collections'], counts['samples']
 
     html = t.div()[
         t.h2('Data Status'),
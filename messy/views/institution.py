@@ -213,7 +213,7 @@ def generate_institution_table(institutions, request):
 
     table_body = t.tbody()
 
-    not_guest = not request.user.has_roles(r.GUEST)
+    not_guest = not request.acl.is_guest
 
     for institution in institutions:
         table_body.add(
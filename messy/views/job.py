@@ -0,0 +1,108 @@
+
+from messy.views import m_roles, get_dbhandler, render_to_response, error_page
+from messy.lib import roles as r
+from rhombus.lib import tags_b46 as t
+
+
+class JobViewer(object):
+
+    def __init__(self, request):
+        self.request = request
+        self.dbh = get_dbhandler()
+
+    def get_job(self):
+        job_id = int(self.request.matchdict.get('id'))
+        jobs = self.dbh.get_jobs_by_ids([job_id], groups=self.request.user.groups,
+                                        user=self.request.user,
+                                        ignore_acl=self.request.user.is_admin())
+        if len(jobs) == 0:
+            return None
+        return jobs[0]
+
+    @m_roles(r.PUBLIC)
+    def index(self):
+
+        jobs = self.dbh.get_jobs(groups=self.request.user.groups, user=self.request.user)
+
+        tbody = t.tbody()
+        for job in jobs:
+            tbody.add(
+                t.tr(
+                    t.td(t.a(str(job.id), href=self.request.route_url('messy.job-view', id=job.id))),
+                    t.td(job.job_type),
+                    t.td(job.status),
+                    t.td(f'{job.progress}%'),
+                    t.td(str(job.submit_time)),
+                    t.td(job.message),
+                )
+            )
+
+        html = t.div(t.h2('Jobs'))[
+            t.table(class_='table table-condensed table-striped')[
+                t.thead(
+                    t.tr(
+                        t.th('ID'), t.th('Type'), t.th('Status'), t.th('Progress'),
+                        t.th('Submitted'), t.th('Message'),
+                    )
+                ),
+                tbody,
+            ]
+        ]
+
+        return render_to_response("messy:templates/generic_page.mako",
+                                  {'html': html},
+                                  request=self.request)
+
+    @m_roles(r.PUBLIC)
+    def view(self):
+
+        job = self.get_job()
+        if job is None:
+            return error_page(self.request, 'Job does not exist or is not owned by this user!')
+
+        html = t.div()[
+            t.h2(f'Job {job.id}: {job.job_type}'),
+            t.div('Status: ', t.span(job.status, id='job-status')),
+            t.div('Progress: ', t.span(f'{job.progress}%', id='job-progress')),
+            t.div('Message: ', t.span(job.message, id='job-message')),
+            t.div(f'Submitted: {job.submit_time}'),
+            t.div(f'Result: {job.result}') if job.result else '',
+            t.hr,
+            t.h5('Log'),
+            t.pre(job.log, id='job-log'),
+        ]
+
+        jscode = ''
+        if not job.is_finished():
+            # poll until the job finishes, then reload to show the result
+            jscode = '''
+            var poll = function() {
+                $.getJSON('%s', function(data) {
+                    $('#job-status').text(data.status);
+                    $('#job-progress').text(data.progress + '%%');
+                    $('#job-message').text(data.message);
+                    if (data.status == 'completed' || data.status == 'failed') {
+                        location.reload();
+                    } else {
+                        setTimeout(poll, 2000);
+                    }
+                });
+            };
+            setTimeout(poll, 2000);
+            ''' % self.request.route_url('messy.job-status', id=job.id)
+
+        return render_to_response("messy:templates/generic_page.mako",
+                                  {'html': html, 'code': jscode},
+                                  request=self.request)
+
+    @m_roles(r.PUBLIC)
+    def status(self):
+
+        job = self.get_job()
+        if job is None:
+            return {'status': 'invalid'}
+
+        return {'id': job.id, 'job_type': job.job_type, 'status': job.status,
+                'progress': job.progress, 'message': job.message, 'result': job.result}
+
+# EOF
@@ -40,9 +40,10 @@ class PlateViewer(BaseViewer):
     def index(self):
 
         if self.request.user.has_roles(r.SYSADM, r.DATAADM, r.SYSVIEW, r.DATAVIEW, r.PLATE_MODIFY, r.PLATE_VIEW):
-            plates = self.dbh.get_plates(groups=None, fetch=False).order_by(self.dbh.Plate.date.desc())
+            plates = self.dbh.get_plates(groups=None, fetch=False, load='list').order_by(self.dbh.Plate.date.desc())
         else:
-            plates = self.dbh.get_plates(groups=self.request.user.groups, fetch=False).order_by(self.dbh.Plate.date.desc())
+            plates = self.dbh.get_plates(groups=self.request.user.groups, fetch=False,
+                                        load='list').order_by(self.dbh.Plate.date.desc())
 
         html, code = generate_plate_table(plates, self.request)
 
@@ -416,7 +417,7 @@ def generate_plate_table(plates, request):
 
     table_body = t.tbody()
 
-    not_guest = not request.user.has_roles(r.GUEST)
+    not_guest = not request.acl.is_guest
 
     for plate in plates:
         table_body.add(
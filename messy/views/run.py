@@ -308,7 +308,7 @@ def generate_run_table(runs, request):
 
     table_body = t.tbody()
 
-    not_guest = not request.user.has_roles(r.GUEST)
+    not_guest = not request.acl.is_guest
 
     for run in runs:
         table_body.add(
@@ -10,6 +10,9 @@ import sqlalchemy.exc
 import dateutil
 import json
 import more_itertools
+import orjson
+from html import escape
+from sqlalchemy import or_, func
 
 
 def generate_plateposition_table_tab(viewer, html_anchor=None):
@@ -85,11 +88,23 @@ class SampleViewer(BaseViewer):
         if (q := self.request.params.get('q', None)):
             specs = query2dict(q, grouping=False)
 
-        samples = self.dbh.get_samples(
-            groups=None, specs=specs, user=self.request.user, fetch=False
-        ).order_by(self.dbh.Sample.id.desc())
+        if (text := self.request.params.get('text', None)):
+            # full-text search, ordered by score
+            samples = self.dbh.search_samples(
+                text, groups=None, user=self.request.user,
+                limit=int(self.request.params.get('limit', 1000))
+            )
+        elif self.request.params.get('view', None) == 'status':
+            samples = self.dbh.get_samples(
+                groups=None, specs=specs, user=self.request.user, fetch=False
+            ).order_by(self.dbh.Sample.id.desc())
+        else:
+            samples = None
 
-        if self.request.params.get('view', None) == 'status':
+        if samples is None:
+            # rows are fetched page by page from the datatable endpoint
+            html, code = generate_sample_table(None, self.request)
+        elif self.request.params.get('view', None) == 'status':
             html, code = generate_sample_status_table(samples, self.request)
         else:
             html, code = generate_sample_table(samples, self.request)
@@ -106,10 +121,7 @@ class SampleViewer(BaseViewer):
     @m_roles(r.SYSADM, r.DATAADM, r.SAMPLE_MANAGE)
     def gridview(self):
 
-        samples = self.dbh.get_samples(groups=None, user=self.request.user, fetch=False)\
-            .order_by(self.dbh.Sample.id.desc())
-
-        html, code = generate_sample_grid(samples, self.request)
+        html, code = generate_sample_grid(self.request)
         html = t.div()[t.h2('Samples: raw view'), html]
         return render_to_response("messy:templates/gridbase.mako",
                                   {
@@ -349,6 +361,76 @@ class SampleViewer(BaseViewer):
 
         return result
 
+    @m_roles(r.PUBLIC)
+    def datatable(self):
+        """ DataTables server-side processing; paging, sorting and searching are performed
+            in SQL, and pages following a page ordered by id use keyset pagination
+            (after_id) instead of OFFSET
+        """
+
+        params = self.request.params
+        Sample = self.dbh.Sample
+
+        specs = None
+        if (q := params.get('q', None)):
+            specs = query2dict(q, grouping=False)
+
+        q = self.dbh.get_sample_rows(None, sample_table_fields, specs=specs,
+                                     user=self.request.user)
+        total = q.order_by(None).count()
+
+        if (search := params.get('search[value]', '').strip()):
+            pattern = '%' + search.lower().replace('%', r'\%').replace('_', r'\_') + '%'
+            q = q.filter(or_(*[func.lower(c).like(pattern, escape='\\')
+                               for c in q.selectable.selected_columns
+                               if c.name in sample_table_searchable_fields]))
+            filtered = q.order_by(None).count()
+        else:
+            filtered = total
+
+        start = max(int(params.get('start', 0)), 0)
+        length = int(params.get('length', 250))
+
+        column = params.get('order[0][column]', None)
+        field = sample_table_fields[int(column)] if column is not None else None
+        if field and field != 'id' and params.get(f'columns[{column}][orderable]') != 'false':
+            col = q.selectable.selected_columns[field]
+            q = q.order_by(col.desc() if params.get('order[0][dir]') == 'desc' else col.asc(),
+                           Sample.id.desc())
+        else:
+            q = q.order_by(Sample.id.desc())
+            if (after_id := params.get('after_id', '')):
+                q = q.filter(Sample.id < int(after_id))
+                start = 0
+
+        if start:
+            q = q.offset(start)
+        if length > 0:
+            q = q.limit(length)
+
+        not_guest = not self.request.acl.is_guest
+        view_url = self.request.route_url('messy.sample-view', id='')
+        data = []
+        for row in q:
+            data.append([
+                f'<input type="checkbox" name="sample-ids" value="{row.id}" />'
+                if not_guest else '',
+                f'<a href="{view_url}{row.id}">{escape(row.code)}</a>',
+                escape(row.collection),
+                escape(row.category or ''),
+                escape(row.acc_code or ''),
+                escape(row.location or ''),
+                str(row.collection_date or ''),
+            ])
+
+        return {
+            'draw': int(params.get('draw', 0)),
+            'recordsTotal': total,
+            'recordsFiltered': filtered,
+            'data': data,
+            'last_id': row.id if data else None,
+        }
+
     def action_post(self):
 
         request = self.request
@@ -407,6 +489,20 @@ class SampleViewer(BaseViewer):
         _m = rq.method
         dbh = get_dbhandler()
 
+        if _m == t.GET:
+            # a page of grid rows, ordered by descending id; the next page starts after
+            # the last id of the previous page
+            q = dbh.get_sample_rows(None, sample_grid_fields, user=rq.user)\
+                .order_by(dbh.Sample.id.desc())
+            if (after_id := rq.params.get('after_id', '')):
+                q = q.filter(dbh.Sample.id < int(after_id))
+            rows = [list(row) for row in q.limit(int(rq.params.get('length', 5000)))]
+
+            d = {'data': rows}
+            if not after_id:
+                d['total'] = q.order_by(None).count()
+            return Response(body=orjson.dumps(d), content_type='application/json')
+
         if _m == t.POST:
             """
             request.POST is MultiDict([('data', '[{"row":"3", "col0": 1234, "data":{"code":"def"}}]'), ('name', '')])
@@ -414,10 +510,41 @@ class SampleViewer(BaseViewer):
             # update the samples
             updates = json.loads(rq.POST.get('data'))
 
+            # fetch all edited samples, and resolve the collection and institution codes
+            # of all edits with a single query each
+            samples = {
+                s.id: s for s in dbh.get_samples_by_ids([int(vals['col0']) for vals in updates],
+                                                        groups=None, ignore_acl=True)
+            }
+            collection_ids = {
+                c.code: c.id for c in dbh.get_collections_by_codes(
+                    list({vals['data']['collection'] for vals in updates
+                          if 'collection' in vals['data']}),
+                    groups=None, ignore_acl=True)
+            }
+            institution_ids = {
+                i.code: i.id for i in dbh.get_institutions_by_codes(
+                    list({vals['data'][f] for vals in updates
+                          for f in ('originating_institution', 'sampling_institution')
+                          if f in vals['data']}),
+                    None)
+            }
+
             for vals in updates:
-                sample_id = vals['col0']
-                d = vals['data']
-                sample = dbh.get_samples_by_ids([sample_id], groups=None, ignore_acl=True)[0]
+                sample_id = int(vals['col0'])
+                if (sample := samples.get(sample_id, None)) is None:
+                    return {'success': False, 'message': f'Sample id {sample_id} does not exist'}
+                d = dict(vals['data'])
+                if 'collection' in d:
+                    if (code := d.pop('collection')) not in collection_ids:
+                        return {'success': False, 'message': f'Collection {code} does not exist'}
+                    sample.collection_id = collection_ids[code]
+                for f in ('originating_institution', 'sampling_institution'):
+                    if f in d:
+                        if (code := d.pop(f)) not in institution_ids:
+                            return {'success': False,
+                                    'message': f'Institution {code} does not exist'}
+                        setattr(sample, f'{f}_id', institution_ids[code])
                 sample.update(d)
 
             return {'success': True}
@@ -438,7 +565,7 @@ class SampleViewer(BaseViewer):
         res = func([obj_id],
                    groups=None if rq.user.has_roles(* self.viewing_roles)
                    else rq.user.groups,
-                   user=rq.user)
+                   user=rq.user, load='detail')
         if len(res) == 0:
             raise RuntimeError('Cannot find object! Please check object id!')
 
@@ -446,13 +573,43 @@ class SampleViewer(BaseViewer):
         return self.obj
 
 
+# fields of each column of sample table, the first column (checkbox) is ordered by id
+sample_table_fields = ['id', 'code', 'collection', 'category', 'acc_code', 'location',
+                       'collection_date']
+sample_table_searchable_fields = {'code', 'collection', 'category', 'acc_code', 'location'}
+
+# columns of sample grid with their jspreadsheet attributes, id must be the first column
+sample_grid_columns = [
+    ('id', "align: 'left', width: 80, readOnly: true,"),
+    ('code', "align: 'left', width: 100,"),
+    ('acc_code', "align: 'left', width: 120,"),
+    ('collection', "align: 'left', width: 120,"),
+    ('location', "align: 'left', width: 300,"),
+    ('collection_date', "width: 120,"),
+    ('originating_institution', "align: 'left', width: 180,"),
+    ('originating_code', "align: 'left', width: 120,"),
+    ('sampling_institution', "align: 'left', width: 180,"),
+    ('sampling_code', "align: 'left', width: 120,"),
+    ('category', "align: 'left', width: 70,"),
+    ('specimen_type', "align: 'left', width: 120,"),
+    ('host', "align: 'left', width: 120,"),
+    ('host_info', "align: 'left', width: 120,"),
+    ('host_status', "align: 'left', width: 80,"),
+    ('species', "align: 'left', width: 120,"),
+]
+sample_grid_fields = [f for f, _ in sample_grid_columns]
+
+
 def generate_sample_table(samples, request):
+    """ generate sample table; when samples is None, the rows are fetched by DataTables
+        from the datatable endpoint
+    """
 
     table_body = t.tbody()
 
-    not_guest = not request.user.has_roles(r.GUEST)
+    not_guest = not request.acl.is_guest
 
-    for sample in samples:
+    for sample in (samples or []):
         table_body.add(
             t.tr(
                 t.td(t.literal('<input type="checkbox" name="sample-ids" value="%d" />' % sample.id)
@@ -499,7 +656,13 @@ def generate_sample_table(samples, request):
         html = t.div(t.a('View in grid mode', href=request.route_url('messy.sample-gridview')),
                      html)
 
-    code += template_datatable_js
+    if samples is None:
+        code += template_datatable_server_js % json.dumps({
+            'url': request.route_url('messy.sample-datatable'),
+            'q': request.params.get('q', ''),
+        })
+    else:
+        code += template_datatable_js
     return html, code
 
 
@@ -583,7 +746,7 @@ def generate_sample_status_table(samples, request):
     dbh = get_dbhandler()
 
     specimen_type_ids = [
-        dbh.EK._id(st, grp='@SPECIMEN_TYPE') for st in ['rna', 'dna', 'ssdna']
+        dbh.get_ek_id(st, '@SPECIMEN_TYPE') for st in ['rna', 'dna', 'ssdna']
     ]
 
     for sample in samples:
@@ -623,40 +786,24 @@ def generate_sample_status_table(samples, request):
     return sample_status_table, template_sample_status_datatable_js
 
 
-def generate_sample_grid(samples, request):
-    """ use grid to show samples """
+def generate_sample_grid(request):
+    """ use grid to show samples, the rows are loaded page by page from the grid endpoint """
 
     html = t.div()[
         t.h5('With great power comes great responsibility!'),
+        t.div('Loading samples...', id='sample_grid_status'),
         t.div(id='sample_grid'),
         t.button('Fullscreen', onclick='toggle(this)'),
     ]
 
-    data = list([[
-        s.id,
-        s.code,
-        s.acc_code,
-        str(s.collection),
-        s.location,
-        str(s.collection_date),
-        str(s.originating_institution),
-        s.originating_code,
-        str(s.sampling_institution),
-        s.sampling_code,
-        s.sequence_name,
-        s.category,
-        s.host_age,
-        s.host_gender,
-        s.host_status,
-        s.species,
-    ] for s in samples])
-
-    grid_js = 'data = ' + json.dumps(data, indent=4) + ';\n'
-
-    grid_js += template_grid_js.format(
+    grid_js = template_grid_js.format(
         name='sample_grid',
-        column=2,
-        row=1,
+        url=request.route_url('messy.sample-grid'),
+        page_size=1000,
+        columns=',\n        '.join(
+            '{{ title: {0}, name: {0}, {1} }}'.format(json.dumps(f), attrs)
+            for f, attrs in sample_grid_columns
+        ),
     )
 
     return html, grid_js
@@ -687,6 +834,55 @@ $(document).ready(function() {
 } );
 """
 
+template_datatable_server_js = """
+$(document).ready(function() {
+    var params = %s;
+    // last sample id of each page, to request the next page with keyset pagination
+    var last_ids = {};
+    var pending_key = null;
+    $('#sample-table').DataTable( {
+        serverSide: true,
+        processing: true,
+        searchDelay: 500,
+        paging: true,
+        pageLength: 250,
+        lengthMenu: [ [100, 250, 500, 1000], [100, 250, 500, 1000] ],
+        order: [],
+        fixedHeader: {
+            headerOffset: $('#fixedNavbar').outerHeight()
+        },
+        orderClasses: false,
+        ajax: {
+            url: params.url,
+            data: function(d) {
+                d.q = params.q;
+                var key = d.start + '|' + d.length + '|' + d.search.value;
+                if (d.order.length == 0 && last_ids[key] !== undefined) {
+                    d.after_id = last_ids[key];
+                }
+                pending_key = (d.order.length == 0) ?
+                    (d.start + d.length) + '|' + d.length + '|' + d.search.value : null;
+            },
+            dataSrc: function(json) {
+                if (pending_key !== null && json.last_id !== null) {
+                    last_ids[pending_key] = json.last_id;
+                }
+                return json.data;
+            }
+        },
+        columns: [
+            { title: ' ', orderable: false, width: '12px' },
+            { },
+            { },
+            { },
+            { },
+            { },
+            { },
+        ]
+    } );
+} );
+"""
+
 template_sample_status_datatable_js = """
 $(document).ready(function() {
     $('#sample-status-table').DataTable( {
@@ -705,44 +901,75 @@ var toggle = function(b) {{
     {name}.fullscreen(true);
 }}
 
-var {name} = jspreadsheet(document.getElementById('{name}'), {{
-    allowInsertRow:false,
-    allowInsertColumn:false,
-    allowDeleteRow:false,
-    allowDeleteColumn:false,
-    allowRenameColumn:false,
-    allowComments:false,
-    columnSorting:true,
-    name:'{name}',
-    data: data,
-    persistance:'/sample/@@grid',
-    freezeColumns: 3,
-    tableOverflow: true,
-    tableWidth: '1800px',
-    tableHeight: '960px',
-    search: true,
-    pagination: 250,
-    paginationOptions: [100, 250, 500, 1000],
-    columns: [
-        {{ title: 'id', name: 'id', align: 'left', width:80, readOnly: true, }},
-        {{ title: 'code', name: 'code', align: 'left', width: 100, }},
-        {{ title: 'acc_code', name: 'acc_code', align: 'left', width: 120, }},
-        {{ title: 'collection', name: 'collection', align: 'left', width: 120, }},
-        {{ title: 'location', name: 'location', align: 'left', width: 300, }},
-        {{ title: 'collection_date', name: 'collection_date', width: 120, }},
-        {{ title: 'originating_institution', name: 'originating_institution', align: 'left', width: 180, }},
-        {{ title: 'originating_code', name: 'originating_code', align: 'left', width: 120, }},
-        {{ title: 'sampling_institution', name: 'sampling_institution', align: 'left', width: 180, }},
-        {{ title: 'sampling_code', name: 'sampling_code', align: 'left', width: 120, }},
-        {{ title: 'sequence_name', name: 'sequence_name', align: 'left', width: 300, }},
-        {{ title: 'category', name: 'category', align: 'left', width: 70, }},
-        {{ title: 'host_age', name: 'host_age', align: 'right', width: 70, }},
-        {{ title: 'host_gender', name: 'host_gender', align: 'left', width: 70, }},
-        {{ title: 'host_status', name: 'host_status', align: 'left', width: 80, }},
-        {{ title: 'species', name: 'species', align: 'left', width: 120, }},
-    ],
-}}
-)
+var {name} = null;
+var {name}_data = [];
+var {name}_total = 0;
+var {name}_loading = false;
+
+// the spreadsheet is created with the first page, and the next page is only loaded when
+// the last client-side page is shown, so that the browser holds the pages viewed so far
+var load_{name} = function(done) {{
+    var after_id = {name}_data.length > 0 ? {name}_data[{name}_data.length - 1][0] : null;
+    var params = {{ length: {page_size} }};
+    if (after_id !== null) {{
+        params.after_id = after_id;
+    }}
+    {name}_loading = true;
+    $.getJSON('{url}', params, function(page) {{
+        if (page.total !== undefined) {{
+            {name}_total = page.total;
+        }}
+        if (page.data.length == 0) {{
+            // no more rows, eg. samples were removed since the total was counted
+            {name}_total = {name}_data.length;
+        }}
+        {name}_data = {name}_data.concat(page.data);
+        $('#{name}_status').text('Loaded ' + {name}_data.length + ' of ' + {name}_total +
+                                 ' samples');
+        {name}_loading = false;
+        done();
+    }});
+}};
+
+var more_{name} = function(el, page_number) {{
+    var pages = Math.ceil({name}_data.length / {name}.options.pagination);
+    if ({name}_loading || page_number < pages - 1 || {name}_data.length >= {name}_total) {{
+        return;
+    }}
+    load_{name}(function() {{
+        {name}.setData({name}_data);
+        {name}.page(page_number);
+    }});
+}};
+
+var create_{name} = function() {{
+    {name} = jspreadsheet(document.getElementById('{name}'), {{
+        allowInsertRow:false,
+        allowInsertColumn:false,
+        allowDeleteRow:false,
+        allowDeleteColumn:false,
+        allowRenameColumn:false,
+        allowComments:false,
+        columnSorting:true,
+        name:'{name}',
+        data: {name}_data,
+        persistance:'{url}',
+        freezeColumns: 3,
+        tableOverflow: true,
+        tableWidth: '1800px',
+        tableHeight: '960px',
+        search: true,
+        pagination: 250,
+        paginationOptions: [100, 250, 500, 1000],
+        onchangepage: more_{name},
+        columns: [
+        {columns},
+        ],
+    }});
+    more_{name}(null, 0);
+}};
+
+load_{name}(create_{name});
 
 """
 
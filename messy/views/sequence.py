@@ -94,7 +94,7 @@ def generate_sequence_table(sequences, request):
 
     table_body = t.tbody()
 
-    not_guest = not request.user.has_roles(r.GUEST)
+    not_guest = not request.acl.is_guest
 
     for sequence in sequences:
         sample = sequence.sample
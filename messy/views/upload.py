@@ -1,14 +1,13 @@
 
 from messy.views import (m_roles, get_dbhandler, error_page, render_to_response, HTTPFound,
                          select2_lookup)
-from messy.lib import uploads
+from messy.lib import uploads, jobs
 from messy.lib import roles as r
 from rhombus.views.generics import forwarding_page
 from rhombus.lib import tags_b46 as t
 from rhombus.lib.utils import random_string
 from rhombus.lib.rpc import generate_user_token
 
-import joblib
 import pandas as pd
 import os
 
@@ -47,9 +46,7 @@ class UploadViewer(object):
 
         jobid = request.params.get('jobid', None)
         if jobid:
-            uploadjob = joblib.load(
-                uploads.create_temp_file('upload', request.user.login, 'joblib', jobid)
-            )
+            uploadjob = uploads.load_job(request.user.id, jobid)
             if not uploadjob.check_user(self.request.user.id):
                 raise RuntimeError('Current job is not owned by this user!')
 
@@ -86,9 +83,7 @@ class UploadViewer(object):
         if self.request.method == 'POST':
             jobid = self.request.POST['jobid']
             if jobid:
-                uploadjob = joblib.load(
-                    uploads.create_temp_file('upload', self.request.user.login, 'joblib', jobid)
-                )
+                uploadjob = uploads.load_job(self.request.user.id, jobid)
                 if not uploadjob.check_user(self.request.user.id):
                     raise RuntimeError('Current job is not owned by this user!')
 
@@ -101,6 +96,29 @@ class UploadViewer(object):
 
         return error_page(self.request, 'Nothing to be done anymore!')
 
+    def submit_commit_job(self, uploadjob, method):
+        """ run the commit in a background job and redirect to the job page """
+
+        uploadjob.save()
+        job = jobs.submit_job('upload_commit', {'randkey': uploadjob.randkey, 'method': method},
+                              self.request.user, self.dbh)
+        return HTTPFound(location=self.request.route_url('messy.job-view', id=job.id))
+
+    @m_roles(r.PUBLIC)
+    def status(self):
+        """ return commit progress of a job as JSON, polled by the confirmation page """
+
+        jobid = self.request.params.get('jobid', '')
+        try:
+            uploadjob = uploads.load_job(self.request.user.id, jobid)
+        except (FileNotFoundError, ValueError):
+            # job directory is removed once all chunks are committed
+            return {'jobid': jobid, 'status': 'removed'}
+        if not uploadjob.check_user(self.request.user.id):
+            raise RuntimeError('Current job is not owned by this user!')
+
+        return uploadjob.progress()
+
     def generate_token(self):
 
         if self.request.method == 'POST':
@@ -135,8 +153,6 @@ class UploadViewer(object):
             else:
                 return error_page(self.request, 'Please provide either sample file or GISAID file')
             randkey = job.randkey
-            job_filename = uploads.create_temp_file('upload', self.request.user.login, 'joblib', randkey)
-            joblib.dump(job, job_filename)
 
             return HTTPFound(
                 location=self.request.route_url('upload', _query={'jobid': randkey}))
@@ -217,6 +233,7 @@ class UploadViewer(object):
                                 placeholder="Type an institution name",
                                 parenttag="table-body",
                                 url=self.request.route_url('messy.institution-lookup'))
+        jscode += commit_progress_js(self.request, job.randkey)
 
         if len(params['err_msgs']) > 0:
             html[t.h4('Warning messages')].add(* [t.div(msg) for msg in params['err_msgs']])
@@ -239,9 +256,14 @@ class UploadViewer(object):
         for inst_code, inst_id in zip(sorted(inst_codes), sorted(inst_ids)):
             if inst_code[0].split('-')[1] != inst_id[0].split('-')[1]:
                 raise RuntimeError('mismatch order of institution code and id')
-            job.institution_cache[inst_code[1]] = self.dbh.get_institution_by_ids(inst_id)[0]
+            job.institution_cache[inst_code[1]] = uploads.institution_ref(
+                self.dbh.get_institutions_by_ids([int(inst_id[1])], None)[0])
+
+        if jobs.is_jobs_enabled():
+            return self.submit_commit_job(job, method)
 
-        added, not_added, updated, failed = job.commit(method, self.request.user)
+        added, not_added, updated, failed = job.commit(method, self.request.user,
+                                                       tm=self.request.tm)
         html = t.div()[
             t.h2('Uploaded Samples'),
             t.div(f"Added sample(s): {len(added)}"),
@@ -249,6 +271,7 @@ class UploadViewer(object):
             t.div(f"Updated sample(s): {len(updated)}"),
             t.div(f"Failed sample(s): {len(failed)}"),
         ]
+        html.add(self.retry_form(job, method))
 
         # create a verbose log
         log_lines = []
@@ -277,7 +300,7 @@ class UploadViewer(object):
         ))
 
         return render_to_response("messy:templates/generic_page.mako",
-                                  {'html': html, },
+                                  {'html': html, 'code': commit_progress_js(self.request, job.randkey)},
                                   request=self.request)
 
     def confirmpage_institution(self, job=None):
@@ -286,8 +309,6 @@ class UploadViewer(object):
             file_content = self.request.params.get('messy-institution/infile')
             job = uploads.InstitutionUploadJob(self.request.user.id, file_content.filename, file_content.file)
             randkey = job.randkey
-            job_filename = uploads.create_temp_file('upload', self.request.user.login, 'joblib', randkey)
-            joblib.dump(job, job_filename)
 
             return HTTPFound(
                 location=self.request.route_url('upload', _query={'jobid': randkey}))
@@ -313,24 +334,72 @@ class UploadViewer(object):
         )
 
         return render_to_response("messy:templates/generic_page.mako",
-                                  {'html': html, },
+                                  {'html': html, 'code': commit_progress_js(self.request, job.randkey)},
                                   request=self.request)
 
     def commitpage_institution(self, job):
 
         method = self.request.POST['_method']
-        added, updated, failed = job.commit(method)
+        if jobs.is_jobs_enabled():
+            return self.submit_commit_job(job, method)
+
+        added, updated, failed = job.commit(method, tm=self.request.tm)
         html = t.div()[
             t.h2('Uploaded Institution'),
             t.div(f"Added institution(s): {added}"),
             t.div(f"Updated institution(s): {updated}"),
-            t.div(f"Failed institution(s): {failed}")
+            t.div(f"Failed institution(s): {failed}"),
+            self.retry_form(job, method),
         ]
         return render_to_response("messy:templates/generic_page.mako",
-                                  {'html': html, },
+                                  {'html': html, 'code': commit_progress_js(self.request, job.randkey)},
                                   request=self.request)
 
 
+    def retry_form(self, job, method):
+        """ remove a completed job, otherwise return a form to retry the failed chunks """
+
+        if job.status == 'completed':
+            job.remove()
+            return ''
+
+        failed_chunks = job.failed_chunks()
+        return t.div(
+            t.hr,
+            t.div(f"Failed chunk(s): {len(failed_chunks)} of {job.chunks}, "
+                  f"the other chunks have been committed"),
+            t.pre('\r\n'.join(f"chunk {idx + 1}: {job.chunk_results[idx]['error']}"
+                               for idx in failed_chunks)),
+            t.form('messy/retry', method='POST', action=self.request.route_url('upload-commit')).add(
+                t.input_hidden('jobid', value=job.randkey),
+                t.custom_submit_bar(
+                    ('Retry failed chunks', method),
+                ).set_offset(1).show_reset_button(False),
+            )
+        )
+
+
+def commit_progress_js(request, jobid):
+    """ poll the status endpoint while the commit request is running """
+
+    status_url = request.route_url('upload-status', _query={'jobid': jobid})
+    return '''
+    $('form[action="%s"]').submit(function() {
+        $(this).append('<div id="upload-progress" class="mt-2">Committing...</div>');
+        var poll = function() {
+            $.getJSON('%s', function(data) {
+                if (data.status == 'running' || data.status == 'pending') {
+                    $('#upload-progress').text('Committed chunk(s): ' + data.completed + ' of '
+                        + data.chunks + ', failed: ' + data.failed.length);
+                    setTimeout(poll, 1000);
+                }
+            });
+        };
+        setTimeout(poll, 1000);
+    });
+    ''' % (request.route_url('upload-commit'), status_url)
+
+
 def generate_token_form(request):
 
     html = t.div(t.hr, t.h3('Token Generator', styles="bg-dark;"))
@@ -21,9 +21,10 @@ requires = [
     'pandas',
     'docutils',
     'pyramid_rpc',
-    'joblib',
+    'pyarrow',
     'more_itertools',
     'simplejson',
+    'orjson',
     'pyparsing',
 ]
 
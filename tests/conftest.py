@@ -0,0 +1,74 @@
+
+# fixtures for tests that need a MESSy database
+#
+# test modules using these fixtures require rhombus, and skip themselves if it is not
+# installed. the database is a SQLite file in the temporary directory of each test,
+# initialized with the MESSy setup data, with the search index using the SQLite FTS5
+# backend.
+
+import datetime
+
+import pytest
+import transaction
+
+
+@pytest.fixture
+def dbh(tmp_path):
+
+    from rhombus.lib.utils import get_dbhandler
+    from messy.scripts import run   # noqa: F401, sets the dbhandler class
+    from messy.lib.whoosh import set_index_service, create_index_service
+
+    settings = {
+        'sqlalchemy.url': f'sqlite:///{tmp_path}/messy.sqlite',
+        'messy.whoosh.path': str(tmp_path / 'index'),
+        'messy.search.backend': 'sqlite',
+    }
+    dbh = get_dbhandler(settings)
+    set_index_service(create_index_service(settings))
+    with transaction.manager:
+        dbh.initdb(create_table=True, init_data=True)
+
+    yield dbh
+
+    transaction.abort()
+    set_index_service(None)
+
+
+def sample_dict(collection_code, code, **kwargs):
+    return dict(
+        collection=collection_code,
+        code=code,
+        species='no-species',
+        passage='original',
+        collection_date=datetime.date(2021, 1, 1),
+        location='Indonesia',
+        category='RS',
+        specimen_type='np',
+        originating_institution='IRRELEVANT',
+        sampling_institution='IRRELEVANT',
+        host='human',
+        host_status='unknown',
+    ) | kwargs
+
+
+@pytest.fixture
+def make_collection(dbh):
+    """ return function creating a collection with samples, returning the collection id """
+
+    def _make_collection(code, group='CollectionMgr', samples=(), **kwargs):
+        with transaction.manager:
+            collection = dbh.Collection(code=code, group_id=dbh.get_group(group).id,
+                                        **kwargs).update({'institutions': ['IRRELEVANT']})
+            dbh.session().add(collection)
+            dbh.session().flush([collection])
+            for sample_code in samples:
+                sample = dbh.Sample()
+                sample.update(sample_dict(code, sample_code))
+                dbh.session().add(sample)
+            dbh.session().flush()
+            return collection.id
+
+    return _make_collection
+
+# EOF
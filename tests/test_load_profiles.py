@@ -0,0 +1,99 @@
+
+# number of SQL statements issued by the getters with load profiles and by the index tables
+
+import contextlib
+import types
+
+import pytest
+import transaction
+
+pytest.importorskip('rhombus')
+
+
+class DummyRequest(object):
+
+    acl = types.SimpleNamespace(is_guest=True)
+
+    def route_url(self, name, **kwargs):
+        return name
+
+
+@contextlib.contextmanager
+def count_statements(dbh):
+    """ yield a list of the statements executed on the engine of the session """
+
+    from sqlalchemy import event
+
+    engine = dbh.session().get_bind()
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+@pytest.fixture
+def populated(dbh, make_collection):
+    """ create 3 collections with 2 samples each and 3 plates, return the collection ids """
+
+    from messy.lib.ekcache import get_ek_cache
+
+    collection_ids = [make_collection(f'LOADP{i}', samples=[f'LOADP{i}-01', f'LOADP{i}-02'])
+                      for i in range(3)]
+
+    with transaction.manager:
+        for i in range(3):
+            plate = dbh.Plate()
+            plate.update({'code': f'LOADP-PLATE{i}', 'user': 'system/_SYSTEM_',
+                          'group': 'CollectionMgr', 'specimen_type': 'np',
+                          'experiment_type': 'rna-extraction', 'remark': f'plate {i}'})
+            dbh.session().add(plate)
+
+    # only statements of the getters are counted, hence the EK cache is loaded beforehand
+    # and the session starts without any loaded object
+    get_ek_cache().prepare(dbh.session())
+    dbh.session().expunge_all()
+    return collection_ids
+
+
+def test_samples_list_profile(dbh, populated):
+
+    with count_statements(dbh) as statements:
+        samples = dbh.get_samples(None, [{'collection_id': populated}], ignore_acl=True,
+                                  load='list')
+        codes = sorted(f'{s.code}/{s.collection.code}' for s in samples)
+
+    assert len(codes) == 6
+    assert len(statements) == 1
+
+
+def test_collection_index_table(dbh, populated):
+
+    from messy.views.collection import generate_collection_table
+
+    with count_statements(dbh) as statements:
+        collections = dbh.get_collections(groups=None, ignore_acl=True, load='list')
+        html, code = generate_collection_table(collections, DummyRequest())
+
+    assert len([c for c in collections if c.id in populated]) == 3
+    # collections with their groups, and the sample counters
+    assert len(statements) == 2
+
+
+def test_plate_index_table(dbh, populated):
+
+    from messy.views.plate import generate_plate_table
+
+    with count_statements(dbh) as statements:
+        plates = dbh.get_plates(groups=None, fetch=False, load='list').order_by(
+            dbh.Plate.date.desc())
+        html, code = generate_plate_table(plates, DummyRequest())
+
+    assert len(statements) == 1
+
+# EOF
@@ -0,0 +1,86 @@
+
+# propagation of collection flags to samples, including their search documents
+
+import pytest
+import transaction
+
+pytest.importorskip('rhombus')
+
+
+def viewer_groups(dbh):
+    """ groups of a user who does not belong to the group of the test collections """
+    return [('SampleViewer', dbh.get_group('SampleViewer').id)]
+
+
+def search_codes(dbh, text):
+    return sorted(s.code for s in dbh.search_samples(text, groups=viewer_groups(dbh)))
+
+
+def test_public_flag_propagates_to_samples_and_search(dbh, make_collection):
+
+    collection_id = make_collection('PROPAG', samples=['PROPAG-01', 'PROPAG-02'],
+                                    public=True)
+    assert search_codes(dbh, 'PROPAG-01 PROPAG-02') == ['PROPAG-01', 'PROPAG-02']
+
+    with transaction.manager:
+        collection = dbh.get_collections_by_ids([collection_id], None, ignore_acl=True)[0]
+        collection.update({'public': False})
+
+    samples = dbh.get_samples(None, [{'collection_id': [collection_id]}], ignore_acl=True)
+    assert [s.public for s in samples] == [False, False]
+    assert search_codes(dbh, 'PROPAG-01 PROPAG-02') == []
+
+    with transaction.manager:
+        collection = dbh.get_collections_by_ids([collection_id], None, ignore_acl=True)[0]
+        collection.update({'public': True})
+
+    assert search_codes(dbh, 'PROPAG-01 PROPAG-02') == ['PROPAG-01', 'PROPAG-02']
+
+
+def test_group_change_reindexes_samples(dbh, make_collection):
+
+    collection_id = make_collection('REGROUP', samples=['REGROUP-01'])
+    assert search_codes(dbh, 'REGROUP-01') == []
+
+    with transaction.manager:
+        collection = dbh.get_collections_by_ids([collection_id], None, ignore_acl=True)[0]
+        collection.update({'group': 'SampleViewer'})
+
+    assert search_codes(dbh, 'REGROUP-01') == ['REGROUP-01']
+
+    with transaction.manager:
+        collection = dbh.get_collections_by_ids([collection_id], None, ignore_acl=True)[0]
+        collection.update({'group': 'CollectionMgr'})
+
+    assert search_codes(dbh, 'REGROUP-01') == []
+
+
+def test_repair_drifts(dbh, make_collection):
+
+    from messy.lib import propagation
+
+    collection_id = make_collection('DRIFT', samples=['DRIFT-01'], public=True)
+    with transaction.manager:
+        sample = dbh.get_samples(None, [{'collection_id': [collection_id]}],
+                                 ignore_acl=True)[0]
+        sample.public = False
+
+    with transaction.manager:
+        repaired = list(propagation.repair_drifts(dbh.session(), fix=True))
+        assert [(c.id, count) for c, count in repaired] == [(collection_id, 1)]
+
+    assert search_codes(dbh, 'DRIFT-01') == ['DRIFT-01']
+
+
+def test_collection_delete_removes_sample_documents(dbh, make_collection):
+
+    collection_id = make_collection('CASCADE', samples=['CASCADE-01'], public=True)
+    assert search_codes(dbh, 'CASCADE-01') == ['CASCADE-01']
+
+    with transaction.manager:
+        dbh.session().delete(dbh.get_collections_by_ids([collection_id], None,
+                                                        ignore_acl=True)[0])
+
+    assert dbh.Sample.search_text('CASCADE-01', dbh.session(), id_only=True) == []
+
+# EOF
@@ -0,0 +1,39 @@
+
+# statistic counters maintained by messy.lib.stats
+
+import pytest
+import transaction
+
+pytest.importorskip('rhombus')
+
+
+def test_collection_delete_updates_sample_counters(dbh, make_collection):
+
+    from messy.lib import stats
+
+    collection_id = make_collection('STATDEL', samples=['STATDEL-01', 'STATDEL-02'])
+    counts = stats.get_counters(dbh.session(), 'samples')['samples']
+
+    with transaction.manager:
+        dbh.session().delete(dbh.get_collections_by_ids([collection_id], None,
+                                                        ignore_acl=True)[0])
+        dbh.session().flush()
+
+    assert stats.get_counters(dbh.session(), 'samples')['samples'] == counts - 2
+    assert collection_id not in stats.get_keyed_counters(dbh.session(), 'samples.collection')
+    assert stats.reconcile(dbh.session(), fix=False) == []
+
+
+def test_empty_counters_are_seeded(dbh, make_collection, monkeypatch):
+
+    from messy.lib import stats
+
+    make_collection('STATSEED', samples=['STATSEED-01'])
+    with transaction.manager:
+        dbh.session().execute(dbh.StatCounter.__table__.delete())
+
+    monkeypatch.setattr(stats, '_seeded_', False)
+    assert stats.get_counters(dbh.session(), 'samples')['samples'] >= 1
+    assert stats.reconcile(dbh.session(), fix=False) == []
+
+# EOF